@@ -5,9 +5,7 @@ import time
 import sys
 import colorsys
 import os
-import datetime
 import math
-from threading import Timer
 
 __addon__      = xbmcaddon.Addon()
 __addondir__   = xbmc.translatePath( __addon__.getAddonInfo('profile') ) 
@@ -20,6 +18,14 @@ sys.path.append (__resource__)
 from settings import *
 from tools import *
 from hue import *
+from spectrum import *
+from pipeline import *
+from adaptive import *
+from zones import *
+from instrument import *
+from chapters import *
+from smoothing import *
+from tracks import *
 
 try:
   import requests
@@ -35,54 +41,66 @@ fmt = capture.getImageFormat()
 # xbmc.log("Hue Capture Image format: %s" % fmt)
 fmtRGBA = fmt == 'RGBA'
 
-class RepeatedTimer(object):
-  def __init__(self, interval, function, *args, **kwargs):
-    self._timer     = None
-    self.interval   = interval
-    self.function   = function
-    self.args       = args
-    self.kwargs     = kwargs
-    self.is_running = False
-    self.start()
-
-  def _run(self):
-    self.is_running = False
-    self.start()
-    self.function(*self.args, **self.kwargs)
-
-  def start(self):
-    if not self.is_running:
-      self._timer = Timer(self.interval, self._run)
-      self._timer.start()
-      self.is_running = True
-
-  def stop(self):
-    self._timer.cancel()
-    self.is_running = False
+if numpy is not None:
+  xbmc.log("Kodi Hue: using NumPy for frame analysis")
+
+# what depends on which settings, for onSettingsChanged
+CAPTURE_SETTINGS = ("adaptive_capture", "capture_min_width", "capture_max_width", "capture_min_rate", "capture_max_rate")
+ZONE_SETTINGS = ("light", "light1_zone", "light1_zone_rect", "light2_zone", "light2_zone_rect",
+  "light3_zone", "light3_zone_rect", "zone_falloff")
+SMOOTHING_SETTINGS = ("smoothing", "smoothing_time", "delta_e")
+TRACK_SETTINGS = ZONE_SETTINGS + ("color_bias", "color_tracks")
 
 class MyMonitor( xbmc.Monitor ):
   def __init__( self, *args, **kwargs ):
     xbmc.Monitor.__init__( self )
 
   def onSettingsChanged( self ):
-    logger.debuglog("running in mode %s" % str(hue.settings.mode))
-    last = datetime.datetime.now()
-    hue.settings.readxml()
-    hue.update_settings()
+    # read into a new MySettings and swapped in whole, only what changed is set up again
+    settings = MySettings()
+    changed = settings.changes(hue.settings)
+    if not changed:
+      return
+    logger.debuglog("running in mode %s", str(settings.mode))
+    hue.reload_settings(settings)
+    if capture_controller is not None and changed.intersection(CAPTURE_SETTINGS):
+      capture_controller.configure(settings)
+    global light_zones
+    if changed.intersection(ZONE_SETTINGS):
+      light_zones = zone_map(settings)
+    if smoothing is not None and changed.intersection(SMOOTHING_SETTINGS):
+      smoothing.configure(settings)
+    if scene_detector is not None:
+      scene_detector.threshold = settings.scene_cut
+    stages.enabled = settings.stage_timing
+    trace.enabled = settings.trace
+    if credits_time is not None and "credits_delay_time" in changed:
+      set_credits_time(credits_time)
+    if color_track_source is not None and changed.intersection(TRACK_SETTINGS):
+      open_color_track(*color_track_source)
 
 class MyPlayer(xbmc.Player):
   duration = 0
   playingvideo = False
   playlistlen = 0
-  timer = None
   movie = False
+  speed = 1
 
   def __init__(self):
     xbmc.Player.__init__(self)
-  
-  def checkTime(self):
+
+  def playingTime(self):
+    # read by the credits scheduler when the credits should be due
     if self.isPlayingVideo():
-      check_time(int(self.getTime())) #call back out to plugin function.
+      return self.getTime()
+    return None
+
+  def syncCredits(self, speed, position=None):
+    # tell the credits scheduler where playback is and how fast it's going
+    if self.movie and self.duration != 0 and credits_scheduler is not None:
+      if position is None:
+        position = self.getTime()
+      credits_scheduler.sync(position, speed)
 
   def onPlayBackStarted(self):
     xbmc.log("Kodi Hue: DEBUG playback started called on player")
@@ -98,17 +116,17 @@ class MyPlayer(xbmc.Player):
       global credits_triggered
       credits_triggered = False
       if self.movie and self.duration != 0: #only try if its a movie and has a duration
-        get_credits_info(self.getVideoInfoTag().getTitle(), self.duration) # TODO: start it on a timer to not block the beginning of the media
-        logger.debuglog("credits_time: %r" % credits_time)
-        self.timer = RepeatedTimer(1, self.checkTime)
+        get_credits_info(self.getVideoInfoTag().getTitle(), self.duration, self.getPlayingFile()) # answer arrives in the background
+      open_color_track(self.getPlayingFile(), self.duration)
+      self.speed = 1
+      self.syncCredits(self.speed)
       state_changed("started", self.duration)
 
   def onPlayBackPaused(self):
     xbmc.log("Kodi Hue: DEBUG playback paused called on player")
     if self.isPlayingVideo():
       self.playingvideo = False
-      if self.movie and not self.timer is None:
-        self.timer.stop()
+      self.syncCredits(0)
       state_changed("paused", self.duration)
 
   def onPlayBackResumed(self):
@@ -118,18 +136,38 @@ class MyPlayer(xbmc.Player):
       if self.duration == 0:
         self.duration = self.getTotalTime()
         if self.movie and self.duration != 0: #only try if its a movie and has a duration
-          get_credits_info(self.getVideoInfoTag().getTitle(), self.duration) # TODO: start it on a timer to not block the beginning of the media
-          logger.debuglog("credits_time: %r" % credits_time)
-      if self.movie and self.duration != 0:    
-        self.timer = RepeatedTimer(1, self.checkTime)
+          get_credits_info(self.getVideoInfoTag().getTitle(), self.duration, self.getPlayingFile()) # answer arrives in the background
+        open_color_track(self.getPlayingFile(), self.duration)
+      self.speed = 1 # resuming plays at normal speed
+      self.syncCredits(self.speed)
       state_changed("resumed", self.duration)
 
+  def onPlayBackSeek(self, seekTime, seekOffset):
+    logger.debuglog("playback seek to %r called on player", seekTime)
+    if self.isPlayingVideo():
+      self.syncCredits(self.speed if self.playingvideo else 0, seekTime / 1000.0)
+    if color_track is not None:
+      color_track.seeked()
+
+  def onPlayBackSeekChapter(self, chapter):
+    logger.debuglog("playback seek to chapter %r called on player", chapter)
+    if self.isPlayingVideo():
+      self.syncCredits(self.speed if self.playingvideo else 0)
+    if color_track is not None:
+      color_track.seeked()
+
+  def onPlayBackSpeedChanged(self, speed):
+    logger.debuglog("playback speed changed to %r called on player", speed)
+    self.speed = speed
+    if self.isPlayingVideo() and self.playingvideo:
+      self.syncCredits(speed)
+
   def onPlayBackStopped(self):
     xbmc.log("Kodi Hue: DEBUG playback stopped called on player")
+    cancel_credits_info()
+    close_color_track()
     self.playingvideo = False
     self.playlistlen = 0
-    if self.movie and not self.timer is None:
-      self.timer.stop()
     state_changed("stopped", self.duration)
 
   def onPlayBackEnded(self):
@@ -139,13 +177,14 @@ class MyPlayer(xbmc.Player):
       return
       
     self.playingvideo = False
-    if self.movie and not self.timer is None:
-      self.timer.stop()
+    cancel_credits_info()
+    close_color_track()
     state_changed("stopped", self.duration)
 
 class HSVRatio:
   cyan_min = float(4.5/12.0)
   cyan_max = float(7.75/12.0)
+  scene = 0 # scene cuts seen before this frame
 
   def __init__(self, hue=0.0, saturation=0.0, value=0.0, ratio=0.0):
     self.h = hue
@@ -166,20 +205,22 @@ class HSVRatio:
     
 
   def hue(self, fullSpectrum):
+    # corrected on a copy, the same ratio can be sent more than once
+    h = self.h
     if fullSpectrum != True:
       if self.s > 0.01:
-        if self.h < 0.5:
+        if h < 0.5:
           #yellow-green correction
-          self.h = self.h * 1.17
+          h = h * 1.17
           #cyan-green correction
-          if self.h > self.cyan_min:
-            self.h = self.cyan_min
+          if h > self.cyan_min:
+            h = self.cyan_min
         else:
           #cyan-blue correction
-          if self.h < self.cyan_max:
-            self.h = self.cyan_max
+          if h < self.cyan_max:
+            h = self.cyan_max
 
-    h = int(self.h*65535) # on a scale from 0 <-> 65535
+    h = int(h*65535) # on a scale from 0 <-> 65535
     s = int(self.s*255)
     v = int(self.v*255)
     if v < hue.settings.ambilight_min:
@@ -199,7 +240,7 @@ class Screenshot:
 
   def most_used_spectrum(self, spectrum, saturation, value, size, overall_value):
     # color bias/groups 6 - 36 in steps of 3
-    colorGroups = settings.color_bias
+    colorGroups = hue.settings.color_bias
     if colorGroups == 0:
       colorGroups = 1
     colorHueRatio = 360 / colorGroups
@@ -245,54 +286,31 @@ class Screenshot:
     else:
       return [HSVRatio()] * 3
 
-  def spectrum_hsv(self, pixels, width, height):
-    spectrum = {}
-    saturation = {}
-    value = {}
-
-    size = int(len(pixels)/4)
-    pixel = 0
-
-    i = 0
-    s, v = 0, 0
-    r, g, b = 0, 0, 0
-    tmph, tmps, tmpv = 0, 0, 0
-    
-    for i in range(size):
-      if fmtRGBA:
-        r = pixels[pixel]
-        g = pixels[pixel + 1]
-        b = pixels[pixel + 2]
-      else: #probably BGRA
-        b = pixels[pixel]
-        g = pixels[pixel + 1]
-        r = pixels[pixel + 2]
-      pixel += 4
-
-      tmph, tmps, tmpv = colorsys.rgb_to_hsv(float(r/255.0), float(g/255.0), float(b/255.0))
-      s += tmps
-      v += tmpv
-
-      # skip low value and saturation
-      if tmpv > 0.25:
-        if tmps > 0.33:
-          h = int(tmph * 360)
-
-          # logger.debuglog("%s \t set pixel r %s \tg %s \tb %s" % (i, r, g, b))
-          # logger.debuglog("%s \t set pixel h %s \ts %s \tv %s" % (i, tmph*100, tmps*100, tmpv*100))
-
-          if spectrum.has_key(h):
-            spectrum[h] += 1 # tmps * 2 * tmpv
-            saturation[h] = (saturation[h] + tmps)/2
-            value[h] = (value[h] + tmpv)/2
-          else:
-            spectrum[h] = 1 # tmps * 2 * tmpv
-            saturation[h] = tmps
-            value[h] = tmpv
+  def zone_hsv(self, zones):
+    # one color per light, each from its own part of the screen
+    start = stages.start()
+    spectra = zones.spectra(self.pixels, self.capture_width, self.capture_height, fmtRGBA, __addondir__)
+    self.histograms = spectra
+    stages.stop("spectrum_hsv", start)
+    start = stages.start()
+    hsvRatios = []
+    for spectrum, saturation, value, size, overall_value in spectra:
+      hsvRatios.append(self.most_used_spectrum(spectrum, saturation, value, size, overall_value)[0])
+    stages.stop("most_used_spectrum", start)
+    return hsvRatios
 
-    overall_value = v / float(i)
-    # s_overall = int(s * 100 / i)
-    return self.most_used_spectrum(spectrum, saturation, value, size, overall_value)
+  def spectrum_hsv(self, pixels, width, height):
+    start = stages.start()
+    if numpy is not None:
+      spectrum, saturation, value, size, overall_value = spectrum_hsv_numpy(pixels, fmtRGBA)
+    else:
+      spectrum, saturation, value, size, overall_value = spectrum_hsv_lut(pixels, fmtRGBA, __addondir__)
+    self.histograms = [(spectrum, saturation, value, size, overall_value)]
+    stages.stop("spectrum_hsv", start)
+    start = stages.start()
+    hsvRatios = self.most_used_spectrum(spectrum, saturation, value, size, overall_value)
+    stages.stop("most_used_spectrum", start)
+    return hsvRatios
 
 def run():
   player = MyPlayer()
@@ -302,69 +320,243 @@ def run():
     
   monitor = MyMonitor()
 
-  last = 0
-
+  global credits_scheduler
+  credits_scheduler = CreditsScheduler(credits_due, player.playingTime)
+
+  last = None
+  profiler = None
+  stages.enabled = hue.settings.stage_timing
+  trace.enabled = hue.settings.trace
+
+  global pipeline, frame_detector, capture_controller, light_zones, smoothing, scene_detector
+  frame_detector = FrameChangeDetector(hue.settings.frame_tolerance)
+  scene_detector = SceneCutDetector(hue.settings.scene_cut)
+  light_zones = zone_map(hue.settings)
+  capture_controller = CaptureController(hue.settings)
+  smoothing = Smoothing(hue.settings)
+  capture_info = None
+  targets = []
+  recorded = None # colours of the last analysed frame, for the color track
+  replay_scene = None
   #logger.debuglog("starting run loop!")
   while not monitor.abortRequested():
 
     waitTimeout = 1;
 
+    if hue.settings.ambilight_pipeline and pipeline is None:
+      pipeline = FramePipeline(fade_light_hsv, logger)
+      pipeline.start()
+    elif not hue.settings.ambilight_pipeline and pipeline is not None:
+      pipeline.stop()
+      pipeline = None
+
+    profile_request = xbmcgui.Window(10000).getProperty(PROFILE_PROPERTY)
+    if profile_request and profiler is None:
+      xbmcgui.Window(10000).clearProperty(PROFILE_PROPERTY)
+      logger.log("profiling the ambilight loop for %s seconds" % profile_request)
+      profiler = Profiler(int(profile_request), __addondir__)
+    elif profiler is not None and profiler.expired():
+      report = profiler.finish()
+      profiler = None
+      logger.log("profile written to %s" % report)
+      notify("Kodi Hue", "Profile written to %s" % report)
+
+    if xbmcgui.Window(10000).getProperty(TRACE_PROPERTY):
+      xbmcgui.Window(10000).clearProperty(TRACE_PROPERTY)
+      path = os.path.join(__addondir__, time.strftime("trace-%Y%m%d-%H%M%S.txt"))
+      count = trace.dump(path)
+      logger.log("%s trace events written to %s", count, path)
+      notify("Kodi Hue", "Trace written to %s" % path)
+
     if hue.settings.mode == 0: # ambilight mode
       waitTimeout = 0.1
-      now = time.time()
-      logger.debuglog("run loop delta: %f (%f/sec)" % ((now-last), 1/(now-last)))
-      last = now
+      if capture_controller.enabled:
+        waitTimeout = capture_controller.interval
+      stages.stop("loop", last)
+      last = stages.start()
 
       if player.playingvideo: # only if there's actually video
+        position = None
+        replayed = None
+        if color_track is not None:
+          position = player.getTime()
+          if hue.settings.color_tracks == TRACKS_REPLAY:
+            replayed = color_track.read(position)
         try:
-          if capture.waitForCaptureStateChangeEvent(200):
+          if replayed is not None:
+            # watched before: the recorded colours, nothing to capture or analyse
+            scene, colors = replayed
+            if replay_scene is not None and scene != replay_scene:
+              scene_detector.scene += 1 # recorded at a cut
+              scene_cut()
+            replay_scene = scene
+            hsvRatios = [HSVRatio(h, s, v) for h, s, v in colors]
+            for hsvRatio in hsvRatios:
+              hsvRatio.scene = scene_detector.scene
+            publish_targets(list(ambilight_targets(hsvRatios)))
+            frame_detector.reset() # live analysis after a gap starts from a fresh frame
+            recorded = None
+            waitTimeout = TRACK_SLOT
+            captured = False
+          else:
+            replay_scene = None
+            start = stages.start()
+            captured = capture.waitForCaptureStateChangeEvent(200)
+            stages.stop("capture_wait", start)
+          if captured:
             #we've got a capture event
             if capture.getCaptureState() == xbmc.CAPTURE_STATE_DONE:
-              screen = Screenshot(capture.getImage(), capture.getWidth(), capture.getHeight())
-              hsvRatios = screen.spectrum_hsv(screen.pixels, screen.capture_width, screen.capture_height)
-              if hue.settings.light == 0:
-                fade_light_hsv(hue.light, hsvRatios[0])
-              else:
-                fade_light_hsv(hue.light[0], hsvRatios[0])
-                if hue.settings.light > 1:
-                  #xbmc.sleep(4) #why?
-                  fade_light_hsv(hue.light[1], hsvRatios[1])
-                if hue.settings.light > 2:
-                  #xbmc.sleep(4) #why?
-                  fade_light_hsv(hue.light[2], hsvRatios[2])
+              start = stages.start()
+              pixels = capture.getImage()
+              stages.stop("get_image", start)
+              screen = Screenshot(pixels, capture.getWidth(), capture.getHeight())
+              frame_detector.tolerance = hue.settings.frame_tolerance
+              # skip frames that look like the last analysed one, the lights already show it
+              if frame_detector.changed(screen.pixels):
+                start = time.time()
+                if light_zones is not None:
+                  hsvRatios = screen.zone_hsv(light_zones)
+                else:
+                  hsvRatios = screen.spectrum_hsv(screen.pixels, screen.capture_width, screen.capture_height)
+                capture_controller.frame(time.time() - start)
+                if scene_detector.cut(screen.histograms):
+                  scene_cut()
+                for hsvRatio in hsvRatios:
+                  hsvRatio.scene = scene_detector.scene
+                targets = list(ambilight_targets(hsvRatios))
+                recorded = [(hsvRatio.h, hsvRatio.s, hsvRatio.v) for light, hsvRatio in targets]
+              elif smoothing.settled():
+                targets = [] # the lights show the last analysed frame
+              # unchanged frames still go through while the smoothed colours catch up
+              publish_targets(targets)
+              if color_track is not None and recorded is not None:
+                color_track.write(position, recorded, scene_detector.scene)
         except ZeroDivisionError:
           logger.debuglog("no frame. looping.")
 
+        if capture_controller.update(time.time(), scheduler_latency()):
+          start_capture(capture_controller.width)
+        if capture_info != repr(capture_controller):
+          capture_info = repr(capture_controller)
+          logger.log("capture: %s" % capture_info)
+          xbmcgui.Window(10000).setProperty("script.kodi.hue.ambilight.capture", capture_info)
+
     if monitor.waitForAbort(waitTimeout):
       break
       
+  if pipeline is not None:
+    logger.debuglog("pipeline: %s", pipeline)
+    pipeline.stop()
+    pipeline = None
+  if profiler is not None:
+    profiler.finish()
+  credits_scheduler.close()
+
   del player
   del monitor
 
+def start_capture(capture_width):
+  capture_height = capture_width / capture.getAspectRatio()
+  if capture_height == 0:
+    capture_height = capture_width #fix for divide by zero.
+  logger.debuglog("capture %s x %s", capture_width, capture_height)
+  capture.capture(int(capture_width), int(capture_height), xbmc.CAPTURE_FLAG_CONTINUOUS)
+
+def ambilight_targets(hsvRatios):
+  lights = hue.light # read once, a settings change swaps in a new one
+  if not isinstance(lights, list):
+    return [(lights, hsvRatios[0])]
+  return zip(lights, hsvRatios)
+
+def publish_targets(targets):
+  for i, (light, hsvRatio) in enumerate(targets):
+    if pipeline is not None:
+      pipeline.publish(i, light, hsvRatio) # sent by the pipeline thread, stale ones are dropped
+    else:
+      fade_light_hsv(light, hsvRatio)
+
+def scene_cut():
+  # queued colours of the old scene aren't worth sending anymore
+  logger.debuglog("scene cut")
+  if pipeline is not None:
+    pipeline.clear()
+  discard_all(PRIORITY_AMBILIGHT)
+
 def fade_light_hsv(light, hsvRatio):
-  fullSpectrum = light.fullSpectrum
+  start = stages.start()
+  send_light_hsv(light, hsvRatio)
+  stages.stop("fade_light_hsv", start)
+
+def send_light_hsv(light, hsvRatio):
+  fullSpectrum = light.fullSpectrum or light.gamut is not None # xy is exact, no hue corrections
   h, s, v = hsvRatio.hue(fullSpectrum)
-  hvec = abs(h - light.hueLast) % int(65535/2)
-  hvec = float(hvec/128.0)
-  svec = s - light.satLast
-  vvec = v - light.valLast
-  distance = math.sqrt(hvec**2 + svec**2 + vvec**2) #changed to squares for performance
-  if distance > 0:
-    duration = int(3 + 27 * distance/255)
+  if hue.stream is not None and hue.stream.active:
+    # streamed every frame anyway, no need to look at the distance
+    if light.group:
+      for l in light.lights:
+        hue.stream.update(l, h, s, v)
+    else:
+      hue.stream.update(light.light, h, s, v)
+    return
+  # filtered, and only sent when it's visibly different from what the light shows
+  smoothed = smoothing.update(light, h, s, v, time.time(), hsvRatio.scene)
+  if smoothed is not None:
+    h, s, v, distance, cut = smoothed
+    if cut:
+      duration = CUT_TRANSITION # a hard cut shouldn't fade
+    else:
+      duration = int(3 + 27 * min(distance, 100) / 100)
     # logger.debuglog("distance %s duration %s" % (distance, duration))
-    light.set_light2(h, s, v, duration)
-
+    xy = None
+    if light.gamut is not None:
+      xy = light.gamut.xy(h, s) # table lookup, clipped to what the light can show
+    light.set_light2(h, s, v, duration, PRIORITY_AMBILIGHT, xy)
+
+pipeline = None
+frame_detector = None
+capture_controller = None
+light_zones = None
+smoothing = None
+scene_detector = None
+color_track = None
+color_track_source = None # (file, duration) of the video playing
 credits_time = None #test = 10
 credits_triggered = False
+credits_lookup = None
+credits_scheduler = None
+credits_cache = CreditsCache(os.path.join(__addondir__, CREDITS_CACHE_FILE))
 
-def get_credits_info(title, duration):
+def get_credits_info(title, duration, path=None):
   logger.debuglog("get_credits_info")
+  cancel_credits_info()
   if hue.settings.undim_during_credits:
-    #get credits time here
-    logger.debuglog("title: %r, duration: %r" % (title, duration))
-    global credits_time
-    credits_time = ChapterManager.CreditsStartTimeForMovie(title, duration)
-    logger.debuglog("set credits time to: %r" % credits_time)
+    #get credits time in the background, the credits scheduler waits for it once it's there
+    logger.debuglog("title: %r, duration: %r, file: %r", title, duration, path)
+    chapters = None
+    if path:
+      chapters = lambda: media_chapters(path) # chapters in the file first, then chapterdb
+    global credits_lookup
+    credits_lookup = CreditsLookup(title, duration, set_credits_time, cache=credits_cache, chapters=chapters)
+
+def cancel_credits_info():
+  global credits_time, credits_lookup
+  if credits_lookup is not None:
+    credits_lookup.cancel()
+    credits_lookup = None
+  credits_time = None
+  if credits_scheduler is not None:
+    credits_scheduler.clear()
+
+def set_credits_time(t):
+  global credits_time
+  credits_time = t
+  logger.debuglog("set credits time to: %r", credits_time)
+  if credits_scheduler is not None:
+    credits_scheduler.set_target(None if t is None else t + hue.settings.credits_delay_time)
+
+def credits_due(position):
+  # from the credits scheduler: credits reached, or rewound to before them
+  check_time(int(position))
 
 def check_time(cur_time):
   global credits_triggered
@@ -386,8 +578,60 @@ def check_time(cur_time):
       #still before credits, if this has happened, we've rewound
       credits_triggered = False
 
+def track_signature():
+  # the settings the recorded colours depend on
+  return "%s|%s|%s|%s|%s|%s|%s|%s|%s" % (hue.settings.light, hue.settings.color_bias,
+    hue.settings.light1_zone, hue.settings.light1_zone_rect, hue.settings.light2_zone, hue.settings.light2_zone_rect,
+    hue.settings.light3_zone, hue.settings.light3_zone_rect, hue.settings.zone_falloff)
+
+def open_color_track(path, duration):
+  global color_track, color_track_source
+  close_color_track()
+  color_track_source = (path, duration)
+  if hue.settings.color_tracks == TRACKS_OFF or not path or duration == 0:
+    return
+  track_dir = os.path.join(__addondir__, TRACK_DIR)
+  try:
+    if not os.path.isdir(track_dir):
+      os.makedirs(track_dir)
+    prune_tracks(track_dir)
+    lights = 1 if hue.settings.light == 0 else hue.settings.light
+    color_track = ColorTrack(os.path.join(track_dir, track_key(path, duration, track_signature())), lights, duration)
+    logger.debuglog("color %s", color_track)
+  except (IOError, OSError, ValueError) as e:
+    logger.log("no color track: %s" % e) # live analysis only
+    color_track = None
+
+def close_color_track():
+  global color_track, color_track_source
+  if color_track is not None:
+    logger.debuglog("color %s", color_track)
+    color_track.close()
+  color_track = None
+  color_track_source = None
+
 def state_changed(state, duration):
-  logger.debuglog("state changed to: %s" % state)
+  logger.debuglog("state changed to: %s", state)
+  trace.add("state", None, state)
+
+  if state in ["paused", "stopped"]:
+    # don't let a queued ambilight frame override the undim
+    if pipeline is not None:
+      pipeline.clear()
+    discard_all(PRIORITY_AMBILIGHT)
+    hue.stop_stream()
+    if frame_detector is not None:
+      logger.debuglog("frames: %s", frame_detector)
+    if smoothing is not None:
+      logger.debuglog("light commands: %s, %s", smoothing, scene_detector)
+    if stages.enabled:
+      logger.log("ambilight stages:\n%s" % stages.report())
+  if frame_detector is not None:
+    frame_detector.reset() # always analyse the first frame after a state change
+  if scene_detector is not None:
+    scene_detector.reset()
+  if smoothing is not None:
+    smoothing.reset()
 
   if duration < hue.settings.misc_disableshort_threshold and hue.settings.misc_disableshort:
     logger.debuglog("add-on disabled for short movies")
@@ -395,12 +639,13 @@ def state_changed(state, duration):
 
   if state == "started":
     logger.debuglog("retrieving current setting before starting")
-    
-    if hue.settings.light == 0: # group mode
-      hue.light.get_current_setting()
-    else:
-      for l in hue.light:
-        l.get_current_setting() #loop through without sleep.
+    for bridge in configured_bridges(hue.settings):
+      bridge_settings = BridgeSettings(hue.settings, bridge)
+      get_session(bridge_settings.bridge_ip).warm(bridge_settings.bridge_user, hue.settings.send_workers)
+    snapshot = hue.get_snapshots() # everything in two requests per bridge (None falls back to one per light)
+
+    for l in each_light(hue.light): # a group or the single lights
+      l.get_current_setting(snapshot) #loop through without sleep.
       # hue.light[0].get_current_setting()
       # if hue.settings.light > 1:
       #   xbmc.sleep(1)
@@ -411,46 +656,35 @@ def state_changed(state, duration):
 
     if hue.settings.mode == 0: # ambilight mode
       if hue.settings.ambilight_dim:
-        if hue.settings.ambilight_dim_light == 0:
-          hue.ambilight_dim_light.get_current_setting()
-        elif hue.settings.ambilight_dim_light > 0:
-          for l in hue.ambilight_dim_light:
-            l.get_current_setting()
+        for l in each_light(hue.ambilight_dim_light):
+          l.get_current_setting(snapshot)
       #start capture when playback starts
       capture_width = 32 #100
-      capture_height = capture_width / capture.getAspectRatio()
-      if capture_height == 0:
-        capture_height = capture_width #fix for divide by zero.
-      logger.debuglog("capture %s x %s" % (capture_width, capture_height))
-      capture.capture(int(capture_width), int(capture_height), xbmc.CAPTURE_FLAG_CONTINUOUS)
+      if capture_controller is not None and capture_controller.enabled:
+        capture_width = capture_controller.width
+      start_capture(capture_width)
 
   if (state == "started" and hue.pauseafterrefreshchange == 0) or state == "resumed":
     if hue.settings.mode == 0 and hue.settings.ambilight_dim: #if in ambilight mode and dimming is enabled
       logger.debuglog("dimming for ambilight")
-      if hue.settings.ambilight_dim_light == 0:
-        hue.ambilight_dim_light.dim_light()
-      elif hue.settings.ambilight_dim_light > 0:
-        for l in hue.ambilight_dim_light:
-          l.dim_light()
+      for l in each_light(hue.ambilight_dim_light):
+        l.dim_light()
     hue.dim_lights()
   elif state == "paused" and hue.last_state == "dimmed":
     #only if its coming from being off
     if hue.settings.mode == 0 and hue.settings.ambilight_dim:
-      if hue.settings.ambilight_dim_light == 0:
-        hue.ambilight_dim_light.partial_light()
-      elif hue.settings.ambilight_dim_light > 0:
-        for l in hue.ambilight_dim_light:
-          l.partial_light()
+      for l in each_light(hue.ambilight_dim_light):
+        l.partial_light()
     hue.partial_lights()
   elif state == "stopped":
     if hue.settings.mode == 0 and hue.settings.ambilight_dim:
-      if hue.settings.ambilight_dim_light == 0:
-        hue.ambilight_dim_light.brighter_light()
-      elif hue.settings.ambilight_dim_light > 0:
-        for l in hue.ambilight_dim_light:
-          l.brighter_light()
+      for l in each_light(hue.ambilight_dim_light):
+        l.brighter_light()
     hue.brighter_lights()
 
+  if state in ["started", "resumed"] and hue.settings.mode == 0:
+    hue.start_stream() # no-op unless entertainment streaming is selected
+
 if ( __name__ == "__main__" ):
   logger = Logger()
   settings = MySettings()
@@ -460,12 +694,20 @@ if ( __name__ == "__main__" ):
   args = None
   if len(sys.argv) == 2:
     args = sys.argv[1]
-  hue = Hue(settings, args)
-  while not hue.connected and not monitor.abortRequested():
-    logger.debuglog("not connected")
-    time.sleep(1)
-  run()
-  
+  if args == "action=profile":
+    # the running service picks this up and profiles its own loop
+    xbmcgui.Window(10000).setProperty(PROFILE_PROPERTY, str(settings.profile_seconds))
+    notify("Kodi Hue", "Profiling the next %s seconds" % settings.profile_seconds)
+  elif args == "action=dump_trace":
+    xbmcgui.Window(10000).setProperty(TRACE_PROPERTY, "dump")
+  else:
+    hue = Hue(settings, args)
+    while not hue.connected and not monitor.abortRequested():
+      logger.debuglog("not connected")
+      time.sleep(1)
+    run()
+    stop_schedulers()
+
   del logger
   del settings
 
@@ -0,0 +1,78 @@
+import time
+
+# capture widths the controller steps through (height follows the aspect ratio)
+WIDTHS = [8, 12, 16, 24, 32, 48, 64, 96, 128]
+
+class CaptureController:
+  # Closed loop for the ambilight capture. Every WINDOW seconds it looks at the
+  # analysis time per frame and the bridge round trip, and moves the capture
+  # width and the loop interval within the user's bounds: smaller/slower when
+  # frames overrun their budget, faster and then bigger when there's capacity
+  # to spare. Only the add-on's own measured analysis time counts; the CPU
+  # time of the process would be Kodi's (video decoding, the GUI) as well.
+  WINDOW = 2.0
+  STEP = 1.25
+  OVERRUN = 0.5 # analysis may use half the frame budget
+  SPARE = 0.1
+
+  def __init__(self, settings, width=32, interval=0.1):
+    self.width = width
+    self.interval = interval
+    self.configure(settings)
+    self.start_window(time.time())
+
+  def configure(self, settings):
+    self.enabled = settings.adaptive_capture
+    self.widths = [w for w in WIDTHS if settings.capture_min_width <= w <= settings.capture_max_width]
+    if not self.widths:
+      self.widths = [settings.capture_min_width]
+    self.min_interval = 1.0 / settings.capture_max_rate
+    self.max_interval = 1.0 / settings.capture_min_rate
+    # snap the current values into the (possibly new) bounds
+    self.width = min(self.widths, key=lambda w: abs(w - self.width))
+    self.interval = min(max(self.interval, self.min_interval), self.max_interval)
+
+  def start_window(self, now):
+    self.window_start = now
+    self.frames = 0
+    self.analysis = 0.0
+
+  def frame(self, analysis_time):
+    self.frames += 1
+    self.analysis += analysis_time
+
+  def update(self, now, send_latency=0.0):
+    # returns True when the capture width changed and the capture needs a restart
+    elapsed = now - self.window_start
+    if not self.enabled or elapsed < self.WINDOW:
+      return False
+
+    frames = self.frames
+    analysis = self.analysis / frames if frames else 0.0
+    self.start_window(now)
+    if frames == 0:
+      return False # nothing captured (paused, menus), nothing to learn from
+
+    width = self.width
+    i = self.widths.index(width)
+    if analysis > self.interval * self.OVERRUN:
+      if i > 0:
+        width = self.widths[i - 1]
+      else:
+        self.interval = min(self.interval * self.STEP, self.max_interval)
+    elif analysis < self.interval * self.SPARE:
+      if self.interval > self.min_interval and send_latency < self.interval / self.STEP:
+        self.interval = max(self.interval / self.STEP, self.min_interval)
+      elif i < len(self.widths) - 1:
+        width = self.widths[i + 1]
+
+    # no point in producing frames faster than the bridge takes them
+    if send_latency > self.interval:
+      self.interval = min(send_latency, self.max_interval)
+
+    changed = width != self.width
+    self.width = width
+    return changed
+
+  def __repr__(self):
+    return 'width: %s rate: %.1f/sec' % (self.width, 1.0 / self.interval)
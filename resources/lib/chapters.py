@@ -0,0 +1,362 @@
+import os
+import struct
+
+try:
+  import xbmcvfs
+except ImportError:
+  xbmcvfs = None
+
+# Chapter start times (seconds) straight from the container, reading only the
+# chapter metadata: the Matroska Chapters element (found through the SeekHead)
+# or the MP4 chapter atoms (Nero chpl or a QuickTime chapter text track).
+
+MAX_ELEMENT = 4 * 1024 * 1024 # never read more than this for one element/atom
+MAX_SCAN = 64 # top level elements looked at when there's no SeekHead entry
+
+# Matroska element IDs
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEKHEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEKID = 0x53AB
+SEEKPOSITION = 0x53AC
+CHAPTERS = 0x1043A770
+EDITIONENTRY = 0x45B9
+EDITIONFLAGDEFAULT = 0x45DB
+EDITIONFLAGHIDDEN = 0x45BD
+CHAPTERATOM = 0xB6
+CHAPTERTIMESTART = 0x91
+CHAPTERFLAGHIDDEN = 0x98
+CHAPTERFLAGENABLED = 0x4598
+
+# MP4 atoms that only contain other atoms
+MP4_CONTAINERS = set([b"moov", b"trak", b"mdia", b"minf", b"stbl", b"udta", b"tref"])
+
+class ChapterError(Exception):
+  pass
+
+def read_chapters(f):
+  # sorted chapter starts in seconds, [] when the file has none
+  f.seek(0)
+  head = f.read(12)
+  if len(head) < 12:
+    raise ChapterError("file too short")
+  if struct.unpack(">I", head[0:4])[0] == EBML:
+    return read_mkv_chapters(f)
+  if head[4:8] in (b"ftyp", b"moov", b"mdat", b"free", b"wide", b"skip"):
+    return read_mp4_chapters(f)
+  raise ChapterError("not a Matroska or MP4 file")
+
+def open_media(path):
+  # local files directly, everything else (smb://, nfs://, ...) through Kodi's VFS
+  if os.path.exists(path):
+    return open(path, "rb")
+  if xbmcvfs is not None:
+    return VFSFile(path)
+  raise ChapterError("can't open %s" % path)
+
+class VFSFile:
+  # the read/seek/close subset of a file object over xbmcvfs.File
+  def __init__(self, path):
+    self.f = xbmcvfs.File(path)
+
+  def read(self, size):
+    return bytes(self.f.readBytes(size))
+
+  def seek(self, offset, whence=0):
+    return self.f.seek(offset, whence)
+
+  def close(self):
+    self.f.close()
+
+#############
+# MATROSKA  #
+#############
+
+def _vint(f, keep_marker):
+  # EBML variable length integer: IDs keep the length marker, sizes don't.
+  # Returns (value, length in bytes), value None for an unknown size.
+  first = f.read(1)
+  if not first:
+    raise ChapterError("unexpected end of file")
+  first = ord(first)
+  length = 1
+  mask = 0x80
+  while length <= 8 and not first & mask:
+    mask >>= 1
+    length += 1
+  if length > 8:
+    raise ChapterError("invalid EBML number")
+  value = first if keep_marker else first & (mask - 1)
+  rest = f.read(length - 1)
+  if len(rest) != length - 1:
+    raise ChapterError("unexpected end of file")
+  for c in bytearray(rest):
+    value = (value << 8) | c
+  if not keep_marker and value == (1 << (7 * length)) - 1:
+    value = None
+  return value, length
+
+def _element(f):
+  # (id, data size, header length) of the element at the current position
+  element_id, id_length = _vint(f, True)
+  size, size_length = _vint(f, False)
+  return element_id, size, id_length + size_length
+
+def _children(data, offset=0, end=None):
+  # (id, data offset, data size) of the elements inside an already read buffer
+  end = len(data) if end is None else end
+  while offset < end:
+    buf = _Buffer(data, offset)
+    element_id, size, header = _element(buf)
+    if size is None or offset + header + size > end:
+      raise ChapterError("element runs past its parent")
+    yield element_id, offset + header, size
+    offset += header + size
+
+class _Buffer:
+  # read() over a bytes buffer so _element works on files and buffers alike
+  def __init__(self, data, offset):
+    self.data = data
+    self.offset = offset
+
+  def read(self, size):
+    chunk = self.data[self.offset:self.offset + size]
+    self.offset += len(chunk)
+    return chunk
+
+def _uint(data, offset, size):
+  value = 0
+  for c in bytearray(data[offset:offset + size]):
+    value = (value << 8) | c
+  return value
+
+def _read(f, position, size):
+  if size is None or size > MAX_ELEMENT:
+    raise ChapterError("element too large")
+  f.seek(position)
+  data = f.read(size)
+  if len(data) != size:
+    raise ChapterError("unexpected end of file")
+  return data
+
+def read_mkv_chapters(f):
+  f.seek(0)
+  element_id, size, header = _element(f)
+  position = header + size # past the EBML header
+  f.seek(position)
+  element_id, size, header = _element(f)
+  if element_id != SEGMENT:
+    raise ChapterError("no Segment")
+  segment = position + header # SeekPositions count from here
+  segment_end = None if size is None else segment + size
+
+  found = _find_chapters(f, segment, segment_end)
+  if found is None:
+    return []
+  return _parse_chapters(_read(f, found[0], found[1]))
+
+def _find_chapters(f, segment, segment_end):
+  # (position, size) of the Chapters element, looked up in the SeekHead, or
+  # by walking the top level elements (headers only) when it isn't listed
+  position = segment
+  seen = set()
+  for i in range(MAX_SCAN):
+    if segment_end is not None and position >= segment_end:
+      break
+    f.seek(position)
+    try:
+      element_id, size, header = _element(f)
+    except ChapterError:
+      break # end of file
+    if element_id == CHAPTERS:
+      return position + header, size
+    if element_id == SEEKHEAD and position not in seen:
+      seen.add(position)
+      found = _seek_chapters(f, segment, _read(f, position + header, size), seen)
+      if found is not None:
+        return found
+    if size is None:
+      break # unknown size (a live stream cluster), nothing to skip to
+    position += header + size
+  return None
+
+def _seek_chapters(f, segment, seekhead, seen):
+  for element_id, offset, size in _children(seekhead):
+    if element_id != SEEK:
+      continue
+    target = position = None
+    for child_id, child_offset, child_size in _children(seekhead, offset, offset + size):
+      if child_id == SEEKID:
+        target = _uint(seekhead, child_offset, child_size)
+      elif child_id == SEEKPOSITION:
+        position = segment + _uint(seekhead, child_offset, child_size)
+    if position is None or target not in (CHAPTERS, SEEKHEAD) or position in seen:
+      continue
+    f.seek(position)
+    found_id, found_size, header = _element(f)
+    if found_id != target:
+      continue # stale SeekHead
+    if target == CHAPTERS:
+      return position + header, found_size
+    seen.add(position) # a second SeekHead, usually at the end of the file
+    found = _seek_chapters(f, segment, _read(f, position + header, found_size), seen)
+    if found is not None:
+      return found
+  return None
+
+def _parse_chapters(data):
+  # starts of the top level chapters of the default edition (or the first
+  # visible one), hidden and disabled chapters left out
+  editions = []
+  for element_id, offset, size in _children(data):
+    if element_id != EDITIONENTRY:
+      continue
+    default = hidden = False
+    starts = []
+    for child_id, child_offset, child_size in _children(data, offset, offset + size):
+      if child_id == EDITIONFLAGDEFAULT:
+        default = _uint(data, child_offset, child_size) == 1
+      elif child_id == EDITIONFLAGHIDDEN:
+        hidden = _uint(data, child_offset, child_size) == 1
+      elif child_id == CHAPTERATOM:
+        start = None
+        visible = True
+        for atom_id, atom_offset, atom_size in _children(data, child_offset, child_offset + child_size):
+          if atom_id == CHAPTERTIMESTART:
+            start = _uint(data, atom_offset, atom_size) / 1000000000.0
+          elif atom_id == CHAPTERFLAGHIDDEN and _uint(data, atom_offset, atom_size) == 1:
+            visible = False
+          elif atom_id == CHAPTERFLAGENABLED and _uint(data, atom_offset, atom_size) == 0:
+            visible = False
+        if start is not None and visible:
+          starts.append(start)
+    editions.append((default, hidden, sorted(starts)))
+
+  for default, hidden, starts in editions:
+    if default:
+      return starts
+  for default, hidden, starts in editions:
+    if not hidden:
+      return starts
+  return []
+
+#######
+# MP4 #
+#######
+
+def _atoms(f, start, end):
+  # (type, payload position, payload size) of the atoms from start to end,
+  # only the headers are read. size None means up to the end of the file.
+  position = start
+  while end is None or position + 8 <= end:
+    f.seek(position)
+    header = f.read(8)
+    if len(header) < 8:
+      return
+    size, kind = struct.unpack(">I4s", header)
+    header_size = 8
+    if size == 1:
+      large = f.read(8)
+      if len(large) < 8:
+        return
+      size = struct.unpack(">Q", large)[0]
+      header_size = 16
+    elif size == 0:
+      if end is None:
+        yield kind, position + 8, None
+        return
+      size = end - position
+    if size < header_size:
+      raise ChapterError("bad atom size")
+    yield kind, position + header_size, size - header_size
+    position += size
+
+def read_mp4_chapters(f):
+  moov = None
+  for kind, position, size in _atoms(f, 0, None):
+    if kind == b"moov":
+      moov = position, size
+      break
+  if moov is None or moov[1] is None:
+    raise ChapterError("no moov atom")
+
+  nero = None
+  tracks = {}
+  chapter_tracks = []
+  for kind, position, size in _atoms(f, moov[0], moov[0] + moov[1]):
+    if kind == b"udta":
+      for child, child_position, child_size in _atoms(f, position, position + size):
+        if child == b"chpl":
+          nero = _parse_chpl(_read(f, child_position, child_size))
+    elif kind == b"trak":
+      track = _parse_trak(f, position, position + size)
+      tracks[track["id"]] = track
+      chapter_tracks.extend(track["chap"])
+
+  if nero:
+    return nero
+  for track_id in chapter_tracks:
+    track = tracks.get(track_id)
+    if track is not None and track["timescale"] and track["stts"] is not None:
+      return _sample_starts(_read(f, *track["stts"]), track["timescale"])
+  return []
+
+def _parse_chpl(data):
+  # Nero chapters: version, flags, (reserved), count, then per chapter a 64 bit
+  # start in 100ns units and a length prefixed title
+  version = bytearray(data[0:1])[0]
+  offset = 8 if version else 4
+  count = bytearray(data[offset:offset + 1])[0]
+  offset += 1
+  starts = []
+  for i in range(count):
+    if offset + 9 > len(data):
+      break
+    start, length = struct.unpack(">QB", data[offset:offset + 9])
+    starts.append(start / 10000000.0)
+    offset += 9 + length
+  return sorted(starts)
+
+def _parse_trak(f, start, end):
+  # track id, the tracks its tref/chap points to, the media timescale and
+  # where its stts (sample durations) is; the sample table itself isn't read
+  track = {"id": None, "chap": [], "timescale": None, "stts": None}
+  def walk(start, end):
+    for kind, position, size in _atoms(f, start, end):
+      if kind == b"tkhd":
+        data = _read(f, position, min(size, 24))
+        version = bytearray(data[0:1])[0]
+        track["id"] = struct.unpack(">I", data[20:24] if version else data[12:16])[0]
+      elif kind == b"mdhd":
+        data = _read(f, position, min(size, 24))
+        version = bytearray(data[0:1])[0]
+        track["timescale"] = struct.unpack(">I", data[20:24] if version else data[12:16])[0]
+      elif kind == b"chap":
+        data = _read(f, position, size)
+        track["chap"] = list(struct.unpack(">%dI" % (len(data) // 4), data[:len(data) // 4 * 4]))
+      elif kind == b"stts":
+        track["stts"] = (position, size)
+      elif kind in MP4_CONTAINERS:
+        walk(position, position + size)
+  walk(start, end)
+  return track
+
+def _sample_starts(data, timescale):
+  # start of every sample of the chapter text track, one sample per chapter
+  count = struct.unpack(">I", data[4:8])[0]
+  starts = []
+  t = 0
+  for i in range(min(count, (len(data) - 8) // 8)):
+    samples, delta = struct.unpack(">II", data[8 + i * 8:16 + i * 8])
+    for j in range(min(samples, 10000)):
+      starts.append(t / float(timescale))
+      t += delta
+  return starts
+
+def media_chapters(path):
+  f = open_media(path)
+  try:
+    return read_chapters(f)
+  finally:
+    f.close()
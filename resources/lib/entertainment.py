@@ -0,0 +1,149 @@
+import socket
+import struct
+import threading
+import time
+import colorsys
+import binascii
+
+#########################
+# HUE ENTERTAINMENT API #
+#########################
+
+# One datagram per frame carries the colors of every light in the
+# entertainment group:
+#   "HueStream", version 1.0, sequence, 2 reserved, color space, 1 reserved
+# followed by 9 bytes per light:
+#   device type (0 = light), light id, three 16 bit channels (RGB or XY+bri)
+
+PROTOCOL = b"HueStream"
+PORT = 2100
+HEADER = struct.Struct(">9sBBBHBB")
+LIGHT = struct.Struct(">BHHHH")
+COLORSPACE_RGB = 0x00
+COLORSPACE_XY = 0x01
+DEVICE_LIGHT = 0x00
+CIPHER = "TLS-PSK-WITH-AES-128-GCM-SHA256"
+
+class DTLSUnavailable(Exception):
+  pass
+
+def encode_frame(sequence, lights, colorspace=COLORSPACE_RGB):
+  # lights is a list of (light_id, a, b, c) with 16 bit channel values
+  parts = [HEADER.pack(PROTOCOL, 1, 0, sequence & 0xff, 0, colorspace, 0)]
+  for light_id, a, b, c in lights:
+    parts.append(LIGHT.pack(DEVICE_LIGHT, int(light_id), a, b, c))
+  return b"".join(parts)
+
+def decode_frame(data):
+  # inverse of encode_frame: (sequence, colorspace, [(light_id, a, b, c)])
+  if len(data) < HEADER.size or (len(data) - HEADER.size) % LIGHT.size:
+    raise ValueError("bad frame length %d" % len(data))
+  protocol, major, minor, sequence, reserved, colorspace, reserved2 = HEADER.unpack_from(data)
+  if protocol != PROTOCOL or major != 1:
+    raise ValueError("not a HueStream v1 frame")
+  lights = []
+  for offset in range(HEADER.size, len(data), LIGHT.size):
+    device, light_id, a, b, c = LIGHT.unpack_from(data, offset)
+    lights.append((light_id, a, b, c))
+  return sequence, colorspace, lights
+
+def hsv_to_channels(hue, sat, bri):
+  # bridge scale (hue 0-65535, sat/bri 0-255) to 16 bit RGB
+  r, g, b = colorsys.hsv_to_rgb(hue / 65535.0, sat / 255.0, bri / 255.0)
+  return int(r * 65535), int(g * 65535), int(b * 65535)
+
+class UDPTransport:
+  # plain datagrams, only for a local stand-in (the bridge requires DTLS)
+  def __init__(self, host, port=PORT):
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sock.connect((host, port))
+
+  def send(self, data):
+    self.sock.send(data)
+
+  def close(self):
+    self.sock.close()
+
+def check_dtls(clientkey):
+  # raises DTLSUnavailable when a session can't even be tried, before the
+  # bridge is asked to stream
+  if not clientkey:
+    raise DTLSUnavailable("no client key, register with the bridge again")
+  try:
+    from mbedtls import tls
+  except ImportError:
+    raise DTLSUnavailable("no DTLS implementation (python-mbedtls) available")
+
+class DTLSTransport:
+  # DTLS 1.2 with the client key from registration as pre-shared key
+  def __init__(self, host, username, clientkey, port=PORT):
+    check_dtls(clientkey)
+    from mbedtls import tls
+
+    conf = tls.DTLSConfiguration(
+      pre_shared_key=(username, binascii.unhexlify(clientkey)),
+      ciphers=(CIPHER,),
+      validate_certificates=False)
+    self.sock = tls.ClientContext(conf).wrap_socket(
+      socket.socket(socket.AF_INET, socket.SOCK_DGRAM), server_hostname=None)
+    self.sock.connect((host, port))
+    self.sock.do_handshake()
+
+  def send(self, data):
+    self.sock.send(data)
+
+  def close(self):
+    self.sock.close()
+
+class EntertainmentStream(threading.Thread):
+  # Sends the latest color of every light in one datagram, rate times a second.
+  def __init__(self, transport, rate, logger, max_errors=25):
+    threading.Thread.__init__(self, name="KodiHueStream")
+    self.daemon = True
+    self.transport = transport
+    self.interval = 1.0 / rate
+    self.logger = logger
+    self.max_errors = max_errors
+    self.lock = threading.Lock()
+    self.colors = {}
+    self.sequence = 0
+    self.frames = 0
+    self.active = True
+
+  def update(self, light_id, hue, sat, bri):
+    channels = hsv_to_channels(hue, sat, bri)
+    with self.lock:
+      self.colors[int(light_id)] = channels
+
+  def frame(self):
+    with self.lock:
+      lights = [(light_id,) + c for light_id, c in sorted(self.colors.items())]
+    self.sequence = (self.sequence + 1) & 0xff
+    return encode_frame(self.sequence, lights)
+
+  def run(self):
+    errors = 0
+    deadline = time.time()
+    while self.active:
+      if self.colors:
+        try:
+          self.transport.send(self.frame())
+          self.frames += 1
+          errors = 0
+        except (socket.error, IOError) as e:
+          errors += 1
+          if errors >= self.max_errors:
+            self.logger.log("entertainment stream failed, falling back to REST: %s" % e)
+            self.active = False
+            break
+      deadline += self.interval
+      delay = deadline - time.time()
+      if delay > 0:
+        time.sleep(delay)
+      else:
+        deadline = time.time() # fell behind, don't try to catch up
+    self.transport.close()
+
+  def stop(self):
+    self.active = False
+    self.join(1)
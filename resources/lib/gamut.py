@@ -0,0 +1,142 @@
+import colorsys
+
+# color output setting values
+COLOR_OUTPUT_HS = 0
+COLOR_OUTPUT_XY = 1
+
+# Colour gamuts of the Hue lights as (red, green, blue) corners in CIE xy,
+# from the Philips Hue developer documentation.
+GAMUTS = {
+  "A": ((0.704, 0.296), (0.2151, 0.7106), (0.138, 0.08)),
+  "B": ((0.675, 0.322), (0.409, 0.518), (0.167, 0.04)),
+  "C": ((0.6915, 0.3083), (0.17, 0.7), (0.1532, 0.0475)),
+}
+
+# Model IDs for bridges that don't report capabilities yet (API < 1.22)
+MODEL_GAMUTS = {
+  "LST001": "A", "LLC005": "A", "LLC006": "A", "LLC007": "A", "LLC010": "A",
+  "LLC011": "A", "LLC012": "A", "LLC013": "A", "LLC014": "A", "LLC001": "A",
+  "LCT001": "B", "LCT002": "B", "LCT003": "B", "LCT007": "B", "LLM001": "B",
+  "LCT010": "C", "LCT011": "C", "LCT012": "C", "LCT014": "C", "LCT015": "C",
+  "LCT016": "C", "LLC020": "C", "LST002": "C",
+}
+# lights that show the whole hue circle without the hue corrections
+FULL_SPECTRUM_MODELS = set(["LST001", "LLC007"])
+
+# xy table resolution: hue steps around the circle and saturation steps
+HUE_STEPS = 512
+SAT_STEPS = 64
+
+class LightCapabilities:
+  # What a light can do, from its /lights entry: newer bridges list it under
+  # capabilities, older ones only give the model and the state.
+  def __init__(self, light_id, j):
+    self.light = light_id
+    self.modelid = j.get("modelid", "")
+    self.type = j.get("type", "")
+    state = j.get("state", {})
+    control = j.get("capabilities", {}).get("control", {})
+    self.color = "xy" in state or "hue" in state or "colorgamuttype" in control
+    self.ct = "ct" in state or "ct" in control
+    self.dimmable = "bri" in state
+    self.full_spectrum = self.modelid in FULL_SPECTRUM_MODELS
+    self.gamut = None
+    if self.color:
+      gamut = control.get("colorgamuttype", MODEL_GAMUTS.get(self.modelid))
+      if gamut in GAMUTS:
+        self.gamut = gamut
+      elif control.get("colorgamut"):
+        self.gamut = tuple(tuple(corner) for corner in control["colorgamut"])
+      else:
+        self.gamut = "C" # unknown colour light, let the bridge clip the rest
+
+  def __repr__(self):
+    return 'light: %s model: %s gamut: %s color: %s ct: %s dimmable: %s' % \
+      (self.light, self.modelid, self.gamut, self.color, self.ct, self.dimmable)
+
+def capability_index(lights):
+  # {light id: LightCapabilities} for a whole GET /lights answer
+  return dict((light_id, LightCapabilities(light_id, j)) for light_id, j in lights.items())
+
+#######
+# CIE #
+#######
+
+def _cross(p, q):
+  return p[0] * q[1] - p[1] * q[0]
+
+def _closest_on_segment(p, a, b):
+  ab = (b[0] - a[0], b[1] - a[1])
+  t = ((p[0] - a[0]) * ab[0] + (p[1] - a[1]) * ab[1]) / (ab[0] * ab[0] + ab[1] * ab[1])
+  t = min(max(t, 0.0), 1.0)
+  return a[0] + t * ab[0], a[1] + t * ab[1]
+
+def clip_to_gamut(xy, gamut):
+  # xy itself when the light can show it, otherwise the closest point it can
+  red, green, blue = gamut
+  inside = True
+  for a, b in ((red, green), (green, blue), (blue, red)):
+    if _cross((b[0] - a[0], b[1] - a[1]), (xy[0] - a[0], xy[1] - a[1])) < 0:
+      inside = False
+      break
+  if inside:
+    return xy
+  best = None
+  for a, b in ((red, green), (green, blue), (blue, red)):
+    point = _closest_on_segment(xy, a, b)
+    distance = (point[0] - xy[0]) ** 2 + (point[1] - xy[1]) ** 2
+    if best is None or distance < best[0]:
+      best = (distance, point)
+  return best[1]
+
+def rgb_to_xy(r, g, b):
+  # sRGB (0-1) to CIE xy, wide gamut D65 conversion as recommended for Hue
+  r, g, b = [((c + 0.055) / 1.055) ** 2.4 if c > 0.04045 else c / 12.92 for c in (r, g, b)]
+  X = r * 0.664511 + g * 0.154324 + b * 0.162028
+  Y = r * 0.283881 + g * 0.668433 + b * 0.047685
+  Z = r * 0.000088 + g * 0.072310 + b * 0.986039
+  total = X + Y + Z
+  if total == 0:
+    return 0.3227, 0.329 # black has no colour, use the white point
+  return X / total, Y / total
+
+class GamutTable:
+  # Hue API hue/sat to gamut clipped xy. Brightness doesn't change the
+  # chromaticity, so one table over quantised hue and saturation covers all
+  # colours; entries are worked out the first time they are needed and then
+  # just looked up.
+  def __init__(self, gamut):
+    self.gamut = GAMUTS.get(gamut, gamut)
+    self.table = [None] * (HUE_STEPS * SAT_STEPS)
+    self.area = abs(_cross((self.gamut[1][0] - self.gamut[0][0], self.gamut[1][1] - self.gamut[0][1]),
+      (self.gamut[2][0] - self.gamut[0][0], self.gamut[2][1] - self.gamut[0][1]))) / 2
+
+  def xy(self, hue, sat):
+    h = int(round(hue * HUE_STEPS / 65536.0)) % HUE_STEPS
+    s = min(int(round(sat * (SAT_STEPS - 1) / 255.0)), SAT_STEPS - 1)
+    xy = self.table[h * SAT_STEPS + s]
+    if xy is None:
+      xy = self._compute(h, s)
+    return xy
+
+  def _compute(self, h, s):
+    r, g, b = colorsys.hsv_to_rgb(h / float(HUE_STEPS), s / (SAT_STEPS - 1.0), 1.0)
+    x, y = clip_to_gamut(rgb_to_xy(r, g, b), self.gamut)
+    xy = self.table[h * SAT_STEPS + s] = [round(x, 4), round(y, 4)]
+    return xy
+
+  def fill(self):
+    # the whole table up front, e.g. for timing it
+    for h in range(HUE_STEPS):
+      for s in range(SAT_STEPS):
+        self._compute(h, s)
+
+_tables = {}
+
+def gamut_table(gamut):
+  # one shared table per gamut
+  key = gamut if gamut in GAMUTS else repr(gamut)
+  table = _tables.get(key)
+  if table is None:
+    table = _tables[key] = GamutTable(gamut)
+  return table
@@ -1,16 +1,32 @@
-import xbmc
 import socket
 import json
 import time
 import logging
+import threading
 
 from tools import *
+from entertainment import *
+from instrument import *
+from gamut import *
+
+if not NOSE:
+  import xbmc
 
 try:
   import requests
 except ImportError:
   notify("Kodi Hue", "ERROR: Could not import Python requests")
 
+# seconds to connect / to wait for an answer, a bridge that stops
+# answering must not hang the ambilight loop
+TIMEOUT = (2, 5)
+
+PRIORITY_STATE = 0     # dim/undim/flash/credits transitions
+PRIORITY_AMBILIGHT = 1 # ambilight frame updates
+
+# bridge 1 is bridge_ip/bridge_user/..., the others bridge2_ip/bridge2_user/...
+BRIDGES = (1, 2, 3)
+
 class Hue:
   params = None
   connected = None
@@ -18,6 +34,9 @@ class Hue:
   light = None
   ambilight_dim_light = None
   pauseafterrefreshchange = 0
+  stream = None
+  built = {} # (role, kind, bridge, id) -> the Light or Group in use
+  reload_lock = threading.Lock() # one settings reload at a time
 
   def __init__(self, settings, args):
     #Logs are good, mkay.
@@ -34,22 +53,29 @@ class Hue:
       self.update_settings()
 
     if self.params == {}:
-      self.logger.debuglog("params: %s" % self.params)
+      self.logger.debuglog("params: %s", self.params)
       #if there's a bridge IP, try to talk to it.
       if self.settings.bridge_ip not in ["-", "", None]:
         result = self.test_connection()
         if result:
           self.update_settings()
     elif self.params['action'] == "discover":
-      self.logger.debuglog("Starting discovery")
+      bridge = int(self.params.get("bridge", 1))
+      self.logger.debuglog("Starting discovery of bridge %s", bridge)
       notify("Bridge Discovery", "starting")
-      hue_ip = self.start_autodiscover()
+      # the other bridges are configured already, look for a new one
+      known = [BridgeSettings(self.settings, b).bridge_ip for b in configured_bridges(self.settings) if b != bridge]
+      hue_ip = self.start_autodiscover(known)
       if hue_ip != None:
         notify("Bridge Discovery", "Found bridge at: %s" % hue_ip)
-        username = self.register_user(hue_ip)
+        username, clientkey = self.register_user(hue_ip)
         self.logger.debuglog("Updating settings")
-        self.settings.update(bridge_ip = hue_ip)
-        self.settings.update(bridge_user = username)
+        prefix = bridge_prefix(bridge)
+        if bridge != 1:
+          self.settings.update(**{prefix: "true"})
+        self.settings.update(**{prefix + "_ip": hue_ip})
+        self.settings.update(**{prefix + "_user": username})
+        self.settings.update(**{prefix + "_clientkey": clientkey})
         notify("Bridge Discovery", "Finished")
         self.test_connection()
         self.update_settings()
@@ -64,7 +90,7 @@ class Hue:
       #__addon__.openSettings()
     else:
       # not yet implemented
-      self.logger.debuglog("unimplemented action call: %s" % self.params['action'])
+      self.logger.debuglog("unimplemented action call: %s", self.params['action'])
 
     #detect pause for refresh change (must reboot for this to take effect.)
     response = json.loads(xbmc.executeJSONRPC('{"jsonrpc":"2.0","method":"Settings.GetSettingValue", "params":{"setting":"videoplayer.pauseafterrefreshchange"},"id":1}'))
@@ -76,7 +102,7 @@ class Hue:
       if self.settings.misc_initialflash:
         self.flash_lights()
 
-  def start_autodiscover(self):
+  def start_autodiscover(self, known=()):
     port = 1900
     ip = "239.255.255.250"
 
@@ -100,15 +126,17 @@ class Hue:
         recv_data, addr = client_socket.recvfrom(2048)
         self.logger.debuglog("received data during autodiscovery: "+recv_data)
         if "IpBridge" in recv_data and "description.xml" in recv_data:
-          hue_ip = recv_data.split("LOCATION: http://")[1].split(":")[0]
+          found = recv_data.split("LOCATION: http://")[1].split(":")[0]
+          if found not in known:
+            hue_ip = found
         time.sleep(1)
       except socket.timeout:
         break #if the socket times out once, its probably not going to complete at all. fallback to nupnp.
 
     if hue_ip == None:
       #still nothing found, try alternate api
-      r=requests.get("https://www.meethue.com/api/nupnp", verify=False) #verify false hack until meethue fixes their ssl cert.
-      j=r.json()
+      r=requests.get("https://www.meethue.com/api/nupnp", verify=False, timeout=TIMEOUT) #verify false hack until meethue fixes their ssl cert.
+      j=[b for b in r.json() if b["internalipaddress"] not in known]
       if len(j) > 0:
         hue_ip=j[0]["internalipaddress"]
         self.logger.debuglog("meethue nupnp api returned: "+hue_ip)
@@ -119,36 +147,33 @@ class Hue:
 
   def register_user(self, hue_ip):
     device = "kodi-hue-addon"
-    data = '{"devicetype": "%s#%s"}' % (device, xbmc.getInfoLabel('System.FriendlyName')[0:19])
-    self.logger.debuglog("sending data: %s" % data)
+    data = '{"devicetype": "%s#%s", "generateclientkey": true}' % (device, xbmc.getInfoLabel('System.FriendlyName')[0:19])
+    self.logger.debuglog("sending data: %s", data)
 
-    r = requests.post('http://%s/api' % hue_ip, data=data)
+    session = get_session(hue_ip)
+    r = session.post('http://%s/api' % hue_ip, data=data)
     response = r.text
     while "link button not pressed" in response:
-      self.logger.debuglog("register user response: %s" % r)
+      self.logger.debuglog("register user response: %s", r)
       notify("Bridge Discovery", "Press link button on bridge")
-      r = requests.post('http://%s/api' % hue_ip, data=data)
+      r = session.post('http://%s/api' % hue_ip, data=data)
       response = r.text 
       time.sleep(3)
 
     j = r.json()
-    self.logger.debuglog("got a username response: %s" % j)
+    self.logger.debuglog("got a username response: %s", j)
     username = j[0]["success"]["username"]
+    # only bridges with the entertainment api hand out a client key
+    clientkey = j[0]["success"].get("clientkey", "")
 
-    return username
+    return username, clientkey
 
   def flash_lights(self):
     self.logger.debuglog("class Hue: flashing lights")
-    if self.settings.light == 0:
-      self.light.flash_light()
-    else:
-      self.light[0].flash_light()
-      if self.settings.light > 1:
-        xbmc.sleep(1)
-        self.light[1].flash_light()
-      if self.settings.light > 2:
+    for i, l in enumerate(each_light(self.light)):
+      if i > 0:
         xbmc.sleep(1)
-        self.light[2].flash_light()
+      l.flash_light()
     
   def _parse_argv(self, args):
     try:
@@ -158,9 +183,13 @@ class Hue:
 
   def test_connection(self):
     self.logger.debuglog("testing connection")
-    r = requests.get('http://%s/api/%s/config' % \
-      (self.settings.bridge_ip, self.settings.bridge_user))
-    test_connection = r.text.find("name")
+    try:
+      r = get_session(self.settings.bridge_ip).get('http://%s/api/%s/config' % \
+        (self.settings.bridge_ip, self.settings.bridge_user))
+      test_connection = r.text.find("name")
+    except Exception as e:
+      self.logger.debuglog("test connection failed: %s", e)
+      test_connection = False
     if not test_connection:
       notify("Failed", "Could not connect to bridge")
       self.connected = False
@@ -198,92 +227,302 @@ class Hue:
   def dim_lights(self):
     self.logger.debuglog("class Hue: dim lights")
     self.last_state = "dimmed"
-    if self.settings.light == 0:
-      self.light.dim_light()
-    else:
-      self.light[0].dim_light()
-      if self.settings.light > 1:
+    for i, l in enumerate(each_light(self.light)):
+      if i > 0:
         xbmc.sleep(1)
-        self.light[1].dim_light()
-      if self.settings.light > 2:
-        xbmc.sleep(1)
-        self.light[2].dim_light()
+      l.dim_light()
         
   def brighter_lights(self):
     self.logger.debuglog("class Hue: brighter lights")
     self.last_state = "brighter"
-    if self.settings.light == 0:
-      self.light.brighter_light()
-    else:
-      self.light[0].brighter_light()
-      if self.settings.light > 1:
+    for i, l in enumerate(each_light(self.light)):
+      if i > 0:
         xbmc.sleep(1)
-        self.light[1].brighter_light()
-      if self.settings.light > 2:
-        xbmc.sleep(1)
-        self.light[2].brighter_light()
+      l.brighter_light()
 
   def partial_lights(self):
     self.logger.debuglog("class Hue: partial lights")
     self.last_state = "partial"
-    if self.settings.light == 0:
-      self.light.partial_light()
-    else:
-      self.light[0].partial_light()
-      if self.settings.light > 1:
-        xbmc.sleep(1)
-        self.light[1].partial_light()
-      if self.settings.light > 2:
+    for i, l in enumerate(each_light(self.light)):
+      if i > 0:
         xbmc.sleep(1)
-        self.light[2].partial_light()
+      l.partial_light()
+
+  def start_stream(self):
+    # Entertainment streaming for ambilight, falls back to REST (stream stays None)
+    if self.settings.output != 1 or self.stream is not None:
+      return
+    self.logger.debuglog("class Hue: starting entertainment stream on group %s", self.settings.entertainment_group_id)
+    try:
+      check_dtls(self.settings.bridge_clientkey) # the usual case in Kodi, don't touch the group
+      r = self.stream_put(True)
+      try:
+        if "error" in r.text:
+          raise DTLSUnavailable("bridge refused to stream: %s" % r.text)
+        transport = DTLSTransport(self.settings.bridge_ip, self.settings.bridge_user, self.settings.bridge_clientkey)
+      except Exception:
+        self.deactivate_stream() # or the group stays in streaming mode and fights REST
+        raise
+    except Exception as e:
+      self.logger.log("entertainment streaming unavailable, using REST: %s" % e)
+      notify("Kodi Hue", "Streaming unavailable, using REST")
+      return
+    self.stream = EntertainmentStream(transport, self.settings.stream_rate, self.logger)
+    self.stream.start()
+
+  def stream_put(self, active):
+    return get_session(self.settings.bridge_ip).put("http://%s/api/%s/groups/%s" % \
+      (self.settings.bridge_ip, self.settings.bridge_user, self.settings.entertainment_group_id),
+      data='{"stream": {"active": %s}}' % ("true" if active else "false"))
+
+  def deactivate_stream(self):
+    try:
+      self.stream_put(False)
+    except Exception:
+      self.logger.debuglog("WARNING: could not deactivate stream")
+
+  def stop_stream(self):
+    if self.stream is None:
+      return
+    self.logger.debuglog("class Hue: stopping entertainment stream, %s frames sent", self.stream.frames)
+    self.stream.stop()
+    self.stream = None
+    self.deactivate_stream()
+
+  def get_snapshots(self, bridges=None):
+    # state of every light and group in two requests per bridge:
+    # {bridge ip: BridgeSnapshot, or None if that failed}
+    snapshots = {}
+    for bridge in bridges or configured_bridges(self.settings):
+      settings = BridgeSettings(self.settings, bridge)
+      try:
+        snapshots[settings.bridge_ip] = BridgeSnapshot(settings.bridge_ip, settings.bridge_user)
+      except Exception as e:
+        self.logger.debuglog("WARNING: bulk state request to bridge %s failed, falling back to single requests: %s", bridge, e)
+        snapshots[settings.bridge_ip] = None
+    return snapshots
 
   def update_settings(self):
     self.logger.debuglog("class Hue: update settings")
     self.logger.debuglog(self.settings)
-    if self.settings.light == 0:
-      self.logger.debuglog("creating Group instance")
-      self.light = Group(self.settings)
-    elif self.settings.light > 0:
-      self.logger.debuglog("creating Light instances")
-      self.light = [None] * self.settings.light
-      self.light[0] = Light(self.settings.light1_id, self.settings)
-      if self.settings.light > 1:
-        xbmc.sleep(1)
-        self.light[1] = Light(self.settings.light2_id, self.settings)
-      if self.settings.light > 2:
-        xbmc.sleep(1)
-        self.light[2] = Light(self.settings.light3_id, self.settings)
-    #ambilight dim
-    if self.settings.ambilight_dim:
-      if self.settings.ambilight_dim_light == 0:
-        self.logger.debuglog("creating Group instance for ambilight dim")
-        self.ambilight_dim_light = Group(self.settings, self.settings.ambilight_dim_group_id)
-      elif self.settings.ambilight_dim_light > 0:
-        self.logger.debuglog("creating Light instances for ambilight dim")
-        self.ambilight_dim_light = [None] * self.settings.ambilight_dim_light
-        self.ambilight_dim_light[0] = Light(self.settings.ambilight_dim_light1_id, self.settings)
-        if self.settings.ambilight_dim_light > 1:
-          xbmc.sleep(1)
-          self.ambilight_dim_light[1] = Light(self.settings.ambilight_dim_light2_id, self.settings)
-        if self.settings.ambilight_dim_light > 2:
-          xbmc.sleep(1)
-          self.ambilight_dim_light[2] = Light(self.settings.ambilight_dim_light3_id, self.settings)
+    with self.reload_lock:
+      light_keys, dim_keys = light_plan(self.settings), dim_plan(self.settings)
+      built = self._build(self.settings, light_keys + dim_keys, {})
+      self._swap(light_keys, dim_keys, built)
+
+  def reload_settings(self, settings):
+    # Settings read again after a change. Lights and groups that are still
+    # configured are patched in place (dim times, overrides, colour output)
+    # and the new settings are in use right away; lights or groups that are
+    # new need the bridge, they are set up in a background thread and
+    # swapped in all together once they're ready. Returns that thread, or
+    # None when there was nothing to set up.
+    changed = settings.changes(self.settings)
+    self.logger.debuglog("settings changed: %s", ", ".join(sorted(changed)))
+    with self.reload_lock:
+      # a bridge with another address or user starts from scratch
+      moved = [b for b in BRIDGES if changed.intersection(bridge_setting_names(b))]
+      existing = dict((key, l) for key, l in self.built.items() if key[2] not in moved)
+      for bridge in configured_bridges(settings):
+        if bridge not in moved:
+          get_scheduler(BridgeSettings(settings, bridge)) # rate limits and workers
+      for l in existing.values():
+        l.configure(settings)
+      self.settings = settings
+      light_keys, dim_keys = light_plan(settings), dim_plan(settings)
+      missing = [key for key in light_keys + dim_keys if key not in existing]
+      if not missing:
+        self._swap(light_keys, dim_keys, existing)
+        return None
+    self.logger.debuglog("setting up %s in the background", missing)
+    thread = threading.Thread(target=self._rebuild, args=(settings, light_keys, dim_keys, existing), name="KodiHueReload")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+  def _rebuild(self, settings, light_keys, dim_keys, existing):
+    try:
+      built = self._build(settings, light_keys + dim_keys, existing)
+    except Exception as e:
+      self.logger.log("WARNING: lights not set up again, keeping the old ones: %s" % e)
+      return
+    with self.reload_lock:
+      if self.settings is not settings:
+        return # another change came in meanwhile, that reload swaps
+      self._swap(light_keys, dim_keys, built)
+
+  def _build(self, settings, keys, existing):
+    built = dict(existing)
+    missing = [key for key in keys if key not in built]
+    # one snapshot for each bridge that has something to set up
+    snapshots = self.get_snapshots(sorted(set(key[2] for key in missing)))
+    for key in missing:
+      role, kind, bridge, id = key
+      self.logger.debuglog("creating %s instance %s on bridge %s for %s", kind, id, bridge, role)
+      bridge_settings = BridgeSettings(settings, bridge)
+      snapshot = snapshots.get(bridge_settings.bridge_ip)
+      if kind == "group":
+        built[key] = Group(bridge_settings, id, snapshot)
+      else:
+        built[key] = Light(id, bridge_settings, snapshot)
+    return built
+
+  def _swap(self, light_keys, dim_keys, built):
+    # readers see either the old or the new lights, never a half built list
+    light = as_lights([built[key] for key in light_keys], light_keys)
+    dim = as_lights([built[key] for key in dim_keys], dim_keys)
+    self.light, self.ambilight_dim_light = light, dim
+    self.built = dict((key, built[key]) for key in light_keys + dim_keys)
+
+def as_lights(objects, keys):
+  # what Hue.light holds: a list of Lights, a Group, Groups on several
+  # bridges, or None
+  if not keys:
+    return None
+  if keys[0][1] != "group":
+    return objects
+  if len(objects) == 1:
+    return objects[0]
+  return Groups(objects)
+
+def light_plan(settings):
+  # (role, "light" or "group", bridge, id) for each entry of Hue.light
+  bridges = configured_bridges(settings)
+  if settings.light == 0:
+    # in a room split across bridges there is a group on each of them
+    return [("ambilight", "group", b, settings.group_id if b == 1 else getattr(settings, "bridge%d_group_id" % b))
+      for b in bridges]
+  ids = [settings.light1_id, settings.light2_id, settings.light3_id]
+  on = [settings.light1_bridge, settings.light2_bridge, settings.light3_bridge]
+  return [("ambilight", "light", b if b in bridges else 1, id) for id, b in list(zip(ids, on))[:settings.light]]
+
+def dim_plan(settings):
+  # the same for Hue.ambilight_dim_light, those are on bridge 1
+  if not settings.ambilight_dim:
+    return []
+  if settings.ambilight_dim_light == 0:
+    return [("dim", "group", 1, settings.ambilight_dim_group_id)]
+  ids = [settings.ambilight_dim_light1_id, settings.ambilight_dim_light2_id, settings.ambilight_dim_light3_id]
+  return [("dim", "light", 1, id) for id in ids[:settings.ambilight_dim_light]]
+
+def bridge_prefix(bridge):
+  return "bridge" if bridge == 1 else "bridge%d" % bridge
+
+def bridge_setting_names(bridge):
+  # a change to these means the lights of the bridge are set up again
+  prefix = bridge_prefix(bridge)
+  names = set([prefix + "_ip", prefix + "_user"])
+  if bridge != 1:
+    names.add(prefix) # enabled
+  return names
+
+def configured_bridges(settings):
+  # bridge 1 always, the others when they are enabled and have an address
+  bridges = [1]
+  for bridge in BRIDGES[1:]:
+    prefix = bridge_prefix(bridge)
+    if getattr(settings, prefix, False) and getattr(settings, prefix + "_ip", "") not in ["-", "", None]:
+      bridges.append(bridge)
+  return bridges
+
+class BridgeSettings:
+  # The settings as the lights of one bridge see them: that bridge's
+  # address, user, client key and rate budget as bridge_ip, bridge_user,
+  # bridge_clientkey and bridge_rate, everything else shared.
+  def __init__(self, settings, bridge=1):
+    self.settings = settings
+    self.bridge = bridge
+    prefix = bridge_prefix(bridge)
+    self.bridge_ip = getattr(settings, prefix + "_ip")
+    self.bridge_user = getattr(settings, prefix + "_user")
+    self.bridge_clientkey = getattr(settings, prefix + "_clientkey", "")
+    self.bridge_rate = getattr(settings, prefix + "_rate")
+
+  def __getattr__(self, name):
+    return getattr(self.settings, name)
+
+def snapshot_for(snapshot, bridge_ip):
+  # a BridgeSnapshot or {bridge ip: BridgeSnapshot}, narrowed to one bridge
+  if isinstance(snapshot, dict):
+    return snapshot.get(bridge_ip)
+  if snapshot is not None and snapshot.bridge_ip != bridge_ip:
+    return None # another bridge's ids
+  return snapshot
+
+def each_light(lights):
+  # a Group, a list of Lights or nothing, as a list
+  if lights is None:
+    return []
+  if isinstance(lights, list):
+    return lights
+  return [lights]
+
+class BridgeSnapshot:
+  # One GET /lights and one GET /groups, so lights and groups can be set up
+  # without a request each. Lookups answer like the bridge would for a single
+  # light or group, including the "not found" error.
+  def __init__(self, bridge_ip, bridge_user):
+    self.bridge_ip = bridge_ip
+    self.session = get_session(bridge_ip)
+    self.lights = self._get("http://%s/api/%s/lights" % (bridge_ip, bridge_user))
+    self.groups = self._get("http://%s/api/%s/groups" % (bridge_ip, bridge_user))
+    self.capabilities = capability_index(self.lights)
+
+  def _get(self, url):
+    j = self.session.get(url).json()
+    if isinstance(j, list) and len(j) > 0 and "error" in j[0]:
+      raise ValueError("Bridge Error", j[0]["error"]["type"], j[0]["error"])
+    return j
+
+  def _not_found(self, resource, id):
+    return [{"error": {"type": 3, "address": "/%s/%s" % (resource, id),
+      "description": "resource, /%s/%s, not available" % (resource, id)}}]
+
+  def light(self, light_id):
+    return self.lights.get(str(light_id), self._not_found("lights", light_id))
+
+  def group(self, group_id):
+    # group 0 (all lights) is not part of /groups, None means ask the bridge
+    if int(group_id) == 0:
+      return None
+    return self.groups.get(str(group_id), self._not_found("groups", group_id))
+
+  def group_lights(self, group_id):
+    if int(group_id) == 0:
+      return sorted(self.lights.keys(), key=int)
+    return self.groups.get(str(group_id), {}).get("lights", [])
 
 class Light:
   start_setting = None
   group = False
   livingwhite = False
   fullSpectrum = False
+  capabilities = None
+  gamut = None # GamutTable when colours go out as xy
 
-  def __init__(self, light_id, settings):
+  def __init__(self, light_id, settings, snapshot=None):
     self.logger = Logger()
     if settings.debug:
       self.logger.debug()
 
     self.bridge_ip    = settings.bridge_ip
     self.bridge_user  = settings.bridge_user
-    self.mode         = settings.mode
     self.light        = light_id
+    self.configure(settings)
+
+    self.onLast = True
+    self.hueLast = 0
+    self.satLast = 0
+    self.valLast = 0
+    self.xyLast = None
+
+    self.session = get_session(self.bridge_ip)
+    self.get_current_setting(snapshot)
+    self.scheduler = get_scheduler(settings)
+
+  def configure(self, settings):
+    # everything that can change without asking the bridge again
+    self.mode         = settings.mode
     self.dim_time     = settings.dim_time
     self.proportional_dim_time = settings.proportional_dim_time
     self.override_hue = settings.override_hue
@@ -299,30 +538,33 @@ class Light:
     self.override_undim_bri = settings.override_undim_bri
     self.force_light_on = settings.force_light_on
     self.force_light_group_start_override = settings.force_light_group_start_override
-
-    self.onLast = True
-    self.hueLast = 0
-    self.satLast = 0
-    self.valLast = 0
-
-    self.get_current_setting()
-    self.s = requests.Session()
+    self.xy_output    = settings.color_output == COLOR_OUTPUT_XY
+    if self.start_setting is not None: # set up already
+      self.gamut = None
+      if self.xy_output and self.capabilities is not None and self.capabilities.gamut is not None:
+        self.gamut = gamut_table(self.capabilities.gamut)
+      self.xyLast = None
 
   def request_url_put(self, url, data):
     #if self.start_setting['on']: #Why? 
     try:
-      response = self.s.put(url, data=data)
-      self.logger.debuglog("response: %s" % response)
+      response = self.session.put(url, data=data)
+      self.logger.debuglog("response: %s", response)
     except:
       self.logger.debuglog("exception in request_url_put")
+      trace.add("error", url, data)
       pass # probably a timeout
 
-  def get_current_setting(self):
-    self.logger.debuglog("get_current_setting. requesting from: http://%s/api/%s/lights/%s" % \
-      (self.bridge_ip, self.bridge_user, self.light))
-    r = requests.get("http://%s/api/%s/lights/%s" % \
-      (self.bridge_ip, self.bridge_user, self.light))
-    j = r.json()
+  def get_current_setting(self, snapshot=None):
+    snapshot = snapshot_for(snapshot, self.bridge_ip)
+    if snapshot is not None:
+      j = snapshot.light(self.light)
+    else:
+      self.logger.debuglog("get_current_setting. requesting from: http://%s/api/%s/lights/%s",
+        self.bridge_ip, self.bridge_user, self.light)
+      r = self.session.get("http://%s/api/%s/lights/%s" % \
+        (self.bridge_ip, self.bridge_user, self.light))
+      j = r.json()
 
     if isinstance(j, list) and "error" in j[0]:
       # something went wrong.
@@ -342,9 +584,15 @@ class Light:
     self.start_setting['bri'] = state['bri']
     self.onLast = state['on']
     self.valLast = state['bri']
-    
-    modelid = j['modelid']
-    self.fullSpectrum = ((modelid == 'LST001') or (modelid == 'LLC007'))
+
+    if snapshot is not None:
+      self.capabilities = snapshot.capabilities.get(str(self.light))
+    if self.capabilities is None:
+      self.capabilities = LightCapabilities(self.light, j)
+    self.fullSpectrum = self.capabilities.full_spectrum
+    if self.xy_output and self.capabilities.gamut is not None:
+      self.gamut = gamut_table(self.capabilities.gamut)
+    self.logger.debuglog("light %s capabilities: %s", self.light, self.capabilities)
 
     if state.has_key('hue'):
       self.start_setting['hue'] = state['hue']
@@ -354,33 +602,41 @@ class Light:
     else:
       self.livingwhite = True
 
-    self.logger.debuglog("light %s start settings: %s" % (self.light, self.start_setting))
+    self.logger.debuglog("light %s start settings: %s", self.light, self.start_setting)
 
   # def set_light(self, data):
   #   self.logger.debuglog("set_light: %s: %s" % (self.light, data))
   #   self.request_url_put("http://%s/api/%s/lights/%s/state" % \
   #     (self.bridge_ip, self.bridge_user, self.light), data=data)
 
-  def set_light2(self, hue, sat, bri, duration=None):
+  def set_light2(self, hue, sat, bri, duration=None, priority=PRIORITY_STATE, xy=None):
 
     if self.start_setting["on"] == False and self.force_light_on == False:
       # light was not on, and settings say we should not turn it on
-      self.logger.debuglog("light %s was off, settings say we should not turn it on" % self.light)
+      self.logger.debuglog("light %s was off, settings say we should not turn it on", self.light)
       return
 
     data = {}
 
     if not self.livingwhite:
-      if not hue is None:
-        if not hue == self.hueLast:
-          data["hue"] = hue
-          self.hueLast = hue
-      if not sat is None:
-        if not sat == self.satLast:
-          data["sat"] = sat
-          self.satLast = sat
-
-    self.logger.debuglog("light %s: onLast: %s, valLast: %s" % (self.light, self.onLast, self.valLast))
+      if not xy is None and not self.gamut is None:
+        if not xy == self.xyLast:
+          data["xy"] = xy
+          self.xyLast = xy
+        self.hueLast = self.satLast = None # the light isn't in hue/sat mode anymore
+      else:
+        if not hue is None:
+          if not hue == self.hueLast:
+            data["hue"] = hue
+            self.hueLast = hue
+            self.xyLast = None
+        if not sat is None:
+          if not sat == self.satLast:
+            data["sat"] = sat
+            self.satLast = sat
+            self.xyLast = None
+
+    self.logger.debuglog("light %s: onLast: %s, valLast: %s", self.light, self.onLast, self.valLast)
     if bri > 0:
       if self.onLast == False: #don't send on unless we have to (performance)
         data["on"] = True
@@ -393,7 +649,7 @@ class Light:
     time = 0
     if duration is None:
       if self.proportional_dim_time and self.mode != 0: #only if its not ambilight mode too
-        self.logger.debuglog("last %r, next %r, start %r, finish %r" % (self.valLast, bri, self.start_setting['bri'], self.dimmed_bri))
+        self.logger.debuglog("last %r, next %r, start %r, finish %r", self.valLast, bri, self.start_setting['bri'], self.dimmed_bri)
         difference = abs(float(bri) - self.valLast)
         total = float(self.start_setting['bri']) - self.dimmed_bri
         if total != 0:
@@ -407,13 +663,19 @@ class Light:
     self.valLast = bri # moved after time calclation to know the previous value (important)
 
     data["transitiontime"] = time
-    
-    dataString = json.dumps(data)
 
-    self.logger.debuglog("set_light2: %s: %s" % (self.light, dataString))
-    
-    self.request_url_put("http://%s/api/%s/lights/%s/state" % \
-      (self.bridge_ip, self.bridge_user, self.light), data=dataString)
+    self.logger.debuglog("set_light2: %s: %s", self.light, data)
+
+    self.scheduler.submit("http://%s/api/%s/lights/%s/state" % \
+      (self.bridge_ip, self.bridge_user, self.light), data, self.request_url_put, priority, self.dropped)
+
+  def dropped(self, data):
+    # a queued command was discarded before it went out, what it would have
+    # set isn't on the light: don't let it hold back the next identical one
+    if "hue" in data or "sat" in data or "xy" in data:
+      self.hueLast = self.satLast = self.xyLast = None
+    if data.get("on"):
+      self.onLast = False
 
   def flash_light(self):
     self.dim_light()
@@ -479,9 +741,8 @@ class Light:
 
 class Group(Light):
   group = True
-  lights = {}
 
-  def __init__(self, settings, group_id=None):
+  def __init__(self, settings, group_id=None, snapshot=None):
     if group_id==None:
       self.group_id = settings.group_id
     else:
@@ -491,56 +752,71 @@ class Group(Light):
     if settings.debug:
       self.logger.debug()
 
-    Light.__init__(self, settings.light1_id, settings)
-    
-    for light in self.get_lights():
-      tmp = Light(light, settings)
-      tmp.get_current_setting()
-      #if tmp.start_setting['on']: #TODO: Why only add these if they're on?
-      self.lights[light] = tmp
+    snapshot = snapshot_for(snapshot, settings.bridge_ip)
+    if snapshot is None:
+      try:
+        snapshot = BridgeSnapshot(settings.bridge_ip, settings.bridge_user)
+      except Exception:
+        self.logger.debuglog("WARNING: Request fo bridge failed")
+
+    # members first, the group's start state may depend on them
+    self.lights = {}
+    if snapshot is not None:
+      for light in snapshot.group_lights(self.group_id):
+        #if tmp.start_setting['on']: #TODO: Why only add these if they're on?
+        self.lights[light] = Light(light, settings, snapshot)
+    if len(self.lights) == 0:
+      # user probably selected a non-existing group
+      self.logger.debuglog("Exception: no lights in this group")
+
+    Light.__init__(self, settings.light1_id, settings, snapshot)
 
   def __len__(self):
     return 0
 
-  def get_lights(self):
-    try:
-      r = requests.get("http://%s/api/%s/groups/%s" % \
-        (self.bridge_ip, self.bridge_user, self.group_id))
-      j = r.json()
-    except:
-      self.logger.debuglog("WARNING: Request fo bridge failed")
-      #notify("Communication Failed", "Error while talking to the bridge")
+  def configure(self, settings):
+    Light.configure(self, settings)
+    if self.start_setting is not None:
+      for l in self.lights.values():
+        l.configure(settings)
+      self.gamut = self._gamut()
 
-    try:
-      return j['lights']
-    except:
-      # user probably selected a non-existing group
-      self.logger.debuglog("Exception: no lights in this group")
-      return []
+  def _gamut(self):
+    # the members may have different gamuts, stay inside the smallest one
+    tables = [l.gamut for l in self.lights.values() if l.gamut is not None]
+    return min(tables, key=lambda t: t.area) if tables else None
 
   # def set_light(self, data):
   #   self.logger.debuglog("set_light: %s" % data)
   #   Light.request_url_put(self, "http://%s/api/%s/groups/%s/action" % \
   #     (self.bridge_ip, self.bridge_user, self.group_id), data=data)
 
-  def set_light2(self, hue, sat, bri, duration=None):
+  def set_light2(self, hue, sat, bri, duration=None, priority=PRIORITY_STATE, xy=None):
 
     if self.start_setting["on"] == False and self.force_light_on == False:
       # light was not on, and settings say we should not turn it on
-      self.logger.debuglog("group %s was off, settings say we should not turn it on" % self.group_id)
+      self.logger.debuglog("group %s was off, settings say we should not turn it on", self.group_id)
       return
 
     data = {}
 
     if not self.livingwhite:
-      if not hue is None:
-        if not hue == self.hueLast:
-          data["hue"] = hue
-          self.hueLast = hue
-      if not sat is None:
-        if not sat == self.satLast:
-          data["sat"] = sat
-          self.satLast = sat
+      if not xy is None and not self.gamut is None:
+        if not xy == self.xyLast:
+          data["xy"] = xy
+          self.xyLast = xy
+        self.hueLast = self.satLast = None # the light isn't in hue/sat mode anymore
+      else:
+        if not hue is None:
+          if not hue == self.hueLast:
+            data["hue"] = hue
+            self.hueLast = hue
+            self.xyLast = None
+        if not sat is None:
+          if not sat == self.satLast:
+            data["sat"] = sat
+            self.satLast = sat
+            self.xyLast = None
 
     if bri > 0:
       if self.onLast == False: #don't sent on unless we have to. (performance)
@@ -553,7 +829,7 @@ class Group(Light):
 
     if duration is None:
       if self.proportional_dim_time and self.mode != 0: #only if its not ambilight mode too
-        self.logger.debuglog("last %r, next %r, start %r, finish %r" % (self.valLast, bri, self.start_setting['bri'], self.dimmed_bri))
+        self.logger.debuglog("last %r, next %r, start %r, finish %r", self.valLast, bri, self.start_setting['bri'], self.dimmed_bri)
         difference = abs(float(bri) - self.valLast)
         total = float(self.start_setting['bri']) - self.dimmed_bri
         proportion = difference / total
@@ -566,13 +842,11 @@ class Group(Light):
     self.valLast = bri # moved after time calculation
 
     data["transitiontime"] = time
-    
-    dataString = json.dumps(data)
 
-    self.logger.debuglog("set_light2: group_id %s: %s" % (self.group_id, dataString))
-    
-    self.request_url_put("http://%s/api/%s/groups/%s/action" % \
-      (self.bridge_ip, self.bridge_user, self.group_id), data=dataString)
+    self.logger.debuglog("set_light2: group_id %s: %s", self.group_id, data)
+
+    self.scheduler.submit("http://%s/api/%s/groups/%s/action" % \
+      (self.bridge_ip, self.bridge_user, self.group_id), data, self.request_url_put, priority, self.dropped)
 
   # def dim_light(self):
   #   for light in self.lights:
@@ -586,11 +860,18 @@ class Group(Light):
   #     for light in self.lights:
   #       self.lights[light].partial_light()
 
-  def get_current_setting(self):
-    r = requests.get("http://%s/api/%s/groups/%s" % \
-      (self.bridge_ip, self.bridge_user, self.group_id))
-    j = r.json()
-    self.logger.debuglog("response: %s" % j)
+  def get_current_setting(self, snapshot=None):
+    snapshot = snapshot_for(snapshot, self.bridge_ip)
+    j = None
+    if snapshot is not None:
+      for l in self.lights:
+        self.lights[l].get_current_setting(snapshot)
+      j = snapshot.group(self.group_id)
+    if j is None:
+      r = self.session.get("http://%s/api/%s/groups/%s" % \
+        (self.bridge_ip, self.bridge_user, self.group_id))
+      j = r.json()
+    self.logger.debuglog("response: %s", j)
     if isinstance(j, list) and "error" in j[0]:
       # something went wrong.
       err = j[0]["error"]
@@ -611,7 +892,7 @@ class Group(Light):
       for l in self.lights:
         #self.logger.debuglog("light: %s" % self.lights[l])
         if self.lights[l].start_setting['on']:
-          self.logger.debuglog("light %s was on, so the group will start as on" % l)
+          self.logger.debuglog("light %s was on, so the group will start as on", l)
           self.start_setting['on'] = True
           break
 
@@ -624,8 +905,7 @@ class Group(Light):
     self.onLast = self.start_setting['on']
     self.valLast = self.start_setting['bri']
     
-    # modelid = j['modelid']
-    # self.fullSpectrum = ((modelid == 'LST001') or (modelid == 'LLC007'))
+    self.gamut = self._gamut()
 
     if state.has_key('hue'):
       self.start_setting['hue'] = state['hue']
@@ -635,14 +915,329 @@ class Group(Light):
     else:
       self.livingwhite = True
 
-    self.logger.debuglog("group %s start settings: %s" % (self.group_id, self.start_setting))
+    self.logger.debuglog("group %s start settings: %s", self.group_id, self.start_setting)
 
   def request_url_put(self, url, data):
     try:
-      response = self.s.put(url, data=data)
-      self.logger.debuglog("response: %s" % response)
+      response = self.session.put(url, data=data)
+      self.logger.debuglog("response: %s", response)
     except Exception as e:
       # probably a timeout
       self.logger.debuglog("WARNING: Request fo bridge failed")
+      trace.add("error", url, e)
       pass
 
+class Groups:
+  # Groups on several bridges driven as one, for a room whose lights are
+  # split across bridges. Each group goes through its own bridge's
+  # scheduler, so every bridge adds its command rate.
+  group = True
+  livingwhite = False
+  fullSpectrum = False
+
+  def __init__(self, groups):
+    self.groups = groups
+    self.light = groups[0].light
+    self.lights = groups[0].lights # entertainment streaming stays on bridge 1
+    self.gamut = self._gamut()
+
+  def __len__(self):
+    return 0
+
+  def _gamut(self):
+    tables = [g.gamut for g in self.groups if g.gamut is not None]
+    return min(tables, key=lambda t: t.area) if tables else None
+
+  def configure(self, settings):
+    for g in self.groups:
+      g.configure(settings)
+    self.gamut = self._gamut()
+
+  def get_current_setting(self, snapshot=None):
+    for g in self.groups:
+      g.get_current_setting(snapshot)
+    self.gamut = self._gamut()
+
+  def set_light2(self, hue, sat, bri, duration=None, priority=PRIORITY_STATE, xy=None):
+    for g in self.groups:
+      g.set_light2(hue, sat, bri, duration, priority, xy)
+
+  def flash_light(self):
+    for g in self.groups:
+      g.flash_light()
+
+  def dim_light(self):
+    for g in self.groups:
+      g.dim_light()
+
+  def brighter_light(self):
+    for g in self.groups:
+      g.brighter_light()
+
+  def partial_light(self):
+    for g in self.groups:
+      g.partial_light()
+
+
+class TokenBucket:
+  def __init__(self, rate, burst=None):
+    self.configure(rate, burst)
+    self.tokens = self.capacity
+    self.stamp = time.time()
+
+  def configure(self, rate, burst=None):
+    self.rate = max(float(rate), 0.1)
+    self.capacity = float(burst or max(1, rate))
+
+  def delay(self, now):
+    # seconds until a token is available, 0 if one is available right now
+    self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+    self.stamp = now
+    if self.tokens >= 1:
+      return 0
+    return (1 - self.tokens) / self.rate
+
+  def consume(self):
+    self.tokens -= 1
+
+class CommandScheduler:
+  # Every PUT to a bridge goes through here. Keeps a token bucket for the
+  # bridge as a whole and one per light/group, merges pending commands for the
+  # same light into one, serves playback state transitions before ambilight
+  # frames and goes round-robin over the lights so none of them starves.
+  # A small pool of sender threads shares the queue, so the lights of one
+  # frame are sent concurrently (one command per light in flight at a time).
+  def __init__(self, settings):
+    self.logger = Logger()
+    if settings.debug:
+      self.logger.debug()
+
+    self.cond = threading.Condition()
+    self.pending = {} # url -> [priority, data, send, dropped]
+    self.order = []   # pending urls, in the order they will be served
+    self.inflight = set()
+    self.threads = []
+    self.buckets = {}
+    self.bridge_bucket = TokenBucket(settings.bridge_rate)
+    self.running = True
+    self.sent = 0
+    self.coalesced = 0
+    self.latency = 0.0 # moving average of the bridge round trip
+    self.configure(settings)
+
+  def configure(self, settings):
+    with self.cond:
+      self.bridge_rate = settings.bridge_rate
+      self.light_rate = settings.light_rate
+      self.group_rate = settings.group_rate
+      self.workers = settings.send_workers
+      self.bridge_bucket.configure(self.bridge_rate)
+      for url, bucket in self.buckets.items():
+        bucket.configure(self._rate(url))
+      self.cond.notify_all()
+    if self.threads and self.running:
+      self.start() # resize the pool
+
+  def _rate(self, url):
+    if "/groups/" in url:
+      return self.group_rate
+    return self.light_rate
+
+  def submit(self, url, data, send, priority=PRIORITY_STATE, dropped=None):
+    # dropped(data) is called when the command is discarded instead of sent.
+    # Commands of different priorities are never merged: a frame that comes
+    # while a state change waits is dropped, a state change replaces a
+    # waiting frame (keeping its "on", the light counts on it).
+    superseded = None
+    with self.cond:
+      entry = self.pending.get(url)
+      if entry is None:
+        self.pending[url] = [priority, dict(data), send, dropped]
+        self.order.append(url)
+        trace.add("queue", url, data)
+      elif priority > entry[0]:
+        superseded = data, dropped
+        self.coalesced += 1
+        trace.add("drop", url, data)
+      elif priority < entry[0]:
+        superseded = entry[1], entry[3]
+        merged = dict(data)
+        if "on" in entry[1] and "on" not in merged:
+          merged["on"] = entry[1]["on"]
+        entry[:] = [priority, merged, send, dropped]
+        self.coalesced += 1
+        trace.add("replace", url, data)
+      else:
+        # not sent yet, merge so an earlier "on" or hue isn't lost
+        if "xy" in data:
+          entry[1].pop("hue", None)
+          entry[1].pop("sat", None)
+        elif "hue" in data or "sat" in data:
+          entry[1].pop("xy", None)
+        entry[1].update(data)
+        entry[2] = send
+        entry[3] = dropped
+        self.coalesced += 1
+        trace.add("merge", url, data)
+      self.cond.notify()
+    if superseded is not None and superseded[1] is not None:
+      superseded[1](superseded[0])
+
+  def discard(self, priority=PRIORITY_AMBILIGHT):
+    # drop pending commands of the given priority (e.g. frames after playback stopped)
+    discarded = []
+    with self.cond:
+      for url in [u for u in self.order if self.pending[u][0] == priority]:
+        discarded.append(self.pending.pop(url))
+        self.order.remove(url)
+    for priority, data, send, dropped in discarded:
+      if dropped is not None:
+        dropped(data)
+
+  def _next(self, now):
+    # returns (url, 0) for the next command to send, or (None, seconds to wait)
+    wait = self.bridge_bucket.delay(now)
+    if wait > 0:
+      return None, wait
+    wait = 1.0
+    for priority in sorted(set(p[0] for p in self.pending.values())):
+      for url in self.order:
+        if self.pending[url][0] != priority or url in self.inflight:
+          continue
+        bucket = self.buckets.get(url)
+        if bucket is None:
+          bucket = self.buckets[url] = TokenBucket(self._rate(url))
+        delay = bucket.delay(now)
+        if delay == 0:
+          return url, 0
+        wait = min(wait, delay)
+    return None, wait
+
+  def start(self):
+    for i in range(len(self.threads), self.workers):
+      t = threading.Thread(target=self._work, args=(i,), name="KodiHueSender%d" % i)
+      t.daemon = True
+      t.start()
+      self.threads.append(t)
+
+  def _work(self, index):
+    while True:
+      with self.cond:
+        while self.running and not self.pending and index < self.workers:
+          self.cond.wait()
+        if not self.pending or index >= self.workers:
+          if index >= self.workers:
+            self.threads.remove(threading.current_thread())
+          return # stopped and drained, or the pool was made smaller
+        url, wait = self._next(time.time())
+        if url is None:
+          self.cond.wait(wait)
+          continue
+        priority, data, send, dropped = self.pending.pop(url)
+        self.order.remove(url)
+        self.inflight.add(url)
+        self.bridge_bucket.consume()
+        self.buckets[url].consume()
+        self.sent += 1
+
+      start = time.time()
+      try:
+        send(url, json.dumps(data))
+      finally:
+        stages.stop("bridge_put", start)
+        elapsed = time.time() - start
+        trace.add("put", url, data, elapsed)
+        with self.cond:
+          self.latency = self.latency * 0.8 + elapsed * 0.2
+          self.inflight.discard(url)
+          self.cond.notify_all()
+
+  def stop(self, timeout=2):
+    # sends what's still pending (e.g. the final undim) within the timeout
+    with self.cond:
+      self.running = False
+      self.cond.notify_all()
+    deadline = time.time() + timeout
+    for t in list(self.threads):
+      t.join(max(0, deadline - time.time()))
+
+  def __repr__(self):
+    return 'sent: %s coalesced: %s pending: %s' % (self.sent, self.coalesced, len(self.pending))
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+def get_scheduler(settings):
+  # one scheduler per bridge, shared by every Light and Group
+  with _schedulers_lock:
+    scheduler = _schedulers.get(settings.bridge_ip)
+    if scheduler is None:
+      scheduler = _schedulers[settings.bridge_ip] = CommandScheduler(settings)
+      scheduler.start()
+    else:
+      scheduler.configure(settings)
+    return scheduler
+
+def discard_all(priority=PRIORITY_AMBILIGHT):
+  # drop the queued commands of that priority on every bridge
+  with _schedulers_lock:
+    schedulers = list(_schedulers.values())
+  for scheduler in schedulers:
+    scheduler.discard(priority)
+
+def scheduler_latency():
+  # round trip of the slowest bridge, 0 before anything was sent
+  with _schedulers_lock:
+    return max([s.latency for s in _schedulers.values()] or [0.0])
+
+def stop_schedulers():
+  with _schedulers_lock:
+    for scheduler in _schedulers.values():
+      scheduler.stop()
+    _schedulers.clear()
+
+class BridgeSession:
+  # Keep-alive connection pool to one bridge, shared by the Hue, Light and
+  # Group instances and the sender threads. Every request gets a timeout.
+  def __init__(self, bridge_ip, pool_size=10):
+    self.bridge_ip = bridge_ip
+    self.pool_size = pool_size
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    self.session.mount("http://", adapter)
+
+  def get(self, url, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUT)
+    return self.session.get(url, **kwargs)
+
+  def put(self, url, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUT)
+    return self.session.put(url, **kwargs)
+
+  def post(self, url, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUT)
+    return self.session.post(url, **kwargs)
+
+  def warm(self, bridge_user, connections=1):
+    # open connections in the background so the first dim command doesn't
+    # pay for the TCP setup
+    url = "http://%s/api/%s/config" % (self.bridge_ip, bridge_user)
+    def connect():
+      try:
+        self.get(url)
+      except Exception:
+        pass
+    for i in range(min(connections, self.pool_size)):
+      t = threading.Thread(target=connect, name="KodiHueWarm%d" % i)
+      t.daemon = True
+      t.start()
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(bridge_ip):
+  with _sessions_lock:
+    session = _sessions.get(bridge_ip)
+    if session is None:
+      session = _sessions[bridge_ip] = BridgeSession(bridge_ip)
+    return session
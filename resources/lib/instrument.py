@@ -0,0 +1,118 @@
+import os
+import time
+import threading
+
+# ambilight stages, in the order a frame goes through them
+STAGES = ["capture_wait", "get_image", "spectrum_hsv", "most_used_spectrum", "fade_light_hsv", "bridge_put"]
+# the service watches this window property, RunScript(...,action=profile) sets it
+PROFILE_PROPERTY = "script.kodi.hue.ambilight.profile"
+
+# histogram bucket upper bounds in seconds (100us to 1s), the last bucket takes the rest
+BOUNDS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+
+class Histogram:
+  def __init__(self):
+    self.buckets = [0] * (len(BOUNDS) + 1)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def add(self, seconds):
+    i = 0
+    while i < len(BOUNDS) and seconds > BOUNDS[i]:
+      i += 1
+    self.buckets[i] += 1
+    self.count += 1
+    self.total += seconds
+    if seconds > self.max:
+      self.max = seconds
+
+  def percentile(self, p):
+    # upper bound of the bucket the p-th percentile falls in
+    if self.count == 0:
+      return 0.0
+    rank = self.count * p / 100.0
+    seen = 0
+    for i, n in enumerate(self.buckets):
+      seen += n
+      if seen >= rank and n:
+        return BOUNDS[i] if i < len(BOUNDS) else self.max
+    return self.max
+
+  def __repr__(self):
+    if self.count == 0:
+      return 'n: 0'
+    return 'n: %d mean: %.2fms p50: <%.2fms p90: <%.2fms p99: <%.2fms max: %.2fms' % \
+      (self.count, self.total / self.count * 1000, self.percentile(50) * 1000,
+      self.percentile(90) * 1000, self.percentile(99) * 1000, self.max * 1000)
+
+class StageTimer:
+  # Latency histogram per stage. Callers bracket a stage with
+  #   start = stages.start()
+  #   ...
+  #   stages.stop("spectrum_hsv", start)
+  # which is two cheap calls and no clock read while disabled. The time
+  # between loop iterations goes in as "loop".
+  enabled = False
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.histograms = dict((stage, Histogram()) for stage in STAGES)
+
+  def start(self):
+    if self.enabled:
+      return time.time()
+    return None
+
+  def stop(self, stage, start):
+    if start is None or not self.enabled:
+      return
+    elapsed = time.time() - start
+    with self.lock: # bridge_put comes from the sender threads
+      histogram = self.histograms.get(stage)
+      if histogram is None:
+        histogram = self.histograms[stage] = Histogram()
+      histogram.add(elapsed)
+
+  def report(self):
+    with self.lock:
+      names = STAGES + sorted(s for s in self.histograms if s not in STAGES)
+      return "\n".join('%-20s %s' % (s, self.histograms[s]) for s in names)
+
+stages = StageTimer()
+
+class Profiler:
+  # Time-boxed cProfile of the thread that starts it (the ambilight loop). The
+  # stage histograms are recorded for the same window, so the sender threads
+  # show up in the report as well.
+  def __init__(self, seconds, profile_dir):
+    import cProfile
+    self.deadline = time.time() + seconds
+    self.seconds = seconds
+    self.path = os.path.join(profile_dir, time.strftime("profile-%Y%m%d-%H%M%S"))
+    self.timing_was_enabled = stages.enabled
+    stages.reset()
+    stages.enabled = True
+    self.profile = cProfile.Profile()
+    self.profile.enable()
+
+  def expired(self):
+    return time.time() >= self.deadline
+
+  def finish(self):
+    # writes <path>.txt (stages and top functions) and <path>.prof (pstats), returns the report path
+    import pstats
+    self.profile.disable()
+    stages.enabled = self.timing_was_enabled
+    self.profile.dump_stats(self.path + ".prof")
+    report = open(self.path + ".txt", "w")
+    try:
+      report.write("ambilight stages over %s seconds\n%s\n\n" % (self.seconds, stages.report()))
+      pstats.Stats(self.profile, stream=report).sort_stats("cumulative").print_stats(40)
+    finally:
+      report.close()
+    return self.path + ".txt"
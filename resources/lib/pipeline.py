@@ -0,0 +1,75 @@
+import threading
+
+class FramePipeline(threading.Thread):
+  # Ambilight sender stage. The capture/analysis loop publishes a target per
+  # light into a single slot "latest value" mailbox; this thread drains the
+  # mailboxes and talks to the bridge. A target that is replaced before it
+  # was sent is dropped, so a slow bridge never builds up a backlog.
+  def __init__(self, send, logger):
+    threading.Thread.__init__(self, name="KodiHueSender")
+    self.daemon = True
+    self.send = send
+    self.logger = logger
+    self.cond = threading.Condition()
+    self.slots = {}
+    self.running = True
+    self.generation = 0 # bumped by clear(), what was taken before is stale
+    self.sending = False
+    self.published = 0
+    self.dropped = 0
+
+  def publish(self, key, light, target):
+    with self.cond:
+      self.published += 1
+      if key in self.slots:
+        self.dropped += 1 # stale, never sent
+      self.slots[key] = (light, target)
+      self.cond.notify()
+
+  def clear(self):
+    # nothing published before is sent once this returns: waiting targets
+    # are dropped and a send already under way is waited for
+    with self.cond:
+      self.dropped += len(self.slots)
+      self.slots = {}
+      self.generation += 1
+      while self.sending:
+        self.cond.wait()
+
+  def stop(self):
+    with self.cond:
+      self.running = False
+      self.slots = {}
+      self.cond.notify()
+    self.join(2)
+
+  def run(self):
+    while True:
+      with self.cond:
+        while self.running and not self.slots:
+          self.cond.wait()
+        if not self.running:
+          return
+        pending = self.slots
+        self.slots = {}
+        generation = self.generation
+
+      keys = sorted(pending)
+      for i, key in enumerate(keys):
+        with self.cond:
+          if self.generation != generation or not self.running:
+            self.dropped += len(keys) - i # cleared meanwhile
+            break
+          self.sending = True
+        light, target = pending[key]
+        try:
+          self.send(light, target)
+        except Exception as e:
+          self.logger.debuglog("sender: update for light %s failed: %s", key, e)
+        finally:
+          with self.cond:
+            self.sending = False
+            self.cond.notify_all()
+
+  def __repr__(self):
+    return 'published: %s dropped: %s' % (self.published, self.dropped)
@@ -11,6 +11,19 @@ class MySettings():
   def readxml(self):
     self.bridge_ip             = __addon__.getSetting("bridge_ip")
     self.bridge_user           = __addon__.getSetting("bridge_user")
+    self.bridge_clientkey      = __addon__.getSetting("bridge_clientkey")
+    self.bridge2               = __addon__.getSetting("bridge2") == "true"
+    self.bridge2_ip            = __addon__.getSetting("bridge2_ip")
+    self.bridge2_user          = __addon__.getSetting("bridge2_user")
+    self.bridge2_clientkey     = __addon__.getSetting("bridge2_clientkey")
+    self.bridge2_group_id      = int(__addon__.getSetting("bridge2_group_id"))
+    self.bridge2_rate          = int(__addon__.getSetting("bridge2_rate").split(".")[0])
+    self.bridge3               = __addon__.getSetting("bridge3") == "true"
+    self.bridge3_ip            = __addon__.getSetting("bridge3_ip")
+    self.bridge3_user          = __addon__.getSetting("bridge3_user")
+    self.bridge3_clientkey     = __addon__.getSetting("bridge3_clientkey")
+    self.bridge3_group_id      = int(__addon__.getSetting("bridge3_group_id"))
+    self.bridge3_rate          = int(__addon__.getSetting("bridge3_rate").split(".")[0])
 
     self.mode                  = int(__addon__.getSetting("mode"))
     self.light                 = int(__addon__.getSetting("light"))
@@ -18,6 +31,9 @@ class MySettings():
     self.light2_id             = int(__addon__.getSetting("light2_id"))
     self.light3_id             = int(__addon__.getSetting("light3_id"))
     self.group_id              = int(__addon__.getSetting("group_id"))
+    self.light1_bridge         = int(__addon__.getSetting("light1_bridge")) + 1
+    self.light2_bridge         = int(__addon__.getSetting("light2_bridge")) + 1
+    self.light3_bridge         = int(__addon__.getSetting("light3_bridge")) + 1
     self.misc_initialflash     = __addon__.getSetting("misc_initialflash") == "true"
     self.misc_disableshort     = __addon__.getSetting("misc_disableshort") == "true"
     self.misc_disableshort_threshold = int(__addon__.getSetting("misc_disableshort_threshold") == "true")
@@ -46,14 +62,56 @@ class MySettings():
     self.ambilight_min         = int(int(__addon__.getSetting("ambilight_min").split(".")[0])*254/100)
     self.ambilight_max         = int(int(__addon__.getSetting("ambilight_max").split(".")[0])*254/100)
     self.color_bias            = int(int(__addon__.getSetting("color_bias").split(".")[0])/3*3)
+    self.light1_zone           = int(__addon__.getSetting("light1_zone"))
+    self.light1_zone_rect      = __addon__.getSetting("light1_zone_rect")
+    self.light2_zone           = int(__addon__.getSetting("light2_zone"))
+    self.light2_zone_rect      = __addon__.getSetting("light2_zone_rect")
+    self.light3_zone           = int(__addon__.getSetting("light3_zone"))
+    self.light3_zone_rect      = __addon__.getSetting("light3_zone_rect")
+    self.zone_falloff          = int(__addon__.getSetting("zone_falloff").split(".")[0])
+    self.ambilight_pipeline    = __addon__.getSetting("ambilight_pipeline") == "true"
+    self.frame_tolerance       = int(__addon__.getSetting("frame_tolerance").split(".")[0])
+    self.smoothing             = int(__addon__.getSetting("smoothing"))
+    self.smoothing_time        = int(__addon__.getSetting("smoothing_time").split(".")[0])
+    self.delta_e               = int(__addon__.getSetting("delta_e").split(".")[0])
+    self.scene_cut             = int(__addon__.getSetting("scene_cut").split(".")[0])
+    self.color_output          = int(__addon__.getSetting("color_output"))
+    self.color_tracks          = int(__addon__.getSetting("color_tracks"))
+    self.adaptive_capture      = __addon__.getSetting("adaptive_capture") == "true"
+    self.capture_min_width     = int(__addon__.getSetting("capture_min_width").split(".")[0])
+    self.capture_max_width     = int(__addon__.getSetting("capture_max_width").split(".")[0])
+    self.capture_min_rate      = int(__addon__.getSetting("capture_min_rate").split(".")[0])
+    self.capture_max_rate      = int(__addon__.getSetting("capture_max_rate").split(".")[0])
+    self.output                = int(__addon__.getSetting("output"))
+    self.entertainment_group_id = int(__addon__.getSetting("entertainment_group_id"))
+    self.stream_rate           = int(__addon__.getSetting("stream_rate").split(".")[0])
     self.force_light_on        = __addon__.getSetting("force_light_on") == "true"
     self.force_light_group_start_override = __addon__.getSetting("force_light_group_start_override") == "true"
+    self.bridge_rate           = int(__addon__.getSetting("bridge_rate").split(".")[0])
+    self.light_rate            = int(__addon__.getSetting("light_rate").split(".")[0])
+    self.group_rate            = int(__addon__.getSetting("group_rate").split(".")[0])
+    self.send_workers          = int(__addon__.getSetting("send_workers").split(".")[0])
 
     if self.ambilight_min > self.ambilight_max:
         self.ambilight_min = self.ambilight_max
         __addon__.setSetting("ambilight_min", __addon__.getSetting("ambilight_max"))
 
+    if self.capture_min_width > self.capture_max_width:
+        self.capture_min_width = self.capture_max_width
+        __addon__.setSetting("capture_min_width", __addon__.getSetting("capture_max_width"))
+
+    if self.capture_min_rate > self.capture_max_rate:
+        self.capture_min_rate = self.capture_max_rate
+        __addon__.setSetting("capture_min_rate", __addon__.getSetting("capture_max_rate"))
+
     self.debug                 = __addon__.getSetting("debug") == "true"
+    self.stage_timing          = __addon__.getSetting("stage_timing") == "true"
+    self.profile_seconds       = int(__addon__.getSetting("profile_seconds").split(".")[0])
+    self.trace                 = __addon__.getSetting("trace") == "true"
+
+  def changes(self, other):
+    # names of the settings that differ from another MySettings
+    return set(k for k, v in self.__dict__.items() if k != "addon" and getattr(other, k, None) != v)
 
   def update(self, **kwargs):
     self.__dict__.update(**kwargs)
@@ -63,12 +121,23 @@ class MySettings():
   def __repr__(self):
     return 'bridge_ip: %s\n' % self.bridge_ip + \
     'bridge_user: %s\n' % self.bridge_user + \
+    'bridge2: %s\n' % str(self.bridge2) + \
+    'bridge2_ip: %s\n' % self.bridge2_ip + \
+    'bridge2_user: %s\n' % self.bridge2_user + \
+    'bridge2_group_id: %s\n' % str(self.bridge2_group_id) + \
+    'bridge3: %s\n' % str(self.bridge3) + \
+    'bridge3_ip: %s\n' % self.bridge3_ip + \
+    'bridge3_user: %s\n' % self.bridge3_user + \
+    'bridge3_group_id: %s\n' % str(self.bridge3_group_id) + \
     'mode: %s\n' % str(self.mode) + \
     'light: %s\n' % str(self.light) + \
     'light1_id: %s\n' % str(self.light1_id) + \
     'light2_id: %s\n' % str(self.light2_id) + \
     'light3_id: %s\n' % str(self.light3_id) + \
     'group_id: %s\n' % str(self.group_id) + \
+    'light1_bridge: %s\n' % str(self.light1_bridge) + \
+    'light2_bridge: %s\n' % str(self.light2_bridge) + \
+    'light3_bridge: %s\n' % str(self.light3_bridge) + \
     'misc_initialflash: %s\n' % str(self.misc_initialflash) + \
     'misc_disableshort: %s\n' % str(self.misc_disableshort) + \
     'misc_disableshort_threshold: %s\n' % str(self.misc_disableshort_threshold) + \
@@ -91,6 +160,38 @@ class MySettings():
     'ambilight_min: %s\n' % str(self.ambilight_min) + \
     'ambilight_max: %s\n' % str(self.ambilight_max) + \
     'color_bias: %s\n' % str(self.color_bias) + \
+    'light1_zone: %s\n' % str(self.light1_zone) + \
+    'light1_zone_rect: %s\n' % self.light1_zone_rect + \
+    'light2_zone: %s\n' % str(self.light2_zone) + \
+    'light2_zone_rect: %s\n' % self.light2_zone_rect + \
+    'light3_zone: %s\n' % str(self.light3_zone) + \
+    'light3_zone_rect: %s\n' % self.light3_zone_rect + \
+    'zone_falloff: %s\n' % str(self.zone_falloff) + \
+    'ambilight_pipeline: %s\n' % str(self.ambilight_pipeline) + \
+    'frame_tolerance: %s\n' % str(self.frame_tolerance) + \
+    'smoothing: %s\n' % str(self.smoothing) + \
+    'smoothing_time: %s\n' % str(self.smoothing_time) + \
+    'delta_e: %s\n' % str(self.delta_e) + \
+    'scene_cut: %s\n' % str(self.scene_cut) + \
+    'color_output: %s\n' % str(self.color_output) + \
+    'color_tracks: %s\n' % str(self.color_tracks) + \
+    'adaptive_capture: %s\n' % str(self.adaptive_capture) + \
+    'capture_min_width: %s\n' % str(self.capture_min_width) + \
+    'capture_max_width: %s\n' % str(self.capture_max_width) + \
+    'capture_min_rate: %s\n' % str(self.capture_min_rate) + \
+    'capture_max_rate: %s\n' % str(self.capture_max_rate) + \
+    'output: %s\n' % str(self.output) + \
+    'entertainment_group_id: %s\n' % str(self.entertainment_group_id) + \
+    'stream_rate: %s\n' % str(self.stream_rate) + \
     'force_light_on: %s\n' % str(self.force_light_on) + \
     'force_light_group_start_override: %s\n' % str(self.force_light_group_start_override) + \
-    'debug: %s\n' % self.debug
\ No newline at end of file
+    'bridge_rate: %s\n' % str(self.bridge_rate) + \
+    'bridge2_rate: %s\n' % str(self.bridge2_rate) + \
+    'bridge3_rate: %s\n' % str(self.bridge3_rate) + \
+    'light_rate: %s\n' % str(self.light_rate) + \
+    'group_rate: %s\n' % str(self.group_rate) + \
+    'send_workers: %s\n' % str(self.send_workers) + \
+    'debug: %s\n' % self.debug + \
+    'stage_timing: %s\n' % self.stage_timing + \
+    'profile_seconds: %s\n' % str(self.profile_seconds) + \
+    'trace: %s\n' % self.trace
\ No newline at end of file
@@ -0,0 +1,175 @@
+import colorsys
+import math
+import threading
+
+# smoothing setting values
+SMOOTHING_OFF = 0
+SMOOTHING_EXPONENTIAL = 1
+SMOOTHING_DAMPED = 2
+
+MAX_STEP = 1.0 # seconds, a longer gap (pause, skipped frames) jumps to the target
+CUT_TRANSITION = 1 # transitiontime (100ms) for the first colour after a scene cut
+WHITE = (0.95047, 1.0, 1.08883) # D65
+
+#################
+# COLOUR SPACES #
+#################
+
+def _linear(c):
+  return c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4
+
+def _gamma(c):
+  c = min(max(c, 0.0), 1.0)
+  return c * 12.92 if c <= 0.0031308 else 1.055 * c ** (1 / 2.4) - 0.055
+
+def _f(t):
+  return t ** (1 / 3.0) if t > 216 / 24389.0 else (24389 / 27.0 * t + 16) / 116.0
+
+def _f_inverse(t):
+  return t ** 3 if t > 6 / 29.0 else (116 * t - 16) * 27 / 24389.0
+
+def hsv_to_lab(h, s, v):
+  # Hue API ranges (hue 0-65535, sat 0-255, bri 0-255) to CIE L*a*b*, sRGB/D65
+  r, g, b = [_linear(c) for c in colorsys.hsv_to_rgb(h / 65535.0, s / 255.0, v / 255.0)]
+  x = (0.4124 * r + 0.3576 * g + 0.1805 * b) / WHITE[0]
+  y = (0.2126 * r + 0.7152 * g + 0.0722 * b) / WHITE[1]
+  z = (0.0193 * r + 0.1192 * g + 0.9505 * b) / WHITE[2]
+  fx, fy, fz = _f(x), _f(y), _f(z)
+  return 116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz)
+
+def lab_to_hsv(L, a, b):
+  fy = (L + 16) / 116.0
+  x = _f_inverse(fy + a / 500.0) * WHITE[0]
+  y = _f_inverse(fy) * WHITE[1]
+  z = _f_inverse(fy - b / 200.0) * WHITE[2]
+  r = _gamma(3.2406 * x - 1.5372 * y - 0.4986 * z)
+  g = _gamma(-0.9689 * x + 1.8758 * y + 0.0415 * z)
+  b = _gamma(0.0557 * x - 0.2040 * y + 1.0570 * z)
+  h, s, v = colorsys.rgb_to_hsv(r, g, b)
+  return int(round(h * 65535)), int(round(s * 255)), int(round(v * 255))
+
+def delta_e(lab1, lab2):
+  # CIE76, about 2.3 is a just noticeable difference
+  dL = lab1[0] - lab2[0]
+  da = lab1[1] - lab2[1]
+  db = lab1[2] - lab2[2]
+  return math.sqrt(dL * dL + da * da + db * db)
+
+###########
+# FILTERS #
+###########
+
+class LightSmoother:
+  # Filters one light's colour in L*a*b* and says when it's worth sending:
+  # only once the filtered colour is more than threshold (delta E) away from
+  # what the light was last sent. The exponential filter follows the target
+  # with time constant tau; the critically damped one moves like a spring
+  # (smoother start, no overshoot) and settles in about the same time.
+  # A colour from a new scene (after a cut) skips the filter.
+  def __init__(self, mode=SMOOTHING_EXPONENTIAL, tau=0.2, threshold=2.0):
+    self.mode = mode
+    self.tau = tau
+    self.threshold = threshold
+    self.scene = 0
+    self.reset()
+
+  def reset(self):
+    self.state = None
+    self.velocity = (0.0, 0.0, 0.0)
+    self.target = None
+    self.target_hsv = None
+    self.sent = None
+    self.last_update = None
+
+  def _filter(self, target, dt):
+    if self.state is None or self.mode == SMOOTHING_OFF or self.tau <= 0 or dt is None or dt > MAX_STEP:
+      self.velocity = (0.0, 0.0, 0.0)
+      return target
+    if self.mode == SMOOTHING_DAMPED:
+      # closed form step of a critically damped spring, see Game Programming Gems 4, 1.10
+      omega = 2.0 / self.tau
+      x = omega * dt
+      decay = 1.0 / (1.0 + x + 0.48 * x * x + 0.235 * x * x * x)
+      state = []
+      velocity = []
+      for current, goal, speed in zip(self.state, target, self.velocity):
+        change = current - goal
+        temp = (speed + omega * change) * dt
+        velocity.append((speed - omega * temp) * decay)
+        state.append(goal + (change + temp) * decay)
+      self.velocity = tuple(velocity)
+      return tuple(state)
+    alpha = 1.0 - math.exp(-dt / self.tau)
+    L, a, b = self.state
+    return (L + alpha * (target[0] - L), a + alpha * (target[1] - a), b + alpha * (target[2] - b))
+
+  def update(self, h, s, v, now, scene=0):
+    # (h, s, v, delta E, cut) to send, or None when the change isn't visible
+    cut = scene != self.scene
+    if cut:
+      self.scene = scene
+      self.state = None # jump straight to the new scene's colour
+    if (h, s, v) != self.target_hsv: # the same target comes again while the filter catches up
+      self.target = hsv_to_lab(h, s, v)
+      self.target_hsv = (h, s, v)
+    dt = None if self.last_update is None else now - self.last_update
+    self.last_update = now
+    self.state = self._filter(self.target, dt)
+    if self.sent is not None:
+      distance = delta_e(self.state, self.sent)
+      if distance <= self.threshold:
+        return None
+    else:
+      distance = 100.0
+    self.sent = self.state
+    if self.state == self.target:
+      return (h, s, v, distance, cut) # no rounding trip for the unfiltered colour
+    return lab_to_hsv(*self.state) + (distance, cut)
+
+  def settled(self):
+    # True when the filter has nothing left to send for the current target
+    return self.target is None or (self.sent is not None and delta_e(self.target, self.sent) <= self.threshold)
+
+class Smoothing:
+  # A LightSmoother per light plus the counts for tuning: sent is what went
+  # to the bridge, suppressed what was dropped as not visibly different.
+  def __init__(self, settings):
+    self.lock = threading.Lock()
+    self.lights = {}
+    self.sent = 0
+    self.suppressed = 0
+    self.configure(settings)
+
+  def configure(self, settings):
+    with self.lock:
+      self.mode = settings.smoothing
+      self.tau = settings.smoothing_time / 1000.0
+      self.threshold = settings.delta_e
+      self.lights = {} # lights are set up again on a settings change
+
+  def update(self, light, h, s, v, now, scene=0):
+    with self.lock:
+      smoother = self.lights.get(light)
+      if smoother is None:
+        smoother = self.lights[light] = LightSmoother(self.mode, self.tau, self.threshold)
+        smoother.scene = scene
+      result = smoother.update(h, s, v, now, scene)
+      if result is None:
+        self.suppressed += 1
+      else:
+        self.sent += 1
+      return result
+
+  def settled(self):
+    with self.lock:
+      return all(smoother.settled() for smoother in self.lights.values())
+
+  def reset(self):
+    # after pause/stop the lights have moved on, the first frame goes out as is
+    with self.lock:
+      for smoother in self.lights.values():
+        smoother.reset()
+
+  def __repr__(self):
+    total = self.sent + self.suppressed
+    return 'sent: %d suppressed: %d (%.0f%%)' % (self.sent, self.suppressed, 100.0 * self.suppressed / total if total else 0.0)
@@ -0,0 +1,299 @@
+import os
+import colorsys
+import hashlib
+from array import array
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# pixels below these are too dark/grey to say anything about the color
+VALUE_THRESHOLD = 0.25
+SATURATION_THRESHOLD = 0.33
+
+# bits kept per channel for the pure Python lookup table (32768 entries at 5)
+LUT_BITS = 5
+LUT_FILE = "hsv_lut_v2_%dbit.bin" # the tables, then their sha1
+
+# pixels compared by the frame fingerprint
+FINGERPRINT_SAMPLES = 64
+
+_lut = None
+
+def build_lut(bits=LUT_BITS):
+  # hue bin (-1 when the color is filtered out), saturation and value for
+  # every quantized RGB color, sampled at the center of each bucket
+  levels = 1 << bits
+  step = 256 / levels
+  n = levels ** 3
+  bins = array('h', [-1]) * n
+  sats = array('f', [0.0]) * n
+  vals = array('f', [0.0]) * n
+
+  channel = [(q * step + step / 2) / 255.0 for q in range(levels)]
+  i = 0
+  for r in channel:
+    for g in channel:
+      for b in channel:
+        tmph, tmps, tmpv = colorsys.rgb_to_hsv(r, g, b)
+        sats[i] = tmps
+        vals[i] = tmpv
+        if tmpv > VALUE_THRESHOLD and tmps > SATURATION_THRESHOLD:
+          bins[i] = int(tmph * 360)
+        i += 1
+  return bins, sats, vals
+
+def _digest(tables):
+  sha = hashlib.sha1()
+  for a in tables:
+    sha.update(a)
+  return sha.digest()
+
+def _read_lut(path, bits=LUT_BITS):
+  # the cached tables, None when they're missing, of another size or corrupt
+  n = (1 << bits) ** 3
+  bins, sats, vals = array('h'), array('f'), array('f')
+  size = n * (bins.itemsize + sats.itemsize + vals.itemsize)
+  try:
+    if os.path.getsize(path) != size + hashlib.sha1().digest_size:
+      return None
+    f = open(path, "rb")
+    try:
+      bins.fromfile(f, n)
+      sats.fromfile(f, n)
+      vals.fromfile(f, n)
+      digest = f.read()
+    finally:
+      f.close()
+  except (IOError, OSError, EOFError):
+    return None
+  if digest != _digest((bins, sats, vals)):
+    return None
+  return bins, sats, vals
+
+def load_lut(cache_dir=None, bits=LUT_BITS):
+  # built once per process; cached in the addon profile dir between runs
+  global _lut
+  if _lut is not None:
+    return _lut
+
+  path = None
+  if cache_dir:
+    path = os.path.join(cache_dir, LUT_FILE % bits)
+    _lut = _read_lut(path, bits)
+    if _lut is not None:
+      return _lut
+    # not cached yet (or truncated, corrupt), rebuild below
+
+  _lut = build_lut(bits)
+  if path is not None:
+    try:
+      f = open(path, "wb")
+      try:
+        for a in _lut:
+          a.tofile(f)
+        f.write(_digest(_lut))
+      finally:
+        f.close()
+    except (IOError, OSError):
+      pass # profile dir not writable, we'll just build it again next time
+  return _lut
+
+def spectrum_hsv_lut(pixels, rgba=True, cache_dir=None):
+  # Pure Python version of Screenshot.spectrum_hsv using the lookup table,
+  # one index computation and one table read per pixel.
+  bins, sats, vals = load_lut(cache_dir)
+  size = int(len(pixels) / 4)
+  if size == 0:
+    raise ZeroDivisionError("empty capture")
+
+  shift = 8 - LUT_BITS
+  gshift = LUT_BITS
+  rshift = LUT_BITS * 2
+  if rgba:
+    reds, blues = pixels[0:size * 4:4], pixels[2:size * 4:4]
+  else: #probably BGRA
+    reds, blues = pixels[2:size * 4:4], pixels[0:size * 4:4]
+  greens = pixels[1:size * 4:4]
+
+  counts = [0] * 360
+  sat_sum = [0.0] * 360
+  val_sum = [0.0] * 360
+  v = 0.0
+  for r, g, b in zip(reds, greens, blues):
+    i = ((r >> shift) << rshift) | ((g >> shift) << gshift) | (b >> shift)
+    v += vals[i]
+    h = bins[i]
+    if h >= 0:
+      counts[h] += 1
+      sat_sum[h] += sats[i]
+      val_sum[h] += vals[i]
+
+  spectrum = {}
+  saturation = {}
+  value = {}
+  for h in range(360):
+    n = counts[h]
+    if n:
+      spectrum[h] = n
+      saturation[h] = sat_sum[h] / n
+      value[h] = val_sum[h] / n
+
+  overall_value = v / size
+  return spectrum, saturation, value, size, overall_value
+
+class FrameChangeDetector:
+  # Cheap check run before the analysis: a fingerprint of strided pixels is
+  # compared to the one of the last analysed frame (not the previous frame, so
+  # a slow fade can't creep past the tolerance one frame at a time).
+  # tolerance is the mean absolute difference per channel, 0-255.
+  def __init__(self, tolerance, samples=FINGERPRINT_SAMPLES):
+    self.tolerance = tolerance
+    self.samples = samples
+    self.last = None
+    self.analysed = 0
+    self.skipped = 0
+
+  def fingerprint(self, pixels):
+    size = int(len(pixels) / 4)
+    stride = max(1, size // self.samples) * 4
+    end = size * 4
+    return pixels[0:end:stride] + pixels[1:end:stride] + pixels[2:end:stride]
+
+  def changed(self, pixels):
+    fingerprint = self.fingerprint(pixels)
+    last = self.last
+    if last is not None and len(last) == len(fingerprint) and len(last) > 0:
+      distance = sum(abs(a - b) for a, b in zip(fingerprint, last)) / float(len(last))
+      if distance <= self.tolerance:
+        self.skipped += 1
+        return False
+    self.last = fingerprint
+    self.analysed += 1
+    return True
+
+  def reset(self):
+    self.last = None
+
+  def __repr__(self):
+    return 'analysed: %s skipped: %s' % (self.analysed, self.skipped)
+
+class SceneCutDetector:
+  # Hard cuts, from the hue histograms the analysis builds anyway: the pixel
+  # share of every CUT_BINS wide hue range (plus one for dark/grey pixels)
+  # and the overall brightness, compared to the previous analysed frame.
+  # threshold is in percent: 0 never finds a cut, 100 only a complete change.
+  # scene counts the cuts, colours carry it so the sender knows they start
+  # a new scene.
+  CUT_BINS = 10 # degrees
+
+  def __init__(self, threshold):
+    self.threshold = threshold
+    self.last = None
+    self.scene = 0
+
+  def signature(self, histograms):
+    # histograms: (spectrum, saturation, value, size, overall_value) per zone
+    bins = [0.0] * (360 // self.CUT_BINS + 1)
+    total = 0.0
+    value = 0.0
+    for spectrum, saturation, values, size, overall_value in histograms:
+      for h, n in spectrum.items():
+        bins[h // self.CUT_BINS] += n
+      total += size
+      value += overall_value * size
+    if total == 0:
+      return None
+    bins[-1] = total - sum(bins[:-1]) # pixels without a color
+    return [n / total for n in bins], value / total
+
+  def cut(self, histograms):
+    signature = self.signature(histograms)
+    last = self.last
+    self.last = signature
+    if self.threshold <= 0 or last is None or signature is None:
+      return False
+    # share of the picture that changed color, or the brightness change for
+    # greys and fades that the hue histogram doesn't see
+    difference = max(sum(abs(a - b) for a, b in zip(signature[0], last[0])) / 2, abs(signature[1] - last[1]))
+    if difference * 100 < self.threshold:
+      return False
+    self.scene += 1
+    return True
+
+  def reset(self):
+    self.last = None
+
+  def __repr__(self):
+    return 'scene cuts: %s' % self.scene
+
+def hsv_numpy(pixels, rgba=True):
+  # hue (0-1), saturation and value arrays for every pixel
+  buf = numpy.frombuffer(pixels, dtype=numpy.uint8)
+  size = int(len(buf) / 4)
+  if size == 0:
+    raise ZeroDivisionError("empty capture")
+
+  px = buf[:size * 4].reshape(size, 4).astype(numpy.float64) / 255.0
+  if rgba:
+    r, g, b = px[:, 0], px[:, 1], px[:, 2]
+  else: #probably BGRA
+    b, g, r = px[:, 0], px[:, 1], px[:, 2]
+
+  # same maths as colorsys.rgb_to_hsv, for all pixels at once
+  maxc = numpy.maximum(numpy.maximum(r, g), b)
+  minc = numpy.minimum(numpy.minimum(r, g), b)
+  delta = maxc - minc
+  v = maxc
+  s = delta / numpy.where(maxc == 0, 1.0, maxc)
+
+  d = numpy.where(delta == 0, 1.0, delta)
+  rc = (maxc - r) / d
+  gc = (maxc - g) / d
+  bc = (maxc - b) / d
+  h = numpy.where(r == maxc, bc - gc, numpy.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+  h = (h / 6.0) % 1.0
+  h[delta == 0] = 0.0
+  return h, s, v
+
+def histogram_numpy(h, s, v, weights=None):
+  # 360 bin hue histogram in the (spectrum, saturation, value, size,
+  # overall_value) form, optionally with a weight per pixel (the counts are
+  # pixel counts without weights, summed weights with them)
+  weighted = weights is not None
+  if not weighted:
+    weights = numpy.ones(len(v))
+  size = float(weights.sum())
+  if size == 0:
+    raise ZeroDivisionError("empty capture")
+
+  # skip low value and saturation
+  mask = (v > VALUE_THRESHOLD) & (s > SATURATION_THRESHOLD) & (weights > 0)
+  bins = (h[mask] * 360).astype(numpy.intp)
+  w = weights[mask]
+  counts = numpy.bincount(bins, weights=w, minlength=360)
+  sat_sum = numpy.bincount(bins, weights=s[mask] * w, minlength=360)
+  val_sum = numpy.bincount(bins, weights=v[mask] * w, minlength=360)
+
+  used = numpy.nonzero(counts)[0]
+  n = counts[used]
+  keys = used.tolist()
+  spectrum = dict(zip(keys, (n if weighted else n.astype(numpy.intp)).tolist()))
+  saturation = dict(zip(keys, (sat_sum[used] / n).tolist()))
+  value = dict(zip(keys, (val_sum[used] / n).tolist()))
+
+  overall_value = float((v * weights).sum()) / size
+  return spectrum, saturation, value, size, overall_value
+
+def spectrum_hsv_numpy(pixels, rgba=True):
+  # Array version of Screenshot.spectrum_hsv. Returns the same
+  # (spectrum, saturation, value, size, overall_value) tuple that
+  # Screenshot.most_used_spectrum expects. Saturation and value of a bin are
+  # the mean over its pixels (like spectrum_hsv_lut), not the running
+  # (last + new) / 2 of the old colorsys loop, which weighted the pixels
+  # near the bottom of the frame most; overall_value is the mean over all
+  # pixels.
+  h, s, v = hsv_numpy(pixels, rgba)
+  spectrum, saturation, value, size, overall_value = histogram_numpy(h, s, v)
+  return spectrum, saturation, value, int(size), overall_value
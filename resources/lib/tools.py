@@ -1,10 +1,12 @@
-import xbmcaddon
 import time
 import os
 import re
+import json
+import threading
 import urllib
 from urllib2 import Request, urlopen
 import xml.etree.ElementTree as ET
+from collections import deque
 
 NOSE = os.environ.get('NOSE', None)
 if not NOSE:
@@ -28,10 +30,15 @@ API_KEY = "7OOEGRV8Y2SVNTS29EBJ"
 API_SEARCH_URL = "http://www.chapterdb.org/chapters/search"
 XML_NAMESPACE = "http://jvance.com/2008/ChapterGrabber"
 THRESHOLD_LAST_CHAPTER = 60
+CREDITS_DEADLINE = 10 # seconds, later answers are ignored
+CREDITS_CACHE_FILE = "credits_cache.json"
+CREDITS_TTL = 90 * 24 * 3600 # a found credits start
+CREDITS_MISS_TTL = 7 * 24 * 3600 # "no match", chapterdb may get an entry later
+CREDITS_CACHE_SIZE = 500 # entries, least recently used go first
 
 class ChapterManager:
   @staticmethod
-  def CreditsStartTimeForMovie(title, t_duration=None, chapterCount=None):
+  def CreditsStartTimeForMovie(title, t_duration=None, chapterCount=None, timeout=None, fallback=True):
     #try:
     url = "%s?title=%s" % (API_SEARCH_URL, urllib.quote(title))
     
@@ -45,12 +52,35 @@ class ChapterManager:
     
     headers = {"ApiKey": API_KEY}
     request = Request(url, headers=headers)
-    response_body = urlopen(request).read()
-    root = ET.fromstring(response_body)
+    if timeout is None:
+      response = urlopen(request)
+    else:
+      response = urlopen(request, timeout=timeout)
+    try:
+      t_lastChapterStart = ChapterManager.LastChapterStart(response, t_duration, chapterCount)
+    finally:
+      response.close()
+    if t_lastChapterStart != None:
+      return t_lastChapterStart
+
+    # fall back to trying with no duration specified
+    if t_duration != None and fallback:
+      return ChapterManager.CreditsStartTimeForMovie(title, None, chapterCount, timeout)
 
+    #except Exception as e:
+    #  print "Error: %s" % e
+        
+    return None
+
+  @staticmethod
+  def LastChapterStart(response, t_duration=None, chapterCount=None):
+    # parses the search results as they come in and stops at the first match,
+    # the rest of the response is neither read nor parsed
     #xbmc.log("%s: DEBUG %s" % (self.scriptname, "got response back from chapterdb "))
-    
-    for res_chapterInfo in root.findall("{%s}chapterInfo" % XML_NAMESPACE):
+
+    for event, res_chapterInfo in ET.iterparse(response):
+      if res_chapterInfo.tag != "{%s}chapterInfo" % XML_NAMESPACE:
+        continue
       res_duration = res_chapterInfo.find("{%s}source/{%s}duration" % (XML_NAMESPACE, XML_NAMESPACE))
       res_chapters = res_chapterInfo.find("{%s}chapters" % XML_NAMESPACE)
       res_chapterCount = len(res_chapters)
@@ -60,10 +90,12 @@ class ChapterManager:
         
         if t_duration != t_res_duration:
           # durations don't match, skip this result
+          res_chapterInfo.clear()
           continue
 
       if chapterCount and chapterCount != res_chapterCount:
         # chapter counts don't match, skip this result
+        res_chapterInfo.clear()
         continue
     
       res_lastChapter = res_chapters[res_chapterCount - 1]
@@ -76,15 +108,19 @@ class ChapterManager:
       xbmc.log("%s: DEBUG %s" % ("Kodi Hue", "selected chapterdb entry with duration %r" % res_duration.text))
       return t_lastChapterStart
 
-    # fall back to trying with no duration specified
-    if t_duration != None:
-      return ChapterManager.CreditsStartTimeForMovie(title, None, chapterCount)
-
-    #except Exception as e:
-    #  print "Error: %s" % e
-        
     return None
 
+  @staticmethod
+  def CreditsStartForChapters(starts, t_duration=None):
+    # same pick as for chapterdb results: the last chapter, or the one before
+    # it when the last one is an extra chapter right at the end
+    if len(starts) < 2:
+      return None # no chapters, or just one covering the whole movie
+    t_lastChapterStart = starts[-1]
+    if len(starts) > 2 and t_duration != None and (t_duration - t_lastChapterStart < THRESHOLD_LAST_CHAPTER):
+      t_lastChapterStart = starts[-2]
+    return int(round(t_lastChapterStart))
+
   @staticmethod
   def TotalSecondsForTime(time):
     if time:
@@ -109,21 +145,279 @@ class ChapterManager:
 
     return None
 
+class CreditsCache:
+  # Credits start times (and "no match") per title and duration, kept in a
+  # JSON file in the profile dir so replaying a movie needs no network at all.
+  # Entries expire after their TTL, the least recently used ones are dropped
+  # beyond the size cap.
+  def __init__(self, path, ttl=CREDITS_TTL, miss_ttl=CREDITS_MISS_TTL, size=CREDITS_CACHE_SIZE):
+    self.path = path
+    self.ttl = ttl
+    self.miss_ttl = miss_ttl
+    self.size = size
+    self.lock = threading.Lock()
+    self.entries = None # key -> [credits start or None, stored, last used]
+
+  @staticmethod
+  def key(title, duration):
+    # case, punctuation and spacing don't matter, durations within 5 seconds match
+    if isinstance(title, str):
+      title = title.decode("utf-8", "replace")
+    title = " ".join(re.sub(r"[\W_]+", " ", title.lower(), flags=re.UNICODE).split())
+    if duration:
+      return u"%s|%d" % (title, int(round(duration / 5.0)) * 5)
+    return title + u"|"
+
+  def _load(self):
+    if self.entries is None:
+      try:
+        with open(self.path) as f:
+          self.entries = json.load(f)
+      except (IOError, OSError, ValueError):
+        self.entries = {}
+
+  def _save(self):
+    tmp = self.path + ".tmp"
+    try:
+      with open(tmp, "w") as f:
+        json.dump(self.entries, f)
+      if os.path.exists(self.path):
+        os.remove(self.path) # no atomic replace on Windows
+      os.rename(tmp, self.path)
+    except (IOError, OSError):
+      pass # a cache that can't be written is just a cache miss next time
+
+  def get(self, title, duration):
+    # (True, credits start or None) for a cached answer, (False, None) otherwise
+    key = self.key(title, duration)
+    now = time.time()
+    with self.lock:
+      self._load()
+      entry = self.entries.get(key)
+      if entry is None:
+        return False, None
+      result, stored, used = entry
+      if now - stored > (self.ttl if result is not None else self.miss_ttl):
+        del self.entries[key]
+        return False, None
+      entry[2] = now # not saved for every hit, put() or the next expiry writes it
+      return True, result
+
+  def put(self, title, duration, result):
+    now = time.time()
+    with self.lock:
+      self._load()
+      self.entries[self.key(title, duration)] = [result, now, now]
+      if len(self.entries) > self.size:
+        by_use = sorted(self.entries, key=lambda k: self.entries[k][2])
+        for key in by_use[:len(self.entries) - self.size]:
+          del self.entries[key]
+      self._save()
+
+class CreditsLookup:
+  # Looks up the credits start in the background, so playback start (and
+  # dimming) doesn't wait for chapterdb. The queries with and without the
+  # duration run at the same time and the first valid answer is taken. The
+  # callback gets called once, with None when nothing was found in time.
+  # With a cache, known titles are answered right away and answers (including
+  # "no match", but not errors or timeouts) are stored. chapters, if given,
+  # returns the chapter starts embedded in the file; those are tried first.
+  def __init__(self, title, duration, callback, deadline=CREDITS_DEADLINE, cache=None, chapters=None):
+    self.title = title
+    self.duration = duration
+    self.callback = callback
+    self.cache = cache
+    self.deadline = time.time() + deadline
+    self.lock = threading.Lock()
+    self.done = False
+    self.failed = False
+    self.pending = 0
+    if chapters is None:
+      self._lookup(deadline)
+    else:
+      t = threading.Thread(target=self._local, args=(chapters,), name="KodiHueChapters")
+      t.daemon = True
+      t.start()
+
+  def _local(self, chapters):
+    try:
+      result = ChapterManager.CreditsStartForChapters(chapters(), self.duration)
+    except Exception:
+      result = None # not a file we can read, or no chapters in it
+    if result is None:
+      self._lookup(max(0.1, self.deadline - time.time())) # what's left of the deadline
+      return
+    with self.lock:
+      if self.done:
+        return
+      self.done = True
+    self.callback(result)
+
+  def _lookup(self, timeout):
+    if self.cache is not None:
+      hit, result = self.cache.get(self.title, self.duration)
+      if hit:
+        with self.lock:
+          if self.done:
+            return
+          self.done = True
+        self.callback(result)
+        return
+    durations = [None]
+    if self.duration:
+      durations.insert(0, self.duration)
+    self.pending = len(durations)
+    for d in durations:
+      t = threading.Thread(target=self._query, args=(self.title, d, timeout), name="KodiHueCredits")
+      t.daemon = True
+      t.start()
+
+  def _query(self, title, duration, timeout):
+    error = False
+    try:
+      result = ChapterManager.CreditsStartTimeForMovie(title, duration, timeout=timeout, fallback=False)
+    except Exception:
+      result = None # network error, timeout, bad XML: as good as no match
+      error = True
+    with self.lock:
+      self.pending -= 1
+      if error:
+        self.failed = True
+      if self.done:
+        return
+      if time.time() > self.deadline:
+        result = None
+        self.failed = True
+      elif result is None and self.pending > 0:
+        return # the other query may still find it
+      self.done = True
+      failed = self.failed
+    if self.cache is not None and (result is not None or not failed):
+      self.cache.put(self.title, self.duration, result)
+    self.callback(result)
+
+  def cancel(self):
+    # the answer isn't wanted anymore (playback stopped, next item started)
+    with self.lock:
+      self.done = True
+
+class CreditsScheduler:
+  # One thread for the whole session that sleeps until the credits are due.
+  # The player reports where playback is with sync(position, speed) on start,
+  # seek, pause (speed 0), resume and speed changes; the deadline is worked out
+  # from that instead of polling the playing time. When it's reached the real
+  # position is read once more (buffering makes playback fall behind the
+  # clock) and callback(position) runs. It also runs when a sync moves back
+  # before the credits after they fired, so the caller can rewind its state.
+  def __init__(self, callback, get_position):
+    self.callback = callback
+    self.get_position = get_position
+    self.cond = threading.Condition()
+    self.target = None # playing time of the credits, seconds
+    self.position = None # playing time at self.anchor
+    self.anchor = 0
+    self.speed = 0
+    self.fired = False
+    self.moved = False # synced since the last look
+    self.closed = False
+    self.thread = None
+
+  def set_target(self, target):
+    with self.cond:
+      self.target = target
+      self.fired = False
+      self._wake()
+
+  def sync(self, position, speed=1):
+    with self.cond:
+      self.position = position
+      self.anchor = time.time()
+      self.speed = speed
+      self.moved = True
+      self._wake()
+
+  def clear(self):
+    # playback stopped, nothing to wait for
+    with self.cond:
+      self.target = self.position = None
+      self.fired = False
+      self.cond.notify()
+
+  def close(self):
+    with self.cond:
+      self.closed = True
+      self.cond.notify()
+
+  def deadline(self):
+    # wall clock time the credits are due, None while there's nothing to wait for
+    if self.target is None or self.position is None or self.fired or self.speed <= 0:
+      return None
+    return self.anchor + (self.target - self.position) / float(self.speed)
+
+  def _wake(self):
+    if self.thread is None:
+      self.thread = threading.Thread(target=self._run, name="KodiHueCreditsTimer")
+      self.thread.daemon = True
+      self.thread.start()
+    self.cond.notify()
+
+  def _run(self):
+    while True:
+      with self.cond:
+        if self.closed:
+          return
+        rewound = self.moved and self.fired and self.position is not None and self.position < self.target
+        self.moved = False
+        if rewound:
+          self.fired = False
+        deadline = self.deadline()
+        now = time.time()
+        if not rewound and (deadline is None or deadline > now):
+          self.cond.wait(None if deadline is None else deadline - now)
+          continue
+        target = self.target
+        anchor = self.anchor
+        if rewound:
+          position = self.position
+        else:
+          self.fired = True
+      if not rewound:
+        try:
+          position = self.get_position()
+        except Exception:
+          position = None # playback just ended
+        if position is None:
+          continue
+        if position < target:
+          with self.cond: # behind the clock, wait for the rest
+            if self.fired and self.target == target and self.anchor == anchor:
+              self.position = position
+              self.anchor = time.time()
+              self.fired = False
+          continue
+      self.callback(position)
+
 ####################
 # END CREDITS CODE #
 ####################
 
 class Logger:
+  # log("light %s: %s", light, data) only formats when the message is
+  # written, so debuglog calls in hot paths cost next to nothing with debug off
   scriptname = "Kodi Hue"
   enabled = True
   debug_enabled = False
 
-  def log(self, msg):
+  def log(self, msg, *args):
     if self.enabled:
+      if args:
+        msg = msg % args
       xbmc.log("%s: %s" % (self.scriptname, msg))
 
-  def debuglog(self, msg):
+  def debuglog(self, msg, *args):
     if self.debug_enabled:
+      if args:
+        msg = msg % args
       self.log("DEBUG %s" % msg)
 
   def debug(self):
@@ -131,3 +425,42 @@ class Logger:
 
   def disable(self):
     self.enabled = False
+
+TRACE_SIZE = 2048
+# the service watches this window property, RunScript(...,action=dump_trace) sets it
+TRACE_PROPERTY = "script.kodi.hue.ambilight.trace"
+
+class Trace:
+  # Ring buffer of the last TRACE_SIZE events as (time, event, light, payload,
+  # latency) tuples. Recording is a deque append, so it can stay on while
+  # watching; the events are only formatted when dumped to a file.
+  enabled = False
+
+  def __init__(self, size=TRACE_SIZE):
+    self.events = deque(maxlen=size)
+
+  def add(self, event, light=None, payload=None, latency=None):
+    if self.enabled:
+      self.events.append((time.time(), event, light, payload, latency))
+
+  def clear(self):
+    self.events.clear()
+
+  def dump(self, path):
+    # writes the buffered events, oldest first, returns how many
+    events = list(self.events)
+    f = open(path, "w")
+    try:
+      for stamp, event, light, payload, latency in events:
+        if isinstance(light, str) and "/api/" in light:
+          light = "/".join(light.split("/")[5:]) # http://ip/api/user/lights/1/state
+        line = "%s.%03d %-6s %-16s %s" % (time.strftime("%H:%M:%S", time.localtime(stamp)),
+          int(stamp * 1000) % 1000, event, light if light is not None else "-", payload if payload is not None else "")
+        if latency is not None:
+          line += " (%.1fms)" % (latency * 1000)
+        f.write(line + "\n")
+    finally:
+      f.close()
+    return len(events)
+
+trace = Trace()
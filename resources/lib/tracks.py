@@ -0,0 +1,134 @@
+import os
+import mmap
+import struct
+import hashlib
+
+# color track setting values
+TRACKS_OFF = 0
+TRACKS_RECORD = 1
+TRACKS_REPLAY = 2 # record, and replay what's recorded
+
+TRACK_DIR = "tracks"
+TRACKS_KEPT = 50 # least recently played tracks go first
+TRACK_SLOT = 0.1 # seconds of playback per record
+TRACK_HOLD = 1.0 # seconds a color is held to fill the slots up to the next one
+
+# header: magic, record size, lights, slot length (ms), number of slots
+HEADER = struct.Struct(">4sHBHI")
+MAGIC = b"KHT1"
+# record: flag (0 means nothing recorded), scene, then per light
+# hue (0-65535), saturation and value (0-255)
+RECORD = struct.Struct(">BB")
+COLOR = struct.Struct(">HBB")
+
+def track_key(path, duration, signature=""):
+  # file name of the track for a file; signature covers the settings the
+  # colors depend on (lights, zones, color bias), a change starts a new track
+  if not isinstance(path, type(u"")):
+    path = path.decode("utf-8", "replace")
+  text = u"%s|%d|%s" % (path, int(round(duration)), signature)
+  return hashlib.sha1(text.encode("utf-8")).hexdigest() + ".trk"
+
+def prune_tracks(track_dir, kept=TRACKS_KEPT):
+  try:
+    names = [n for n in os.listdir(track_dir) if n.endswith(".trk")]
+  except OSError:
+    return
+  if len(names) <= kept:
+    return
+  paths = sorted((os.path.join(track_dir, n) for n in names), key=os.path.getmtime)
+  for path in paths[:len(paths) - kept]:
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+def _scale(value, top):
+  return int(round(min(max(value, 0.0), 1.0) * top))
+
+class ColorTrack:
+  # The per-light target colors of a title by playing time, one fixed size
+  # record per TRACK_SLOT seconds, so a record is found by its offset and a
+  # seek is just another offset. The file is memory-mapped; records that were
+  # never written (parts not watched yet) read as gaps.
+  def __init__(self, path, lights, duration, slot=TRACK_SLOT):
+    self.path = path
+    self.lights = lights
+    self.slot = slot
+    self.slots = int(duration / slot) + 1
+    self.record_size = RECORD.size + COLOR.size * lights
+    size = HEADER.size + self.slots * self.record_size
+    header = HEADER.pack(MAGIC, self.record_size, lights, int(slot * 1000), self.slots)
+
+    self.file = None
+    if os.path.exists(path) and os.path.getsize(path) == size:
+      self.file = open(path, "r+b")
+      if self.file.read(HEADER.size) != header:
+        self.file.close()
+        self.file = None # another layout, start over
+      else:
+        os.utime(path, None) # recently played, kept longer
+    if self.file is None:
+      self.file = open(path, "w+b")
+      self.file.write(header)
+      self.file.truncate(size) # the rest reads as zeros: nothing recorded
+    self.file.flush()
+    self.map = mmap.mmap(self.file.fileno(), size)
+    self.last_slot = None
+    self.last_colors = None
+    self.written = 0
+
+  def _slot(self, t):
+    slot = int(t / self.slot)
+    if slot < 0 or slot >= self.slots:
+      return None
+    return slot
+
+  def read(self, t):
+    # (scene, [(h, s, v), ...] with 0-1 floats) at playing time t, None for a gap
+    slot = self._slot(t)
+    if slot is None:
+      return None
+    offset = HEADER.size + slot * self.record_size
+    flag, scene = RECORD.unpack_from(self.map, offset)
+    if not flag:
+      return None
+    colors = []
+    offset += RECORD.size
+    for i in range(self.lights):
+      h, s, v = COLOR.unpack_from(self.map, offset)
+      colors.append((h / 65535.0, s / 255.0, v / 255.0))
+      offset += COLOR.size
+    return scene, colors
+
+  def write(self, t, colors, scene=0):
+    # colors: (h, s, v) per light, 0-1 floats. The slots since the last write
+    # (when it was just before) get the last colors, that's what was showing.
+    slot = self._slot(t)
+    if slot is None or len(colors) != self.lights:
+      return
+    record = RECORD.pack(1, scene % 256) + b"".join(COLOR.pack(_scale(h, 65535), _scale(s, 255), _scale(v, 255))
+      for h, s, v in colors)
+    if self.last_slot is not None and self.last_slot < slot <= self.last_slot + int(TRACK_HOLD / self.slot):
+      for held in range(self.last_slot + 1, slot):
+        self._put(held, self.last_colors)
+    self._put(slot, record)
+    self.last_slot = slot
+    self.last_colors = record
+    self.written += 1
+
+  def _put(self, slot, record):
+    offset = HEADER.size + slot * self.record_size
+    self.map[offset:offset + self.record_size] = record
+
+  def seeked(self):
+    # don't hold colors across a jump
+    self.last_slot = None
+
+  def close(self):
+    self.map.flush()
+    self.map.close()
+    self.file.close()
+
+  def __repr__(self):
+    return 'track: %s lights: %s slots: %s written: %s' % (os.path.basename(self.path), self.lights, self.slots, self.written)
@@ -0,0 +1,141 @@
+from spectrum import *
+
+# light zone setting values
+ZONE_SCREEN = 0
+ZONE_LEFT = 1
+ZONE_RIGHT = 2
+ZONE_TOP = 3
+ZONE_BOTTOM = 4
+ZONE_CUSTOM = 5
+
+# (left, top, right, bottom) as fractions of the screen
+ZONE_RECTS = {
+  ZONE_SCREEN: (0.0, 0.0, 1.0, 1.0),
+  ZONE_LEFT: (0.0, 0.0, 1 / 3.0, 1.0),
+  ZONE_RIGHT: (2 / 3.0, 0.0, 1.0, 1.0),
+  ZONE_TOP: (0.0, 0.0, 1.0, 1 / 3.0),
+  ZONE_BOTTOM: (0.0, 2 / 3.0, 1.0, 1.0),
+}
+
+def parse_rect(text):
+  # "left,top,right,bottom" in percent, e.g. "0,0,30,100"
+  try:
+    left, top, right, bottom = [min(max(float(p), 0.0), 100.0) / 100.0 for p in text.split(",")]
+  except ValueError:
+    return ZONE_RECTS[ZONE_SCREEN]
+  if right <= left or bottom <= top:
+    return ZONE_RECTS[ZONE_SCREEN]
+  return left, top, right, bottom
+
+def zone_rect(zone, custom=""):
+  if zone == ZONE_CUSTOM:
+    return parse_rect(custom)
+  return ZONE_RECTS.get(zone, ZONE_RECTS[ZONE_SCREEN])
+
+def _ramp(pos, low, high, falloff):
+  # 1 inside [low, high], fading linearly to 0 over falloff outside of it
+  if low <= pos <= high:
+    return 1.0
+  if falloff <= 0:
+    return 0.0
+  distance = low - pos if pos < low else pos - high
+  return max(0.0, 1.0 - distance / falloff)
+
+class ZoneMap:
+  # Screen zone per light, compiled into per-pixel weights for the current
+  # capture size so a single pass over the frame gives every light its own
+  # histogram. Only recompiled when the capture size (or aspect ratio) changes.
+  def __init__(self, rects, falloff):
+    self.rects = rects
+    self.falloff = falloff
+    self.size = None
+    self.weights = None  # numpy: lights x pixels
+    self.pixel_weights = None  # pure python: per pixel [(light, weight)]
+
+  def compile(self, width, height):
+    if self.size == (width, height):
+      return
+    self.size = (width, height)
+    rows = []
+    for left, top, right, bottom in self.rects:
+      row = []
+      for y in range(height):
+        wy = _ramp((y + 0.5) / height, top, bottom, self.falloff)
+        for x in range(width):
+          row.append(wy * _ramp((x + 0.5) / width, left, right, self.falloff))
+      rows.append(row)
+
+    if numpy is not None:
+      self.weights = numpy.array(rows)
+    else:
+      self.pixel_weights = [[(l, rows[l][i]) for l in range(len(rows)) if rows[l][i] > 0]
+        for i in range(width * height)]
+
+  def spectra(self, pixels, width, height, rgba=True, cache_dir=None):
+    # one (spectrum, saturation, value, size, overall_value) per light
+    self.compile(width, height)
+    if numpy is not None:
+      h, s, v = hsv_numpy(pixels, rgba)
+      if len(v) != self.weights.shape[1]:
+        raise ZeroDivisionError("capture size changed")
+      return [histogram_numpy(h, s, v, w) for w in self.weights]
+    return self._spectra_lut(pixels, rgba, cache_dir)
+
+  def _spectra_lut(self, pixels, rgba, cache_dir):
+    bins, sats, vals = load_lut(cache_dir)
+    size = int(len(pixels) / 4)
+    if size == 0 or size != len(self.pixel_weights):
+      raise ZeroDivisionError("empty capture")
+
+    shift = 8 - LUT_BITS
+    gshift = LUT_BITS
+    rshift = LUT_BITS * 2
+    if rgba:
+      reds, blues = pixels[0:size * 4:4], pixels[2:size * 4:4]
+    else: #probably BGRA
+      reds, blues = pixels[2:size * 4:4], pixels[0:size * 4:4]
+    greens = pixels[1:size * 4:4]
+
+    lights = len(self.rects)
+    counts = [[0.0] * 360 for l in range(lights)]
+    sat_sum = [[0.0] * 360 for l in range(lights)]
+    val_sum = [[0.0] * 360 for l in range(lights)]
+    total = [0.0] * lights
+    v = [0.0] * lights
+    for r, g, b, weights in zip(reds, greens, blues, self.pixel_weights):
+      i = ((r >> shift) << rshift) | ((g >> shift) << gshift) | (b >> shift)
+      h = bins[i]
+      for l, w in weights:
+        total[l] += w
+        v[l] += vals[i] * w
+        if h >= 0:
+          counts[l][h] += w
+          sat_sum[l][h] += sats[i] * w
+          val_sum[l][h] += vals[i] * w
+
+    result = []
+    for l in range(lights):
+      if total[l] == 0:
+        raise ZeroDivisionError("empty zone")
+      spectrum = {}
+      saturation = {}
+      value = {}
+      for h in range(360):
+        n = counts[l][h]
+        if n:
+          spectrum[h] = n
+          saturation[h] = sat_sum[l][h] / n
+          value[h] = val_sum[l][h] / n
+      result.append((spectrum, saturation, value, total[l], v[l] / total[l]))
+    return result
+
+def zone_map(settings):
+  # None when every light looks at the whole screen (popularity mode)
+  if settings.light == 0:
+    return None
+  zones = [(settings.light1_zone, settings.light1_zone_rect),
+    (settings.light2_zone, settings.light2_zone_rect),
+    (settings.light3_zone, settings.light3_zone_rect)][:settings.light]
+  if all(zone == ZONE_SCREEN for zone, custom in zones):
+    return None
+  return ZoneMap([zone_rect(zone, custom) for zone, custom in zones], settings.zone_falloff / 100.0)
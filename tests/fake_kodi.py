@@ -0,0 +1,106 @@
+import os
+import sys
+import types
+import tempfile
+import xml.etree.ElementTree as ET
+
+# Just enough of Kodi's xbmc, xbmcgui and xbmcaddon modules to load default.py
+# outside Kodi, for tests and benchmarks. Settings answer with the defaults
+# from resources/settings.xml unless a test overrides them (SETTINGS).
+
+SETTINGS = {}
+FRAME_SIZE = (16, 9)
+FRAME = bytearray([200, 40, 40, 255] * (FRAME_SIZE[0] * FRAME_SIZE[1]))
+
+def setting_defaults(path="./resources/settings.xml"):
+	return dict((s.get("id"), s.get("default", "")) for s in ET.parse(path).iter("setting") if s.get("id"))
+
+def fake_kodi(profile):
+	if 'xbmc' in sys.modules:
+		return
+	defaults = setting_defaults()
+	xbmc = types.ModuleType('xbmc')
+	xbmc.log = lambda msg, level=0: None
+	xbmc.sleep = lambda ms: None
+	xbmc.translatePath = lambda path: path
+	xbmc.executebuiltin = lambda cmd: None
+	xbmc.executeJSONRPC = lambda cmd: '{}'
+	xbmc.getInfoLabel = lambda label: ""
+	xbmc.getCondVisibility = lambda cond: False
+	xbmc.CAPTURE_STATE_DONE = 3
+	xbmc.CAPTURE_FLAG_CONTINUOUS = 1
+	xbmcgui = types.ModuleType('xbmcgui')
+	xbmcaddon = types.ModuleType('xbmcaddon')
+
+	class Addon():
+		def getAddonInfo(self, key):
+			if key == 'profile':
+				return profile
+			return os.path.abspath(".")
+		def getSetting(self, key):
+			return SETTINGS.get(key, defaults.get(key, ""))
+		def setSetting(self, key, value):
+			SETTINGS[key] = value
+
+	class Monitor():
+		# the service loop runs once, then Kodi "shuts down"
+		def __init__(self):
+			pass
+		def abortRequested(self):
+			return False
+		def waitForAbort(self, timeout=None):
+			return True
+
+	class Player():
+		def __init__(self):
+			pass
+		def isPlayingVideo(self):
+			return True
+		def getTime(self):
+			return 0.0
+
+	class RenderCapture():
+		# every wait delivers FRAME
+		def getImageFormat(self):
+			return 'RGBA'
+		def capture(self, width, height, flags=0):
+			pass
+		def waitForCaptureStateChangeEvent(self, timeout=0):
+			return True
+		def getCaptureState(self):
+			return xbmc.CAPTURE_STATE_DONE
+		def getImage(self):
+			return FRAME
+		def getWidth(self):
+			return FRAME_SIZE[0]
+		def getHeight(self):
+			return FRAME_SIZE[1]
+		def getAspectRatio(self):
+			return float(FRAME_SIZE[0]) / FRAME_SIZE[1]
+
+	class Window():
+		properties = {}
+		def __init__(self, id):
+			pass
+		def getProperty(self, key):
+			return self.properties.get(key, "")
+		def setProperty(self, key, value):
+			self.properties[key] = value
+		def clearProperty(self, key):
+			self.properties.pop(key, None)
+
+	xbmc.Monitor = Monitor
+	xbmc.Player = Player
+	xbmc.RenderCapture = RenderCapture
+	xbmcgui.Window = Window
+	xbmcaddon.Addon = Addon
+	sys.modules['xbmc'] = xbmc
+	sys.modules['xbmcgui'] = xbmcgui
+	sys.modules['xbmcaddon'] = xbmcaddon
+	sys.modules['__main__'].__addon__ = Addon()
+
+def load_addon(name):
+	# default.py as a module, with its own profile dir
+	fake_kodi(tempfile.mkdtemp())
+	import imp
+	return imp.load_source(name, "./default.py")
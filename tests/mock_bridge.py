@@ -0,0 +1,304 @@
+import json
+import random
+import re
+import socket
+import threading
+import time
+
+try:
+	from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+	from SocketServer import ThreadingMixIn
+except ImportError:
+	from http.server import HTTPServer, BaseHTTPRequestHandler
+	from socketserver import ThreadingMixIn
+
+# Local stand-in for a Hue bridge (v1 REST API), for tests and load runs that
+# must not need a physical bridge. Implements what the add-on talks to:
+#
+#   POST /api                                  register (with client key)
+#   GET  /api/<user>                           the full state
+#   GET  /api/<user>/config
+#   GET  /api/<user>/lights, /lights/<id>
+#   PUT  /api/<user>/lights/<id>/state
+#   GET  /api/<user>/groups, /groups/<id>
+#   PUT  /api/<user>/groups/<id>/action, /groups/<id>
+#
+# Every request is answered after latency +- jitter seconds. error_rate is the
+# share of commands answered with an internal error, drop_rate the share of
+# requests whose connection is closed without an answer. Like the real bridge
+# only light_rate light commands and group_rate group commands per second are
+# taken, the rest is refused (error 901, HTTP 503). Every request is recorded
+# as a Command, so tests can check throughput, ordering and what got dropped.
+#
+#   python tests/mock_bridge.py --lights 30 --latency 0.05   serves on port 8080
+
+USERNAME = "mockuser"
+CLIENTKEY = "00112233445566778899AABBCCDDEEFF"
+ROUTE = re.compile(r"^/api/([^/]+)(?:/(config|lights|groups)(?:/(\d+))?(?:/(state|action))?)?/?$")
+
+class Command():
+	# one request as the bridge saw it
+	def __init__(self, stamp, method, path, body, status, resource=None, id=None):
+		self.time = stamp
+		self.method = method
+		self.path = path
+		self.body = body
+		self.status = status # ok, refused (rate limit), error, dropped
+		self.resource = resource
+		self.id = id
+
+	def __repr__(self):
+		return "%.3f %s %s %s %s" % (self.time, self.method, self.path, self.status, self.body)
+
+class RateLimit():
+	def __init__(self, rate):
+		self.rate = rate
+		self.tokens = rate
+		self.stamp = time.time()
+
+	def take(self):
+		if not self.rate:
+			return True
+		now = time.time()
+		self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+		self.stamp = now
+		if self.tokens < 1:
+			return False
+		self.tokens -= 1
+		return True
+
+def mock_light(light_id, color=True):
+	state = {"on": True, "bri": 200, "alert": "none", "reachable": True}
+	if color:
+		state.update({"hue": 10000, "sat": 200, "xy": [0.4, 0.4], "ct": 300,
+			"effect": "none", "colormode": "hs"})
+	return {"state": state, "type": color and "Extended color light" or "Dimmable light",
+		"name": "Mock light %s" % light_id, "modelid": color and "LCT007" or "LWB006",
+		"swversion": "5.105.0.21169"}
+
+class MockBridge(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, lights=3, groups=None, port=0, latency=0.0, jitter=0.0,
+			error_rate=0.0, drop_rate=0.0, light_rate=10, group_rate=1, seed=None):
+		HTTPServer.__init__(self, ("127.0.0.1", port), MockBridgeHandler)
+		self.port = self.server_address[1]
+		self.ip = "127.0.0.1:%d" % self.port
+		self.latency = latency
+		self.jitter = jitter
+		self.error_rate = error_rate
+		self.drop_rate = drop_rate
+		self.light_rate = light_rate
+		self.group_rate = group_rate
+		self.random = random.Random(seed)
+		self.link_button = True
+		self.users = {USERNAME: CLIENTKEY}
+		self.lock = threading.Lock()
+		self.commands = []
+		self.limits = {}
+		self.lights = dict((str(i), mock_light(i)) for i in range(1, lights + 1))
+		if groups is None:
+			groups = {1: list(range(1, lights + 1))}
+		self.groups = {}
+		for group_id, members in groups.items():
+			self.groups[str(group_id)] = {"name": "Mock group %s" % group_id, "type": "LightGroup",
+				"lights": [str(l) for l in members], "action": dict(self.lights[str(members[0])]["state"])}
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.serve_forever, name="MockBridge")
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+		self.thread.join()
+
+	def handle_error(self, request, client_address):
+		pass # clients going away (timeouts, dropped connections) are expected
+
+	def record(self, command):
+		with self.lock:
+			self.commands.append(command)
+
+	def reset(self):
+		with self.lock:
+			self.commands = []
+			self.limits = {}
+
+	def puts(self, resource=None, status="ok"):
+		# recorded commands (PUTs) for lights or groups, by default the applied ones
+		with self.lock:
+			return [c for c in self.commands if c.method == "PUT" and \
+				(resource is None or c.resource == resource) and (status is None or c.status == status)]
+
+	def wait_for(self, count, timeout=5, resource=None, status="ok"):
+		# waits until count commands were recorded, returns them
+		deadline = time.time() + timeout
+		while len(self.puts(resource, status)) < count and time.time() < deadline:
+			time.sleep(0.01)
+		return self.puts(resource, status)
+
+	def rate_limit(self, resource):
+		with self.lock:
+			limit = self.limits.get(resource)
+			if limit is None:
+				limit = self.limits[resource] = RateLimit(self.light_rate if resource == "lights" else self.group_rate)
+			return limit.take()
+
+	def apply(self, resource, id, body):
+		with self.lock:
+			if resource == "lights":
+				targets = [self.lights[id]["state"]]
+			elif "stream" in body:
+				self.groups[id]["stream"] = dict(body["stream"])
+				return
+			elif id == "0":
+				targets = [l["state"] for l in self.lights.values()]
+			else:
+				group = self.groups[id]
+				targets = [group["action"]] + [self.lights[l]["state"] for l in group["lights"]]
+			for state in targets:
+				for key, value in body.items():
+					if key != "transitiontime":
+						state[key] = value
+
+	def config(self):
+		return {"name": "Mock bridge", "apiversion": "1.24.0", "swversion": "1935144040",
+			"bridgeid": "001788FFFE000000", "modelid": "BSB002", "ipaddress": self.ip}
+
+	def group_zero(self):
+		with self.lock:
+			return {"name": "Lightset 0", "type": "LightGroup", "lights": sorted(self.lights.keys(), key=int),
+				"action": dict(self.lights[sorted(self.lights.keys(), key=int)[0]]["state"])}
+
+def error(type, address, description):
+	return [{"error": {"type": type, "address": address, "description": description}}]
+
+class MockBridgeHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1" # keep-alive, like the bridge
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		self.handle_request("GET")
+
+	def do_PUT(self):
+		self.handle_request("PUT")
+
+	def do_POST(self):
+		self.handle_request("POST")
+
+	def handle_request(self, method):
+		bridge = self.server
+		stamp = time.time()
+		length = int(self.headers.get("Content-Length") or 0)
+		raw = self.rfile.read(length) if length else b""
+		try:
+			body = json.loads(raw.decode("utf-8")) if raw else {}
+		except ValueError:
+			body = None
+
+		delay = bridge.latency + bridge.random.uniform(-bridge.jitter, bridge.jitter)
+		if delay > 0:
+			time.sleep(delay)
+
+		match = ROUTE.match(self.path)
+		resource, id = match and match.group(2), match and match.group(3)
+		command = Command(stamp, method, self.path, body, "ok", resource, id)
+		bridge.record(command)
+
+		if bridge.drop_rate and bridge.random.random() < bridge.drop_rate:
+			command.status = "dropped"
+			self.close_connection = True
+			self.connection.shutdown(socket.SHUT_RDWR)
+			return
+		if method == "PUT" and bridge.error_rate and bridge.random.random() < bridge.error_rate:
+			command.status = "error"
+			return self.reply(error(901, self.path, "Internal error, 500"), 500)
+
+		if self.path.rstrip("/") == "/api" and method == "POST":
+			return self.register(command, body)
+		if match is None:
+			return self.reply(error(4, self.path, "method, %s, not available for resource, %s" % (method, self.path)))
+		user, action = match.group(1), match.group(4)
+		if user not in bridge.users:
+			command.status = "unauthorized"
+			return self.reply(error(1, self.path, "unauthorized user"))
+		if body is None:
+			command.status = "error"
+			return self.reply(error(2, self.path, "body contains invalid json"))
+
+		if resource == "config":
+			return self.reply(bridge.config())
+		if resource is None and method == "GET":
+			with bridge.lock:
+				return self.reply({"lights": bridge.lights, "groups": bridge.groups, "config": bridge.config()})
+
+		item = None
+		if resource == "groups" and id == "0":
+			item = bridge.group_zero()
+		elif resource in ("lights", "groups"):
+			items = resource == "lights" and bridge.lights or bridge.groups
+			if id is None:
+				return self.reply(items)
+			item = items.get(id)
+		if item is None:
+			command.status = "error"
+			address = "/" + "/".join(part for part in (resource, id) if part)
+			return self.reply(error(3, address, "resource, %s, not available" % address))
+		if method == "GET":
+			return self.reply(item)
+
+		if "stream" not in body and not bridge.rate_limit(resource): # the limit is for light and group commands
+			command.status = "refused"
+			return self.reply(error(901, self.path, "Internal error, 503"), 503)
+		bridge.apply(resource, id, body)
+		base = "/%s/%s/%s" % (resource, id, action or "")
+		return self.reply([{"success": {base.rstrip("/") + "/" + key: value}} for key, value in body.items()])
+
+	def register(self, command, body):
+		bridge = self.server
+		if not bridge.link_button:
+			command.status = "error"
+			return self.reply(error(101, "", "link button not pressed"))
+		username = "%s%d" % (USERNAME, len(bridge.users))
+		bridge.users[username] = CLIENTKEY
+		success = {"username": username}
+		if body and body.get("generateclientkey"):
+			success["clientkey"] = CLIENTKEY
+		return self.reply([{"success": success}])
+
+	def reply(self, data, status=200):
+		payload = json.dumps(data).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(payload)))
+		self.end_headers()
+		self.wfile.write(payload)
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="Mock Hue bridge (user %s)" % USERNAME)
+	parser.add_argument("--port", type=int, default=8080)
+	parser.add_argument("--lights", type=int, default=3)
+	parser.add_argument("--latency", type=float, default=0.0)
+	parser.add_argument("--jitter", type=float, default=0.0)
+	parser.add_argument("--error-rate", type=float, default=0.0)
+	parser.add_argument("--drop-rate", type=float, default=0.0)
+	parser.add_argument("--light-rate", type=float, default=10)
+	parser.add_argument("--group-rate", type=float, default=1)
+	args = parser.parse_args()
+	bridge = MockBridge(args.lights, port=args.port, latency=args.latency, jitter=args.jitter,
+		error_rate=args.error_rate, drop_rate=args.drop_rate, light_rate=args.light_rate,
+		group_rate=args.group_rate)
+	print("mock bridge at %s, user %s" % (bridge.ip, USERNAME))
+	try:
+		bridge.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	print("\n".join(repr(c) for c in bridge.commands))
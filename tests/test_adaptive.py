@@ -0,0 +1,77 @@
+from nose.tools import *
+import os
+os.sys.path.append("./resources/lib/")
+
+from adaptive import *
+
+class Settings():
+	def __init__(self, adaptive_capture=True, capture_min_width=16, capture_max_width=64, capture_min_rate=2, capture_max_rate=20):
+		self.adaptive_capture = adaptive_capture
+		self.capture_min_width = capture_min_width
+		self.capture_max_width = capture_max_width
+		self.capture_min_rate = capture_min_rate
+		self.capture_max_rate = capture_max_rate
+
+def window(controller, analysis_time, frames=10, send_latency=0.0):
+	# one full window of frames that took analysis_time each
+	controller.start_window(0.0)
+	for i in range(frames):
+		controller.frame(analysis_time)
+	return controller.update(CaptureController.WINDOW, send_latency)
+
+def test_snaps_into_the_bounds():
+	c = CaptureController(Settings(capture_min_width=20, capture_max_width=100), width=8, interval=0.01)
+	eq_((c.width, c.interval), (24, 0.05))
+	c.configure(Settings(capture_min_width=48))
+	eq_(c.width, 48)
+
+def test_overrun_shrinks_the_capture():
+	c = CaptureController(Settings(), width=32, interval=0.1)
+	ok_(window(c, 0.06)) # more than half of the frame budget
+	eq_((c.width, c.interval), (24, 0.1))
+
+def test_overrun_at_the_smallest_capture_slows_down():
+	c = CaptureController(Settings(), width=16, interval=0.1)
+	ok_(not window(c, 0.06))
+	eq_(c.width, 16)
+	eq_(c.interval, 0.1 * CaptureController.STEP)
+	c.interval = 0.5
+	window(c, 0.4)
+	eq_(c.interval, 0.5) # not slower than capture_min_rate
+
+def test_spare_time_speeds_up_then_grows():
+	c = CaptureController(Settings(), width=32, interval=0.08)
+	ok_(not window(c, 0.001))
+	eq_((c.width, c.interval), (32, 0.08 / CaptureController.STEP))
+	while c.interval > 0.05:
+		ok_(not window(c, 0.001))
+	eq_((c.width, c.interval), (32, 0.05)) # capture_max_rate
+	ok_(window(c, 0.001))
+	eq_((c.width, c.interval), (48, 0.05))
+
+def test_in_budget_stays():
+	c = CaptureController(Settings(), width=32, interval=0.1)
+	ok_(not window(c, 0.03))
+	eq_((c.width, c.interval), (32, 0.1))
+
+def test_bridge_latency_limits_the_rate():
+	c = CaptureController(Settings(), width=32, interval=0.1)
+	ok_(window(c, 0.001, send_latency=0.2)) # grows instead of speeding up
+	eq_((c.width, c.interval), (48, 0.2))
+	window(c, 0.03, send_latency=1.0)
+	eq_(c.interval, 0.5)
+
+def test_nothing_to_learn():
+	c = CaptureController(Settings(), width=32, interval=0.1)
+	ok_(not window(c, 0.06, frames=0)) # paused, menus
+	eq_((c.width, c.interval), (32, 0.1))
+	c.start_window(0.0)
+	c.frame(0.06)
+	ok_(not c.update(CaptureController.WINDOW / 2)) # window not over yet
+	eq_(c.width, 32)
+
+def test_disabled():
+	c = CaptureController(Settings(adaptive_capture=False), width=32, interval=0.1)
+	ok_(not window(c, 0.06))
+	ok_(not window(c, 0.001))
+	eq_((c.width, c.interval), (32, 0.1))
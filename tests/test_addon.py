@@ -0,0 +1,94 @@
+from nose.tools import *
+import os
+import time
+os.sys.path.append("./resources/lib/")
+os.sys.path.append("./tests/")
+
+# default.py's playback handling against the local mock bridge, with Kodi
+# faked: NOSE=1 nosetests tests/test_addon.py
+
+NOSE = os.environ.get('NOSE', None)
+ok_(NOSE != None, "NOSE not set")
+
+import fake_kodi
+from mock_bridge import *
+
+addon = fake_kodi.load_addon('kodi_hue_addon')
+
+from hue import *
+
+class HueUnderTest(Hue):
+	# the lights of a Hue without the Kodi parts of its constructor
+	def __init__(self, settings):
+		self.logger = Logger()
+		self.settings = settings
+		self.update_settings()
+
+def with_addon(**kwargs):
+	bridge = MockBridge(**kwargs).start()
+	fake_kodi.SETTINGS.update(bridge_ip=bridge.ip, bridge_user=USERNAME, force_light_on="true",
+		dim_time="0", override_paused="true", paused_bri="30", override_undim_bri="true", undim_bri="100",
+		ambilight_pipeline="false") # frames go out from the loop, run() can't stop the sender before it sent
+	addon.logger = Logger()
+	addon.logger.disable() # xbmc.log isn't there
+	addon.hue = HueUnderTest(addon.MySettings())
+	return bridge
+
+def settles_at(bridge, bri, timeout=5):
+	# light 1 reaches bri, and nothing queued before changes it afterwards
+	deadline = time.time() + timeout
+	while bridge.lights["1"]["state"]["bri"] != bri and time.time() < deadline:
+		time.sleep(0.01)
+	time.sleep(0.2)
+	return bridge.lights["1"]["state"]["bri"] == bri
+
+def teardown():
+	stop_schedulers()
+
+def test_pause_goes_to_paused_brightness():
+	bridge = with_addon(latency=0.05)
+	light = addon.hue.light[0]
+	for bri in range(100, 110):
+		light.set_light2(1000, 100, bri, 0, PRIORITY_AMBILIGHT)
+	addon.hue.last_state = "dimmed"
+	addon.state_changed("paused", 600)
+	eq_(addon.hue.last_state, "partial")
+	ok_(settles_at(bridge, 76)) # 30% of 254, no ambilight frame after it
+	bridge.stop()
+
+def test_stop_undims():
+	bridge = with_addon()
+	addon.hue.light[0].set_light2(1000, 100, 50, 0, PRIORITY_AMBILIGHT)
+	addon.state_changed("stopped", 600)
+	eq_(addon.hue.last_state, "brighter")
+	ok_(settles_at(bridge, 254))
+	bridge.stop()
+
+def run_once(bridge):
+	addon.MyPlayer.playingvideo = True
+	try:
+		addon.run() # one iteration, then the fake monitor aborts
+	finally:
+		addon.MyPlayer.playingvideo = False
+	command = bridge.wait_for(1)[0]
+	eq_(command.path, "/api/%s/lights/1/state" % USERNAME)
+	return command.body
+
+def test_ambilight_loop_sends_the_frame():
+	bridge = with_addon()
+	body = run_once(bridge)
+	ok_("xy" not in body, body) # hue/sat unless xy output is chosen
+	eq_(body["hue"], 0) # the red test frame
+	bridge.stop()
+
+def test_ambilight_loop_sends_xy():
+	bridge = with_addon()
+	fake_kodi.SETTINGS["color_output"] = "1"
+	addon.hue = HueUnderTest(addon.MySettings())
+	try:
+		body = run_once(bridge)
+	finally:
+		del fake_kodi.SETTINGS["color_output"]
+	ok_("xy" in body and "hue" not in body, body) # gamut clipped
+	ok_(body["xy"][0] > 0.5, body)
+	bridge.stop()
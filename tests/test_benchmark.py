@@ -0,0 +1,235 @@
+from nose.tools import *
+from nose.plugins.skip import SkipTest
+import os
+import sys
+import gc
+import glob
+import json
+import time
+import random
+os.sys.path.append("./resources/lib/")
+os.sys.path.append("./tests/")
+
+import fake_kodi
+
+# Offline micro-benchmarks for the ambilight color pipeline. No bridge and no
+# Kodi needed: default.py is loaded with just enough of Kodi around it.
+#
+#   python tests/test_benchmark.py              prints the results
+#   python tests/test_benchmark.py --update     writes a new baseline
+#   BENCH=1 NOSE=1 nosetests tests/test_benchmark.py
+#                                               fails on a regression
+#
+# Timings depend on the machine and its load, so there's no baseline in the
+# repository and the regression test is opt-in (BENCH=1). The baseline is
+# local to the box that runs the suite and not committed (.gitignore): the
+# first opted-in run writes it, later ones compare against it. BENCH_BASELINE
+# picks another file. Recorded frames can be dropped in tests/frames as raw
+# RGBA dumps named <name>-<width>x<height>.rgba, they are benchmarked next to
+# the synthetic ones.
+#
+# Allocations (peak KB per call) come from tracemalloc, which needs Python
+# 3.4 or later. Kodi's Python 2 has nothing comparable per call, so there
+# only the timings are reported.
+
+BASELINE = os.environ.get('BENCH_BASELINE') or "./tests/benchmark_baseline.json"
+TOLERANCE = float(os.environ.get('BENCH_TOLERANCE', 25)) # percent
+FRAMES = "./tests/frames"
+SIZES = [(16, 9), (32, 18), (64, 36)]
+REPEAT = 7
+RUN_TIME = 0.02 # seconds per measurement run
+NOISE = 20e-6 # seconds, differences below this are timer/scheduler noise
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+class settings():
+	mode		= 0 # ambilight
+	light		= 3
+	ambilight_min	= 0
+	ambilight_max	= 229
+	color_bias	= 18
+	smoothing	= 1 # exponential
+	smoothing_time	= 200
+	delta_e		= 2
+	debug		= False
+
+class hue():
+	settings	= settings()
+	stream		= None
+
+class light():
+	# stands in for hue.Light, records instead of talking to a bridge
+	group		= False
+	fullSpectrum	= False
+	light		= 1
+	gamut		= None
+	hueLast		= 0
+	satLast		= 0
+	valLast		= 0
+
+	def set_light2(self, hue, sat, bri, duration=None, priority=None, xy=None):
+		self.hueLast, self.satLast, self.valLast = hue, sat, bri
+
+def load_addon():
+	addon = fake_kodi.load_addon('kodi_hue_default')
+	addon.hue = hue()
+	addon.settings = hue.settings
+	addon.smoothing = addon.Smoothing(hue.settings)
+	return addon
+
+def synthetic_frames(width, height):
+	rnd = random.Random(width * height)
+	frames = {}
+	frames['noise'] = bytearray(rnd.randrange(256) for i in range(width * height * 4))
+	gradient = bytearray()
+	for y in range(height):
+		for x in range(width):
+			gradient += bytearray([x * 255 // width, y * 255 // height, 128, 255])
+	frames['gradient'] = gradient
+	frames['dark'] = bytearray([8, 8, 12, 255] * (width * height))
+	return frames
+
+def recorded_frames():
+	frames = {}
+	for path in sorted(glob.glob(os.path.join(FRAMES, "*.rgba"))):
+		name, size = os.path.basename(path)[:-5].rsplit("-", 1)
+		width, height = [int(n) for n in size.split("x")]
+		frames[(name, width, height)] = bytearray(open(path, "rb").read())
+	return frames
+
+def to_bgra(pixels):
+	bgra = bytearray(pixels)
+	bgra[0::4], bgra[2::4] = pixels[2::4], pixels[0::4]
+	return bgra
+
+def measure(func):
+	# best of REPEAT runs (seconds per call) and the peak allocation of one call
+	func() # warm up (lookup table, caches) before calibrating
+	start = time.time()
+	func()
+	number = max(1, int(RUN_TIME / max(time.time() - start, 1e-6)))
+	best = None
+	for i in range(REPEAT):
+		gc.collect()
+		start = time.time()
+		for j in range(number):
+			func()
+		elapsed = (time.time() - start) / number
+		if best is None or elapsed < best:
+			best = elapsed
+	peak = None
+	if tracemalloc is not None:
+		tracemalloc.start()
+		func()
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+	return best, peak
+
+def run_benchmarks():
+	addon = load_addon()
+	engines = ['lut']
+	if addon.numpy is not None:
+		engines.append('numpy')
+	numpy = addon.numpy
+
+	inputs = []
+	for width, height in SIZES:
+		for name, pixels in sorted(synthetic_frames(width, height).items()):
+			inputs.append((name, width, height, pixels))
+	for (name, width, height), pixels in sorted(recorded_frames().items()):
+		inputs.append((name, width, height, pixels))
+
+	results = {}
+	for name, width, height, rgba in inputs:
+		for fmt in ['RGBA', 'BGRA']:
+			pixels = rgba if fmt == 'RGBA' else to_bgra(rgba)
+			addon.fmtRGBA = fmt == 'RGBA'
+			for engine in engines:
+				addon.numpy = numpy if engine == 'numpy' else None
+				screen = addon.Screenshot(pixels, width, height)
+				key = "%s %dx%d %s %s" % (name, width, height, fmt, engine)
+
+				results["spectrum_hsv " + key] = measure(lambda: screen.spectrum_hsv(pixels, width, height))
+				if engine == 'numpy':
+					histogram = addon.spectrum_hsv_numpy(pixels, addon.fmtRGBA)
+				else:
+					histogram = addon.spectrum_hsv_lut(pixels, addon.fmtRGBA)
+				results["most_used_spectrum " + key] = measure(lambda: screen.most_used_spectrum(*histogram))
+
+				hsvRatios = screen.spectrum_hsv(pixels, width, height)
+				lights = [light(), light(), light()]
+				def fade():
+					for l, hsvRatio in zip(lights, hsvRatios):
+						addon.fade_light_hsv(l, hsvRatio)
+				results["fade_light_hsv " + key] = measure(fade)
+
+				def frame():
+					for l, hsvRatio in zip(lights, screen.spectrum_hsv(pixels, width, height)):
+						addon.fade_light_hsv(l, hsvRatio)
+				results["frame " + key] = measure(frame)
+
+	hsvRatio = addon.HSVRatio(0.3, 0.8, 0.6, 0.5)
+	results["HSVRatio.hue"] = measure(lambda: hsvRatio.hue(False))
+	table = addon.GamutTable("C")
+	results["GamutTable.xy"] = measure(lambda: table.xy(20000, 180))
+	addon.numpy = numpy
+	return results
+
+def report(results):
+	lines = []
+	for key in sorted(results):
+		seconds, peak = results[key]
+		line = "%-50s %10.1f us %10.1f/sec" % (key, seconds * 1e6, 1 / seconds if seconds else 0)
+		if peak is not None:
+			line += " %8.1f KB" % (peak / 1024.0)
+		lines.append(line)
+	if tracemalloc is None:
+		lines.append("allocations not measured, tracemalloc needs Python 3.4+")
+	return "\n".join(lines)
+
+def load_baseline():
+	try:
+		return json.load(open(BASELINE))
+	except (IOError, OSError, ValueError):
+		return None
+
+def save_baseline(results):
+	json.dump(dict((key, r[0]) for key, r in results.items()), open(BASELINE, "w"), indent=1, sort_keys=True)
+
+def regressions(results, baseline):
+	failed = []
+	for key, seconds in baseline.items():
+		if key not in results:
+			continue # other engine or frames not available here
+		current = results[key][0]
+		if current > seconds * (1 + TOLERANCE / 100.0) and current - seconds > NOISE:
+			failed.append("%s: %.1f us, baseline %.1f us (+%d%%)" % \
+				(key, current * 1e6, seconds * 1e6, (current / seconds - 1) * 100))
+	return failed
+
+def test_no_regressions():
+	if not os.environ.get('BENCH'):
+		raise SkipTest("set BENCH=1 to compare against a baseline from this machine")
+	baseline = load_baseline()
+	results = run_benchmarks()
+	if baseline is None:
+		save_baseline(results)
+		raise SkipTest("no baseline yet, written to %s" % BASELINE)
+	failed = regressions(results, baseline)
+	ok_(not failed, "stages slower than the baseline allows (%d%%):\n%s" % (TOLERANCE, "\n".join(failed)))
+
+if __name__ == "__main__":
+	results = run_benchmarks()
+	print(report(results))
+	if "--update" in sys.argv:
+		save_baseline(results)
+		print("baseline written to %s" % BASELINE)
+	else:
+		baseline = load_baseline()
+		if baseline is not None:
+			failed = regressions(results, baseline)
+			print("\n".join(failed) or "no regressions")
+			sys.exit(1 if failed else 0)
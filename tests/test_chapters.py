@@ -0,0 +1,130 @@
+from nose.tools import *
+import io
+import os
+import struct
+os.sys.path.append("./resources/lib/")
+
+from chapters import *
+
+class CountingFile(io.BytesIO):
+	# remembers how many bytes got read
+	def __init__(self, data):
+		io.BytesIO.__init__(self, data)
+		self.bytes_read = 0
+	def read(self, size=-1):
+		data = io.BytesIO.read(self, size)
+		self.bytes_read += len(data)
+		return data
+
+##############
+# MATROSKA   #
+##############
+
+def ebml_id(element_id):
+	data = struct.pack(">I", element_id)
+	return data.lstrip(b"\x00")
+
+def ebml_size(size):
+	return struct.pack(">Q", size | (1 << 56)) # 8 byte size
+
+def element(element_id, *children):
+	data = b"".join(children)
+	return ebml_id(element_id) + ebml_size(len(data)) + data
+
+def uint(element_id, value, length=8):
+	return element(element_id, struct.pack(">Q", value)[8 - length:])
+
+def chapter(seconds, hidden=False, enabled=True):
+	children = [uint(CHAPTERTIMESTART, int(seconds * 1000000000))]
+	if hidden:
+		children.append(uint(CHAPTERFLAGHIDDEN, 1, 1))
+	if not enabled:
+		children.append(uint(CHAPTERFLAGENABLED, 0, 1))
+	return element(CHAPTERATOM, *children)
+
+def edition(chapters, default=False, hidden=False):
+	children = [uint(EDITIONFLAGDEFAULT, int(default), 1), uint(EDITIONFLAGHIDDEN, int(hidden), 1)]
+	return element(EDITIONENTRY, *(children + chapters))
+
+def mkv(editions, seekhead=True, payload=100000):
+	# EBML header, Segment with [SeekHead], a big Cluster-like blob, Chapters
+	header = element(EBML, uint(0x4286, 1, 1))
+	blob = element(0x1F43B675, b"\x00" * payload)
+	chapters = element(CHAPTERS, *editions)
+	body = blob + chapters
+	if seekhead:
+		# the SeekHead has a fixed size, so its own length is known up front
+		seek = lambda position: element(SEEKHEAD, element(SEEK, element(SEEKID, ebml_id(CHAPTERS)), uint(SEEKPOSITION, position)))
+		body = seek(len(seek(0)) + len(blob)) + body
+	return header + element(SEGMENT, body)
+
+def test_mkv_seekhead():
+	f = CountingFile(mkv([edition([chapter(0), chapter(600.5), chapter(5400)])]))
+	eq_(read_chapters(f), [0, 600.5, 5400])
+	ok_(f.bytes_read < 1000, "read %d bytes" % f.bytes_read)
+
+def test_mkv_without_seekhead():
+	f = CountingFile(mkv([edition([chapter(0), chapter(5400)])], seekhead=False))
+	eq_(read_chapters(f), [0, 5400])
+	ok_(f.bytes_read < 1000, "read %d bytes" % f.bytes_read)
+
+def test_mkv_hidden_and_disabled_chapters():
+	chapters = [chapter(0), chapter(3000, hidden=True), chapter(5400), chapter(6000, enabled=False)]
+	eq_(read_chapters(io.BytesIO(mkv([edition(chapters)]))), [0, 5400])
+
+def test_mkv_editions():
+	editions = [edition([chapter(0), chapter(100)]), edition([chapter(0), chapter(200)], default=True)]
+	eq_(read_chapters(io.BytesIO(mkv(editions))), [0, 200])
+	editions = [edition([chapter(0), chapter(100)], hidden=True), edition([chapter(0), chapter(300)])]
+	eq_(read_chapters(io.BytesIO(mkv(editions))), [0, 300])
+
+def test_mkv_no_chapters():
+	data = element(EBML, uint(0x4286, 1, 1)) + element(SEGMENT, element(0x1F43B675, b"\x00" * 100))
+	eq_(read_chapters(io.BytesIO(data)), [])
+
+#######
+# MP4 #
+#######
+
+def atom(kind, *children):
+	data = b"".join(children)
+	return struct.pack(">I4s", len(data) + 8, kind) + data
+
+def chpl(starts):
+	data = struct.pack(">BxxxxxxxB", 1, len(starts))
+	for i, start in enumerate(starts):
+		title = ("Chapter %d" % i).encode("ascii")
+		data += struct.pack(">QB", int(start * 10000000), len(title)) + title
+	return atom(b"chpl", data)
+
+def trak(track_id, timescale, chap=None, stts=None):
+	tkhd = atom(b"tkhd", struct.pack(">IIIII", 0, 0, 0, track_id, 0))
+	mdhd = atom(b"mdhd", struct.pack(">IIII", 0, 0, 0, timescale) + b"\x00" * 8)
+	children = [tkhd]
+	if chap is not None:
+		children.append(atom(b"tref", atom(b"chap", struct.pack(">I", chap))))
+	table = []
+	if stts is not None:
+		table.append(atom(b"stts", struct.pack(">II", 0, len(stts)) + b"".join(struct.pack(">II", n, d) for n, d in stts)))
+	children.append(atom(b"mdia", mdhd, atom(b"minf", atom(b"stbl", *table))))
+	return atom(b"trak", *children)
+
+def mp4(*moov):
+	return atom(b"ftyp", b"isom\x00\x00\x02\x00") + atom(b"mdat", b"\x00" * 100000) + atom(b"moov", *moov)
+
+def test_mp4_nero_chapters():
+	f = CountingFile(mp4(trak(1, 1000), atom(b"udta", chpl([0, 60.5, 5400]))))
+	eq_(read_chapters(f), [0, 60.5, 5400])
+	ok_(f.bytes_read < 1000, "read %d bytes" % f.bytes_read)
+
+def test_mp4_chapter_track():
+	# one 600s chapter, two 2400s chapters at timescale 1000
+	data = mp4(trak(1, 90000, chap=2), trak(2, 1000, stts=[(1, 600000), (2, 2400000)]))
+	eq_(read_chapters(io.BytesIO(data)), [0, 600, 3000])
+
+def test_mp4_no_chapters():
+	eq_(read_chapters(io.BytesIO(mp4(trak(1, 1000)))), [])
+
+def test_unknown_format():
+	assert_raises(ChapterError, read_chapters, io.BytesIO(b"RIFF" + b"\x00" * 100))
+	assert_raises(ChapterError, read_chapters, io.BytesIO(b"\x1a\x45"))
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+from nose.tools import *
+import os
+import shutil
+import tempfile
+import time
+import threading
+os.sys.path.append("./resources/lib/")
+
+NOSE = os.environ.get('NOSE', None)
+ok_(NOSE != None, "NOSE not set")
+
+from tools import *
+
+class FakeChapterDB():
+	# stands in for CreditsStartTimeForMovie: answers[duration] = (delay, result)
+	def __init__(self, answers):
+		self.answers = answers
+		self.calls = []
+		self.original = ChapterManager.CreditsStartTimeForMovie
+
+	def __enter__(self):
+		def lookup(title, t_duration=None, chapterCount=None, timeout=None, fallback=True):
+			self.calls.append((title, t_duration, timeout, fallback))
+			delay, result = self.answers[t_duration]
+			time.sleep(delay)
+			if isinstance(result, Exception):
+				raise result
+			return result
+		ChapterManager.CreditsStartTimeForMovie = staticmethod(lookup)
+		return self
+
+	def __exit__(self, *args):
+		ChapterManager.CreditsStartTimeForMovie = staticmethod(self.original)
+
+def lookup(title, duration, deadline=CREDITS_DEADLINE):
+	answers = []
+	done = threading.Event()
+	def callback(result):
+		answers.append(result)
+		done.set()
+	start = time.time()
+	CreditsLookup(title, duration, callback, deadline)
+	ok_(time.time() - start < 0.05, "lookup blocked the caller")
+	done.wait(2)
+	time.sleep(0.2) # a second callback would show up by now
+	return answers
+
+def test_queries_run_concurrently():
+	with FakeChapterDB({6000: (0.3, 5400), None: (0.3, 5300)}) as db:
+		start = time.time()
+		answers = lookup("Movie", 6000)
+		ok_(time.time() - start < 0.8)
+	eq_(len(answers), 1)
+	ok_(answers[0] in (5400, 5300))
+	eq_(sorted(c[1] for c in db.calls), [None, 6000])
+	ok_(all(c[3] == False for c in db.calls), "no sequential fallback inside the queries")
+
+def test_first_valid_answer_wins():
+	with FakeChapterDB({6000: (0.4, 5400), None: (0.05, 5300)}):
+		eq_(lookup("Movie", 6000), [5300])
+
+def test_miss_waits_for_the_other_query():
+	with FakeChapterDB({6000: (0.05, None), None: (0.3, 5300)}):
+		eq_(lookup("Movie", 6000), [5300])
+
+def test_errors_and_misses_give_none():
+	with FakeChapterDB({6000: (0.05, IOError("timed out")), None: (0.1, None)}):
+		eq_(lookup("Movie", 6000), [None])
+
+def test_no_duration_single_query():
+	with FakeChapterDB({None: (0.05, 5300)}) as db:
+		eq_(lookup("Movie", 0), [5300])
+	eq_(len(db.calls), 1)
+
+def test_deadline():
+	with FakeChapterDB({6000: (0.5, 5400), None: (0.5, 5300)}) as db:
+		eq_(lookup("Movie", 6000, deadline=0.2), [None])
+	eq_(db.calls[0][2], 0.2) # also the socket timeout
+
+def test_cancel():
+	answers = []
+	with FakeChapterDB({6000: (0.1, 5400), None: (0.1, 5300)}):
+		CreditsLookup("Movie", 6000, answers.append).cancel()
+		time.sleep(0.3)
+	eq_(answers, [])
+
+def with_cache(**kwargs):
+	cache_dir = tempfile.mkdtemp()
+	return cache_dir, CreditsCache(os.path.join(cache_dir, CREDITS_CACHE_FILE), **kwargs)
+
+def test_cache_key():
+	eq_(CreditsCache.key("The Matrix (1999)", 8173.4), CreditsCache.key("the  matrix 1999", 8174))
+	ok_(CreditsCache.key("The Matrix", 8173) != CreditsCache.key("The Matrix", 7000))
+	ok_(CreditsCache.key("Amélie", 7000) != CreditsCache.key("Am lie", 7000))
+	eq_(CreditsCache.key("Movie", None), u"movie|")
+
+def test_cache_hits_misses_and_persists():
+	cache_dir, cache = with_cache()
+	try:
+		eq_(cache.get("Movie", 6000), (False, None))
+		cache.put("Movie", 6000, 5400)
+		cache.put("Unknown", 6000, None)
+		eq_(cache.get("Movie", 6000), (True, 5400))
+		eq_(cache.get("Unknown", 6000), (True, None)) # negative result
+		reloaded = CreditsCache(cache.path)
+		eq_(reloaded.get("Movie", 6000), (True, 5400))
+		eq_(reloaded.get("Unknown", 6000), (True, None))
+	finally:
+		shutil.rmtree(cache_dir)
+
+def test_cache_ttl():
+	cache_dir, cache = with_cache(ttl=100, miss_ttl=10)
+	try:
+		cache.put("Movie", 6000, 5400)
+		cache.put("Unknown", 6000, None)
+		cache.entries[CreditsCache.key("Unknown", 6000)][1] -= 20
+		cache.entries[CreditsCache.key("Movie", 6000)][1] -= 20
+		eq_(cache.get("Unknown", 6000), (False, None))
+		eq_(cache.get("Movie", 6000), (True, 5400))
+	finally:
+		shutil.rmtree(cache_dir)
+
+def test_cache_lru():
+	cache_dir, cache = with_cache(size=3)
+	try:
+		for i, title in enumerate(["a", "b", "c"]):
+			cache.put(title, 6000, i)
+			time.sleep(0.01)
+		cache.get("a", 6000) # a is used again, b is now the oldest
+		time.sleep(0.01)
+		cache.put("d", 6000, 3)
+		eq_(len(cache.entries), 3)
+		eq_(cache.get("b", 6000), (False, None))
+		eq_(cache.get("a", 6000), (True, 0))
+	finally:
+		shutil.rmtree(cache_dir)
+
+def test_lookup_uses_cache():
+	cache_dir, cache = with_cache()
+	try:
+		with FakeChapterDB({6000: (0.05, None), None: (0.05, None)}) as db:
+			answers = []
+			CreditsLookup("Movie", 6000, answers.append, cache=cache)
+			time.sleep(0.2)
+			eq_(answers, [None])
+			eq_(len(db.calls), 2)
+			CreditsLookup("Movie", 6000, answers.append, cache=cache)
+			eq_(answers, [None, None]) # answered right away from the cache
+			eq_(len(db.calls), 2)
+		with FakeChapterDB({6000: (0.05, IOError("timed out")), None: (0.05, None)}):
+			CreditsLookup("Other", 6000, answers.append, cache=cache)
+			time.sleep(0.2)
+		eq_(cache.get("Other", 6000), (False, None)) # errors are not cached
+	finally:
+		shutil.rmtree(cache_dir)
+
+CHAPTERDB = """<?xml version="1.0" encoding="UTF-8"?>
+<results xmlns="http://jvance.com/2008/ChapterGrabber">
+%s
+</results>"""
+
+CHAPTERINFO = """<chapterInfo><title>Movie</title><source><duration>%s</duration></source><chapters>
+<chapter time="00:00:00" name="1"/><chapter time="01:20:00" name="2"/><chapter time="%s" name="3"/>
+</chapters></chapterInfo>"""
+
+class Response():
+	# counts how much of the response got read
+	def __init__(self, text):
+		self.text = text
+		self.offset = 0
+	def read(self, size=-1):
+		if size < 0:
+			size = len(self.text)
+		data = self.text[self.offset:self.offset + size]
+		self.offset += len(data)
+		return data
+
+def test_parse_stops_at_first_match():
+	import tools
+	class xbmc():
+		@staticmethod
+		def log(msg):
+			pass
+	tools.xbmc = xbmc
+	try:
+		infos = [CHAPTERINFO % ("01:30:00", "01:29:30"), CHAPTERINFO % ("01:40:00", "01:35:00")]
+		infos += [CHAPTERINFO % ("02:00:00", "01:55:00")] * 2000
+		response = Response(CHAPTERDB % "\n".join(infos))
+		eq_(ChapterManager.LastChapterStart(response, 6000), 5700)
+		ok_(response.offset < len(response.text) / 10, "read %d of %d bytes" % (response.offset, len(response.text)))
+		# last chapter too close to the end, the one before it is the credits
+		eq_(ChapterManager.LastChapterStart(Response(CHAPTERDB % infos[0]), 5400), 4800)
+		eq_(ChapterManager.LastChapterStart(Response(CHAPTERDB % infos[0]), 9999), None)
+	finally:
+		del tools.xbmc
+
+def test_chapters_in_file_first():
+	with FakeChapterDB({6000: (0.05, 5000), None: (0.05, 5000)}) as db:
+		answers = []
+		CreditsLookup("Movie", 6000, answers.append, chapters=lambda: [0, 1200, 5400, 5990])
+		time.sleep(0.2)
+		eq_(answers, [5400]) # the last chapter is too close to the end
+		eq_(db.calls, [])
+		CreditsLookup("Movie", 6000, answers.append, chapters=lambda: [0])
+		time.sleep(0.2)
+		eq_(answers, [5400, 5000]) # one chapter is no chapters
+		def unreadable():
+			raise IOError("no such file")
+		CreditsLookup("Movie", 6000, answers.append, chapters=unreadable)
+		time.sleep(0.2)
+		eq_(answers, [5400, 5000, 5000])
+
+def test_credits_start_for_chapters():
+	eq_(ChapterManager.CreditsStartForChapters([]), None)
+	eq_(ChapterManager.CreditsStartForChapters([0, 5400.4]), 5400)
+	eq_(ChapterManager.CreditsStartForChapters([0, 5400, 5990], 6000), 5400)
+	eq_(ChapterManager.CreditsStartForChapters([0, 5400, 5700], 6000), 5700)
+
+class FakePlayer():
+	# playing time that runs with the clock from a start position
+	def __init__(self, position, speed=1):
+		self.jump(position, speed)
+	def jump(self, position, speed=1):
+		self.start = time.time() - position / float(speed) if speed else None
+		self.position = position
+		self.speed = speed
+	def time(self):
+		if not self.speed:
+			return self.position
+		return (time.time() - self.start) * self.speed
+
+def scheduler(player):
+	calls = []
+	s = CreditsScheduler(lambda position: calls.append((time.time(), position)), player.time)
+	return s, calls
+
+def test_scheduler_fires_once_at_deadline():
+	player = FakePlayer(100)
+	s, calls = scheduler(player)
+	try:
+		s.set_target(100.2)
+		start = time.time()
+		s.sync(player.time(), 1)
+		time.sleep(0.5)
+		eq_(len(calls), 1)
+		ok_(abs(calls[0][0] - start - 0.2) < 0.05, "fired after %.3fs" % (calls[0][0] - start))
+		ok_(calls[0][1] >= 100.2)
+	finally:
+		s.close()
+
+def test_scheduler_pause_and_resume():
+	player = FakePlayer(100)
+	s, calls = scheduler(player)
+	try:
+		s.set_target(100.3)
+		s.sync(player.time(), 1)
+		time.sleep(0.1)
+		player.jump(player.time(), 0)
+		s.sync(player.time(), 0) # paused
+		time.sleep(0.4)
+		eq_(calls, [])
+		player.jump(player.position, 1)
+		s.sync(player.time(), 1)
+		time.sleep(0.4)
+		eq_(len(calls), 1)
+	finally:
+		s.close()
+
+def test_scheduler_seek_and_speed():
+	player = FakePlayer(0)
+	s, calls = scheduler(player)
+	try:
+		s.set_target(1000)
+		s.sync(player.time(), 1)
+		time.sleep(0.1)
+		eq_(calls, [])
+		player.jump(999.5, 4)
+		s.sync(player.time(), 4) # seek close to the credits, then fast forward
+		time.sleep(0.3)
+		eq_(len(calls), 1)
+		player.jump(500)
+		s.sync(player.time(), 1) # rewound, the caller hears about it
+		time.sleep(0.1)
+		eq_(len(calls), 2)
+		ok_(calls[1][1] < 1000)
+	finally:
+		s.close()
+
+def test_scheduler_behind_the_clock():
+	# playback buffered for a while: the deadline passes early, it waits for the rest
+	player = FakePlayer(100)
+	s, calls = scheduler(player)
+	try:
+		s.set_target(100.2)
+		s.sync(player.time(), 1)
+		player.jump(99.9)
+		time.sleep(0.6)
+		eq_(len(calls), 1)
+		ok_(calls[0][1] >= 100.2)
+	finally:
+		s.close()
+
+def test_scheduler_clear():
+	player = FakePlayer(100)
+	s, calls = scheduler(player)
+	try:
+		s.set_target(100.1)
+		s.sync(player.time(), 1)
+		s.clear()
+		time.sleep(0.3)
+		eq_(calls, [])
+	finally:
+		s.close()
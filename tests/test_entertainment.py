@@ -0,0 +1,94 @@
+from nose.tools import *
+import os
+import socket
+import threading
+import time
+os.sys.path.append("./resources/lib/")
+
+from entertainment import *
+
+class logger():
+	def log(self, msg):
+		pass
+	def debuglog(self, msg):
+		pass
+
+# local stand-in for the bridge's streaming port, decodes every frame it gets
+class StreamStandIn(threading.Thread):
+	def __init__(self):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.bind(("127.0.0.1", 0))
+		self.sock.settimeout(0.2)
+		self.port = self.sock.getsockname()[1]
+		self.frames = []
+		self.errors = []
+		self.running = True
+
+	def run(self):
+		while self.running:
+			try:
+				data = self.sock.recv(4096)
+			except socket.timeout:
+				continue
+			try:
+				self.frames.append(decode_frame(data))
+			except ValueError as e:
+				self.errors.append(e)
+
+	def stop(self):
+		self.running = False
+		self.join()
+		self.sock.close()
+
+def test_encode_decode():
+	frame = encode_frame(7, [(1, 65535, 0, 0), (12, 0, 1000, 65535)])
+	eq_(len(frame), 16 + 2 * 9)
+	ok_(frame.startswith(b"HueStream"))
+	eq_(decode_frame(frame), (7, COLORSPACE_RGB, [(1, 65535, 0, 0), (12, 0, 1000, 65535)]))
+
+def test_decode_rejects_garbage():
+	assert_raises(ValueError, decode_frame, b"HueStream")
+	assert_raises(ValueError, decode_frame, b"NotStream" + b"\x01" * 7)
+
+def test_hsv_to_channels():
+	eq_(hsv_to_channels(0, 255, 255), (65535, 0, 0))
+	eq_(hsv_to_channels(0, 0, 0), (0, 0, 0))
+
+def test_stream_to_stand_in():
+	standin = StreamStandIn()
+	standin.start()
+	stream = EntertainmentStream(UDPTransport("127.0.0.1", standin.port), 50, logger())
+	stream.update(1, 0, 255, 255)
+	stream.update(2, 21845, 255, 255) # green
+	stream.start()
+	time.sleep(0.5)
+	stream.update(2, 43690, 255, 255) # blue
+	time.sleep(0.2)
+	stream.stop()
+	time.sleep(0.1)
+	standin.stop()
+
+	eq_(standin.errors, [])
+	# ~35 frames at 50Hz, be lenient on a busy machine
+	ok_(len(standin.frames) >= 15, "only %d frames" % len(standin.frames))
+	sequences = [f[0] for f in standin.frames]
+	eq_(sequences, [(sequences[0] + i) & 0xff for i in range(len(sequences))])
+	for sequence, colorspace, lights in standin.frames:
+		eq_(colorspace, COLORSPACE_RGB)
+		eq_([l[0] for l in lights], [1, 2]) # one datagram carries every light
+		eq_(lights[0][1:], (65535, 0, 0))
+	eq_(standin.frames[0][2][1][1:], (0, 65535, 0))
+	eq_(standin.frames[-1][2][1][1:], (0, 0, 65535))
+
+def test_dtls_unavailable_without_client_key():
+	assert_raises(DTLSUnavailable, DTLSTransport, "127.0.0.1", "user", "")
+
+def test_client_key_checked_first():
+	try:
+		check_dtls("")
+	except DTLSUnavailable as e:
+		ok_("client key" in str(e), e) # not hidden behind a missing python-mbedtls
+	else:
+		ok_(False, "no client key should be unavailable")
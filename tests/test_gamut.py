@@ -0,0 +1,60 @@
+from nose.tools import *
+import os
+os.sys.path.append("./resources/lib/")
+
+from gamut import *
+
+def inside(xy, gamut):
+	return clip_to_gamut(xy, GAMUTS[gamut]) == xy
+
+def test_capabilities_from_bridge():
+	j = {"modelid": "LCT015", "type": "Extended color light", "state": {"on": True, "bri": 100, "xy": [0.3, 0.3], "ct": 300},
+		"capabilities": {"control": {"colorgamuttype": "C", "ct": {"min": 153, "max": 500}}}}
+	c = LightCapabilities("1", j)
+	eq_((c.color, c.ct, c.dimmable, c.gamut), (True, True, True, "C"))
+
+def test_capabilities_from_model():
+	eq_(LightCapabilities("1", {"modelid": "LCT001", "state": {"bri": 1, "hue": 0}}).gamut, "B")
+	c = LightCapabilities("1", {"modelid": "LST001", "state": {"bri": 1, "hue": 0}})
+	eq_((c.gamut, c.full_spectrum), ("A", True))
+	c = LightCapabilities("1", {"modelid": "LWB006", "type": "Dimmable light", "state": {"bri": 1}})
+	eq_((c.color, c.ct, c.gamut), (False, False, None))
+	corners = [[0.68, 0.31], [0.17, 0.69], [0.15, 0.06]]
+	c = LightCapabilities("1", {"modelid": "X", "state": {"bri": 1, "xy": [0, 0]},
+		"capabilities": {"control": {"colorgamuttype": "other", "colorgamut": corners}}})
+	eq_(c.gamut, tuple(tuple(corner) for corner in corners))
+
+def test_capability_index():
+	index = capability_index({"1": {"modelid": "LCT001", "state": {"bri": 1, "hue": 0}}, "2": {"modelid": "LWB006", "state": {"bri": 1}}})
+	eq_(sorted(index), ["1", "2"])
+	eq_(index["2"].gamut, None)
+
+def test_clip_to_gamut():
+	eq_(clip_to_gamut((0.3227, 0.329), GAMUTS["B"]), (0.3227, 0.329)) # white is inside
+	x, y = clip_to_gamut((0.17, 0.7), GAMUTS["B"]) # gamut C green is outside B
+	ok_(abs(x - 0.409) < 0.01 and abs(y - 0.518) < 0.01, (x, y))
+	x, y = clip_to_gamut((0.5, 0.1), GAMUTS["A"]) # below the red-blue edge
+	ok_(y > 0.1)
+	eq_(clip_to_gamut((x, y + 1e-6), GAMUTS["A"]), (x, y + 1e-6)) # on the edge now
+
+def test_table_primaries_and_white():
+	for gamut in "ABC":
+		table = GamutTable(gamut)
+		red, green, blue = GAMUTS[gamut]
+		for hue, corner in [(0, red), (43690, blue)]:
+			x, y = table.xy(hue, 255)
+			ok_(abs(x - corner[0]) < 0.02 and abs(y - corner[1]) < 0.02, (gamut, hue, x, y))
+		eq_(table.xy(12345, 0), table.xy(54321, 0)) # no saturation, no hue
+
+def test_table_memoises():
+	table = GamutTable("C")
+	first = table.xy(20000, 180)
+	ok_(table.xy(20010, 179) is first) # same quantised colour, same entry
+	eq_(sum(1 for e in table.table if e is not None), 1)
+	table.fill()
+	ok_(None not in table.table)
+
+def test_shared_tables():
+	ok_(gamut_table("A") is gamut_table("A"))
+	ok_(gamut_table("A") is not gamut_table("B"))
+	ok_(gamut_table("B").area < gamut_table("C").area)
@@ -0,0 +1,64 @@
+from nose.tools import *
+import os
+import shutil
+import tempfile
+import time
+os.sys.path.append("./resources/lib/")
+
+from instrument import *
+
+def test_histogram_percentiles():
+	h = Histogram()
+	for i in range(90):
+		h.add(0.0008) # <1ms bucket
+	for i in range(10):
+		h.add(0.04) # <50ms bucket
+	eq_(h.count, 100)
+	eq_(h.percentile(50), 0.001)
+	eq_(h.percentile(90), 0.001)
+	eq_(h.percentile(99), 0.05)
+	eq_(h.max, 0.04)
+
+def test_histogram_overflow():
+	h = Histogram()
+	h.add(3.0)
+	eq_(h.buckets[-1], 1)
+	eq_(h.percentile(50), 3.0)
+
+def test_disabled_records_nothing():
+	timer = StageTimer()
+	start = timer.start()
+	eq_(start, None)
+	timer.stop("spectrum_hsv", start)
+	timer.stop("bridge_put", time.time()) # started outside, still ignored
+	eq_(sum(h.count for h in timer.histograms.values()), 0)
+
+def test_enabled_records_stages():
+	timer = StageTimer()
+	timer.enabled = True
+	start = timer.start()
+	time.sleep(0.01)
+	timer.stop("spectrum_hsv", start)
+	timer.stop("loop", timer.start())
+	eq_(timer.histograms["spectrum_hsv"].count, 1)
+	ok_(timer.histograms["spectrum_hsv"].max >= 0.009)
+	eq_(timer.histograms["loop"].count, 1)
+	report = timer.report().split("\n")
+	eq_([line.split()[0] for line in report], STAGES + ["loop"])
+
+def test_profiler_writes_report():
+	profile_dir = tempfile.mkdtemp()
+	try:
+		profiler = Profiler(0.05, profile_dir)
+		ok_(stages.enabled)
+		sum(i * i for i in range(10000))
+		time.sleep(0.06)
+		ok_(profiler.expired())
+		report = profiler.finish()
+		ok_(not stages.enabled)
+		ok_(os.path.exists(report))
+		ok_(os.path.exists(report[:-4] + ".prof"))
+		text = open(report).read()
+		ok_("ambilight stages" in text and "cumulative" in text)
+	finally:
+		shutil.rmtree(profile_dir)
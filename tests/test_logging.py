@@ -0,0 +1,65 @@
+from nose.tools import *
+import os
+import shutil
+import tempfile
+os.sys.path.append("./resources/lib/")
+
+NOSE = os.environ.get('NOSE', None)
+ok_(NOSE != None, "NOSE not set")
+
+import tools
+from tools import *
+
+class Expensive():
+	formatted = 0
+	def __repr__(self):
+		Expensive.formatted += 1
+		return "expensive"
+
+def test_debuglog_defers_formatting():
+	Expensive.formatted = 0
+	logger = Logger()
+	logger.debuglog("light %s: %r", 1, Expensive())
+	eq_(Expensive.formatted, 0)
+
+def test_debuglog_formats_when_enabled():
+	written = []
+	class xbmc():
+		@staticmethod
+		def log(msg):
+			written.append(msg)
+	tools.xbmc = xbmc
+	try:
+		logger = Logger()
+		logger.debug()
+		logger.debuglog("light %s: %r", 1, Expensive())
+		logger.debuglog("100% plain")
+		logger.debuglog("data: %s", (1, 2)) # a tuple is one argument
+	finally:
+		del tools.xbmc
+	eq_(written, ["Kodi Hue: DEBUG light 1: expensive", "Kodi Hue: DEBUG 100% plain", "Kodi Hue: DEBUG data: (1, 2)"])
+
+def test_trace_ring_buffer():
+	t = Trace(size=4)
+	t.add("put", 1, {"bri": 1})
+	eq_(len(t.events), 0) # disabled
+	t.enabled = True
+	for i in range(10):
+		t.add("put", i, {"bri": i}, 0.01)
+	eq_([e[2] for e in t.events], [6, 7, 8, 9])
+
+def test_trace_dump():
+	t = Trace()
+	t.enabled = True
+	t.add("state", None, "started")
+	t.add("put", "http://10.0.0.2/api/user/lights/3/state", {"bri": 100}, 0.0123)
+	dump_dir = tempfile.mkdtemp()
+	try:
+		path = os.path.join(dump_dir, "trace.txt")
+		eq_(t.dump(path), 2)
+		lines = open(path).read().split("\n")
+		ok_("state" in lines[0] and "started" in lines[0])
+		ok_("lights/3/state" in lines[1] and "10.0.0.2" not in lines[1])
+		ok_(lines[1].endswith("(12.3ms)"), lines[1])
+	finally:
+		shutil.rmtree(dump_dir)
@@ -0,0 +1,370 @@
+from nose.tools import *
+import os
+import copy
+import time
+os.sys.path.append("./resources/lib/")
+os.sys.path.append("./tests/")
+
+# Light, Group and the command scheduler against the local mock bridge, no
+# physical bridge needed: NOSE=1 nosetests tests/test_mock_bridge.py
+
+NOSE = os.environ.get('NOSE', None)
+ok_(NOSE != None, "NOSE not set")
+
+import requests
+from hue import *
+from mock_bridge import *
+
+class settings():
+	mode		= 0 # ambilight
+	light		= 1
+	light1_id	= 1
+	group_id	= 1
+	dim_time	= 0
+	proportional_dim_time = False
+	override_hue	= True
+	override_sat	= False
+	override_paused	= False
+	override_undim_bri = True
+	dimmed_bri	= 0
+	dimmed_hue	= 10000
+	dimmed_sat	= 0
+	undim_sat	= 254
+	undim_bri	= 228
+	undim_hue	= 30000
+	paused_bri	= 100
+	force_light_on	= True
+	force_light_group_start_override = False
+	bridge_rate	= 25
+	light_rate	= 10
+	group_rate	= 1
+	send_workers	= 3
+	color_output	= 1 # xy
+	debug		= False
+	light2_id	= 2
+	light3_id	= 3
+	ambilight_dim	= True
+	ambilight_dim_light = 1
+	ambilight_dim_light1_id = 3
+	ambilight_dim_light2_id = 1
+	ambilight_dim_light3_id = 1
+	ambilight_dim_group_id = 1
+	light1_bridge	= 1
+	light2_bridge	= 1
+	light3_bridge	= 1
+	bridge2		= False
+
+	def changes(self, other):
+		return set(k for k in dir(self) if not k.startswith("_") and getattr(self, k) != getattr(other, k, None))
+
+class HueUnderTest(Hue):
+	# the lights of a Hue without the Kodi parts of its constructor
+	def __init__(self, settings):
+		self.logger = Logger()
+		self.settings = settings
+		self.update_settings()
+
+def with_bridge(**kwargs):
+	bridge = MockBridge(**kwargs).start()
+	s = settings()
+	s.bridge_ip = bridge.ip
+	s.bridge_user = USERNAME
+	return bridge, s
+
+def teardown():
+	stop_schedulers()
+
+def test_register():
+	bridge, s = with_bridge()
+	r = requests.post("http://%s/api" % bridge.ip, data='{"devicetype": "test#nose", "generateclientkey": true}')
+	eq_(r.json()[0]["success"]["clientkey"], CLIENTKEY)
+	bridge.link_button = False
+	r = requests.post("http://%s/api" % bridge.ip, data='{"devicetype": "test#nose"}')
+	ok_("link button not pressed" in r.text)
+	r = requests.get("http://%s/api/nobody/lights" % bridge.ip)
+	eq_(r.json()[0]["error"]["type"], 1)
+	bridge.stop()
+
+def test_full_state():
+	bridge, s = with_bridge(lights=2)
+	r = requests.get("http://%s/api/%s" % (bridge.ip, USERNAME)).json()
+	eq_(sorted(r), ["config", "groups", "lights"])
+	eq_(sorted(r["lights"]), ["1", "2"])
+	eq_(r["config"]["ipaddress"], bridge.ip)
+	r = requests.put("http://%s/api/%s" % (bridge.ip, USERNAME), data='{"on": true}').json()
+	eq_(r[0]["error"]["type"], 3)
+	eq_(r[0]["error"]["address"], "/")
+	r = requests.get("http://%s/api/%s/lights/9" % (bridge.ip, USERNAME)).json()
+	eq_(r[0]["error"]["address"], "/lights/9")
+	bridge.stop()
+
+def test_hydrate_from_snapshot():
+	bridge, s = with_bridge(lights=24)
+	g = Group(s, 1, BridgeSnapshot(s.bridge_ip, s.bridge_user))
+	eq_(len(g.lights), 24)
+	eq_([c.path for c in bridge.commands], ["/api/%s/lights" % USERNAME, "/api/%s/groups" % USERNAME])
+	eq_(g.start_setting["bri"], 200)
+	assert_raises(ValueError, Light, 99, s, BridgeSnapshot(s.bridge_ip, s.bridge_user))
+	bridge.stop()
+
+def test_light_command():
+	bridge, s = with_bridge()
+	l = Light(2, s)
+	l.set_light2(20000, 100, 50, 3)
+	command = bridge.wait_for(1)[0]
+	eq_(command.path, "/api/%s/lights/2/state" % USERNAME)
+	eq_(command.body, {"hue": 20000, "sat": 100, "bri": 50, "transitiontime": 3})
+	eq_(bridge.lights["2"]["state"]["bri"], 50)
+	bridge.stop()
+
+def test_light_xy_command():
+	bridge, s = with_bridge()
+	l = Light(2, s)
+	eq_(l.capabilities.gamut, "B") # LCT007
+	l.set_light2(20000, 100, 50, 3, xy=l.gamut.xy(20000, 100))
+	bridge.wait_for(1)
+	l.set_light2(20000, 100, 60, 3, xy=l.gamut.xy(20000, 100))
+	bridge.wait_for(2)
+	l.brighter_light() # back to hue/sat, the hue goes out again
+	commands = bridge.wait_for(3)
+	ok_("xy" in commands[0].body and "hue" not in commands[0].body)
+	eq_(commands[1].body, {"bri": 60, "transitiontime": 3})
+	eq_(commands[2].body["hue"], 30000)
+	eq_(commands[2].body["sat"], 200)
+	bridge.stop()
+
+def test_throughput_many_lights():
+	bridge, s = with_bridge(lights=30, latency=0.02, jitter=0.01, light_rate=25)
+	s.bridge_rate = 20 # stay below what the bridge takes
+	lights = [Light(i, s) for i in range(1, 31)]
+	start = time.time()
+	for l in lights:
+		l.set_light2(30000, 200, 100, 0, PRIORITY_AMBILIGHT)
+	commands = bridge.wait_for(30)
+	elapsed = time.time() - start
+	eq_(len(commands), 30)
+	eq_(bridge.puts(status="refused"), [])
+	eq_(sorted(int(c.id) for c in commands), list(range(1, 31)))
+	# 30 commands at 20/sec, the first 20 from a full bucket
+	ok_(0.4 < elapsed < 3, "took %.2f sec" % elapsed)
+	bridge.stop()
+
+def test_stale_updates_are_dropped():
+	bridge, s = with_bridge(latency=0.1)
+	l = Light(1, s)
+	for bri in range(1, 41):
+		l.set_light2(None, None, bri, 0, PRIORITY_AMBILIGHT)
+		time.sleep(0.005)
+	time.sleep(0.5)
+	commands = bridge.puts()
+	ok_(2 <= len(commands) < 20, "%d commands" % len(commands))
+	eq_(commands[-1].body["bri"], 40) # the latest frame always makes it
+	eq_(bridge.lights["1"]["state"]["bri"], 40)
+	bridge.stop()
+
+def test_state_changes_before_ambilight():
+	bridge, s = with_bridge(lights=8, latency=0.05)
+	s.send_workers = 1
+	lights = [Light(i, s) for i in range(1, 9)]
+	for l in lights[:7]:
+		l.set_light2(1000, 100, 100, 0, PRIORITY_AMBILIGHT)
+	lights[7].dim_light()
+	commands = bridge.wait_for(8)
+	# the first frame may already be on its way, the dim goes right after it
+	ok_([c.id for c in commands].index("8") <= 1, commands)
+	bridge.stop()
+
+def test_discarded_color_goes_out_again():
+	bridge, s = with_bridge(latency=0.2)
+	s.send_workers = 1
+	lights = [Light(i, s) for i in (1, 2)]
+	lights[0].set_light2(1000, 100, 100, 0, PRIORITY_AMBILIGHT) # on its way
+	time.sleep(0.05)
+	lights[1].set_light2(20000, 200, 100, 0, PRIORITY_AMBILIGHT) # queued behind it
+	discard_all(PRIORITY_AMBILIGHT) # e.g. paused
+	lights[1].set_light2(20000, 200, 100, 0, PRIORITY_AMBILIGHT) # the same color again
+	commands = bridge.wait_for(2)
+	eq_(commands[1].id, "2")
+	eq_((commands[1].body["hue"], commands[1].body["sat"]), (20000, 200))
+	eq_(bridge.lights["2"]["state"]["hue"], 20000)
+	bridge.stop()
+
+def test_frame_not_merged_into_state_change():
+	bridge, s = with_bridge(latency=0.2)
+	s.send_workers = 1
+	lights = [Light(i, s) for i in (1, 2)]
+	lights[1].set_light2(1000, 100, 100, 0, PRIORITY_AMBILIGHT) # keeps the sender busy
+	time.sleep(0.05)
+	l = lights[0]
+	l.set_light2(30000, 150, 228, 3) # undim, waits
+	l.set_light2(None, None, 40, 0, PRIORITY_AMBILIGHT, xy=[0.6, 0.3]) # a late frame
+	l.scheduler.discard(PRIORITY_AMBILIGHT)
+	commands = bridge.wait_for(2)
+	time.sleep(0.3)
+	eq_(len(bridge.puts()), 2)
+	eq_(commands[1].id, "1")
+	eq_(commands[1].body, {"hue": 30000, "sat": 150, "bri": 228, "transitiontime": 3})
+	bridge.stop()
+
+def test_state_change_replaces_a_waiting_frame():
+	bridge, s = with_bridge(latency=0.2)
+	s.send_workers = 1
+	lights = [Light(i, s) for i in (1, 2)]
+	lights[1].set_light2(1000, 100, 100, 0, PRIORITY_AMBILIGHT)
+	time.sleep(0.05)
+	l = lights[0]
+	l.set_light2(None, None, 0, 0, PRIORITY_AMBILIGHT) # a dark frame turns it off, waits
+	l.set_light2(None, None, 40, 0, PRIORITY_AMBILIGHT, xy=[0.6, 0.3]) # the next one turns it on again
+	l.set_light2(30000, 200, 228, 3) # undim
+	l.scheduler.discard(PRIORITY_AMBILIGHT)
+	commands = bridge.wait_for(2)
+	time.sleep(0.3)
+	eq_(len(bridge.puts()), 2)
+	eq_(commands[1].body, {"on": True, "hue": 30000, "sat": 200, "bri": 228, "transitiontime": 3})
+	l.set_light2(None, None, 40, 0, PRIORITY_AMBILIGHT, xy=[0.6, 0.3]) # the dropped frame's color goes out now
+	eq_(bridge.wait_for(3)[2].body["xy"], [0.6, 0.3])
+	bridge.stop()
+
+def stream_commands(bridge):
+	return [c.body["stream"] for c in bridge.puts("groups") if "stream" in c.body]
+
+def with_streaming(clientkey):
+	bridge, s = with_bridge()
+	s.output = 1 # entertainment streaming
+	s.entertainment_group_id = 1
+	s.stream_rate = 25
+	s.bridge_clientkey = clientkey
+	h = HueUnderTest(s)
+	h.logger.disable() # the fallback is logged, there's no Kodi log here
+	return bridge, s, h
+
+def test_stream_not_activated_without_dtls():
+	bridge, s, h = with_streaming("")
+	h.start_stream()
+	eq_(h.stream, None) # REST from here on
+	eq_(stream_commands(bridge), []) # the group was never asked to stream
+	bridge.stop()
+
+def test_stream_deactivated_when_dtls_fails():
+	bridge, s, h = with_streaming(CLIENTKEY)
+	import hue
+	check_dtls, transport = hue.check_dtls, hue.DTLSTransport
+	def handshake_fails(*args):
+		raise DTLSUnavailable("handshake timed out")
+	hue.check_dtls = lambda clientkey: None # as if python-mbedtls was installed
+	hue.DTLSTransport = handshake_fails
+	try:
+		h.start_stream()
+	finally:
+		hue.check_dtls, hue.DTLSTransport = check_dtls, transport
+	eq_(h.stream, None)
+	eq_(stream_commands(bridge), [{"active": True}, {"active": False}])
+	eq_(bridge.groups["1"]["stream"], {"active": False})
+	bridge.stop()
+
+def test_bridge_rate_limit():
+	bridge, s = with_bridge(light_rate=10)
+	for i in range(20):
+		requests.put("http://%s/api/%s/lights/1/state" % (bridge.ip, USERNAME), data='{"bri": %d}' % i)
+	refused = bridge.puts(status="refused")
+	ok_(len(refused) >= 5, "%d refused" % len(refused))
+	eq_(bridge.lights["1"]["state"]["bri"], bridge.puts()[-1].body["bri"])
+	bridge.stop()
+
+def test_sender_survives_errors():
+	bridge, s = with_bridge(lights=20, seed=1)
+	lights = [Light(i, s) for i in range(1, 21)]
+	bridge.error_rate, bridge.drop_rate = 0.3, 0.2
+	bridge.reset()
+	for l in lights:
+		l.set_light2(1000, 100, 100, 0, PRIORITY_AMBILIGHT)
+	commands = bridge.wait_for(20, status=None)
+	eq_(len(commands), 20)
+	statuses = set(c.status for c in commands)
+	ok_("error" in statuses and "dropped" in statuses, statuses)
+	bridge.stop()
+
+def test_reload_patches_lights_in_place():
+	bridge, s = with_bridge()
+	hue = HueUnderTest(s)
+	light, dim = hue.light[0], hue.ambilight_dim_light[0]
+	requests_before = len(bridge.commands)
+	s2 = copy.copy(s)
+	s2.dim_time, s2.color_output = 5, 0
+	eq_(hue.reload_settings(s2), None) # nothing to ask the bridge
+	ok_(hue.light[0] is light and hue.ambilight_dim_light[0] is dim)
+	eq_(light.dim_time, 5)
+	eq_(light.gamut, None) # back to hue/sat
+	ok_(hue.settings is s2)
+	eq_(len(bridge.commands), requests_before)
+	bridge.stop()
+
+def test_reload_sets_up_new_lights_in_background():
+	bridge, s = with_bridge()
+	hue = HueUnderTest(s)
+	light = hue.light[0]
+	requests_before = len(bridge.commands)
+	s2 = copy.copy(s)
+	s2.light, s2.ambilight_dim = 2, False
+	thread = hue.reload_settings(s2)
+	ok_(thread is not None)
+	thread.join(5)
+	eq_(len(hue.light), 2)
+	ok_(hue.light[0] is light) # still configured, kept
+	eq_(hue.light[1].light, 2)
+	eq_(hue.ambilight_dim_light, None)
+	eq_(len(bridge.commands), requests_before + 2) # one snapshot
+	s3 = copy.copy(s2)
+	s3.light = 0
+	hue.reload_settings(s3).join(5)
+	ok_(hue.light.group)
+	eq_(each_light(hue.light), [hue.light])
+	bridge.stop()
+
+def with_second_bridge(s, **kwargs):
+	bridge = MockBridge(**kwargs).start()
+	s.bridge2, s.bridge2_ip, s.bridge2_user = True, bridge.ip, USERNAME
+	s.bridge2_group_id, s.bridge2_rate = 0, 25
+	return bridge
+
+def test_lights_on_two_bridges():
+	bridge, s = with_bridge()
+	bridge2 = with_second_bridge(s)
+	s.light, s.light2_bridge, s.ambilight_dim = 2, 2, False
+	hue = HueUnderTest(s)
+	ok_(hue.light[0].scheduler is not hue.light[1].scheduler) # each bridge has its own budget
+	eq_(hue.light[1].bridge_ip, bridge2.ip)
+	hue.light[0].set_light2(1000, 100, 100, 0, PRIORITY_AMBILIGHT)
+	hue.light[1].set_light2(2000, 100, 100, 0, PRIORITY_AMBILIGHT)
+	eq_(bridge.wait_for(1)[0].path, "/api/%s/lights/1/state" % USERNAME)
+	eq_(bridge2.wait_for(1)[0].path, "/api/%s/lights/2/state" % USERNAME)
+	# a snapshot of one bridge isn't used for the lights of the other
+	snapshots = hue.get_snapshots()
+	eq_(sorted(snapshots), sorted([bridge.ip, bridge2.ip]))
+	eq_(snapshot_for(snapshots[bridge.ip], bridge2.ip), None)
+	s.bridge2 = False # light 2 falls back to bridge 1
+	eq_(light_plan(s)[1], ("ambilight", "light", 1, 2))
+	bridge.stop()
+	bridge2.stop()
+
+def test_group_on_two_bridges():
+	bridge, s = with_bridge(lights=4)
+	bridge2 = with_second_bridge(s, lights=4)
+	s.light, s.ambilight_dim = 0, False
+	hue = HueUnderTest(s)
+	ok_(isinstance(hue.light, Groups))
+	eq_(each_light(hue.light), [hue.light])
+	hue.light.set_light2(1000, 100, 100, 0, PRIORITY_AMBILIGHT)
+	eq_(bridge.wait_for(1)[0].resource, "groups")
+	eq_(bridge2.wait_for(1)[0].resource, "groups")
+	# another group on the second bridge, the first bridge isn't asked again
+	group1 = hue.light.groups[0]
+	requests_before = len(bridge.commands)
+	s2 = copy.copy(s)
+	s2.bridge2_group_id = 1
+	hue.reload_settings(s2).join(5)
+	ok_(hue.light.groups[0] is group1)
+	eq_(hue.light.groups[1].group_id, 1)
+	eq_(len(bridge.commands), requests_before)
+	bridge.stop()
+	bridge2.stop()
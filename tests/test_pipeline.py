@@ -0,0 +1,95 @@
+from nose.tools import *
+import os
+import time
+import threading
+os.sys.path.append("./resources/lib/")
+
+from pipeline import *
+
+class Logger():
+	def debuglog(self, msg, *args):
+		pass
+
+class Sender():
+	# records the targets, the first send blocks until released
+	def __init__(self):
+		self.sent = []
+		self.started = threading.Event()
+		self.release = threading.Event()
+
+	def __call__(self, light, target):
+		self.started.set()
+		self.release.wait(5)
+		self.sent.append((light, target))
+
+def wait_until(condition, timeout=2):
+	deadline = time.time() + timeout
+	while not condition() and time.time() < deadline:
+		time.sleep(0.01)
+	return condition()
+
+def start(sender):
+	pipeline = FramePipeline(sender, Logger())
+	pipeline.start()
+	return pipeline
+
+def test_sends_the_latest_target():
+	sender = Sender()
+	pipeline = start(sender)
+	try:
+		pipeline.publish(0, "light 1", "a")
+		ok_(sender.started.wait(2))
+		pipeline.publish(0, "light 1", "b") # replaced before it was sent
+		pipeline.publish(0, "light 1", "c")
+		sender.release.set()
+		ok_(wait_until(lambda: len(sender.sent) == 2))
+		eq_(sender.sent, [("light 1", "a"), ("light 1", "c")])
+		eq_((pipeline.published, pipeline.dropped), (3, 1))
+	finally:
+		sender.release.set()
+		pipeline.stop()
+
+def test_clear_drops_waiting_targets():
+	sender = Sender()
+	pipeline = start(sender)
+	try:
+		pipeline.publish(0, "light 1", "a")
+		ok_(sender.started.wait(2))
+		pipeline.publish(0, "light 1", "b")
+		pipeline.publish(1, "light 2", "b")
+		clear = threading.Thread(target=pipeline.clear)
+		clear.start()
+		sender.release.set()
+		clear.join(2)
+		ok_(not clear.is_alive())
+		time.sleep(0.1)
+		eq_(sender.sent, [("light 1", "a")])
+		pipeline.publish(1, "light 2", "c") # after the clear, sent as usual
+		ok_(wait_until(lambda: len(sender.sent) == 2))
+		eq_(sender.sent[1], ("light 2", "c"))
+		eq_(pipeline.dropped, 2)
+	finally:
+		sender.release.set()
+		pipeline.stop()
+
+def test_clear_waits_for_the_send_under_way():
+	sender = Sender()
+	pipeline = start(sender)
+	try:
+		with pipeline.cond: # taken by the sender together
+			pipeline.publish(0, "light 1", "a")
+			pipeline.publish(1, "light 2", "a")
+		ok_(sender.started.wait(2))
+		clear = threading.Thread(target=pipeline.clear)
+		clear.start()
+		time.sleep(0.1)
+		ok_(clear.is_alive(), "clear returned while light 1 was being sent")
+		sender.release.set()
+		clear.join(2)
+		ok_(not clear.is_alive())
+		time.sleep(0.1)
+		eq_(sender.sent, [("light 1", "a")]) # light 2 was taken before the clear, it's stale
+		eq_(pipeline.dropped, 1)
+	finally:
+		sender.release.set()
+		pipeline.stop()
@@ -0,0 +1,100 @@
+from nose.tools import *
+import os
+import time
+os.sys.path.append("./resources/lib/")
+os.sys.path.append("./tests/")
+
+import fake_kodi
+from mock_bridge import *
+from spectrum import *
+from smoothing import *
+
+addon = fake_kodi.load_addon('kodi_hue_scene_cut')
+
+def frame(colors, width=16, height=9):
+	# RGBA frame split into vertical bands of the given colors
+	pixels = bytearray()
+	for y in range(height):
+		for x in range(width):
+			pixels += bytearray(colors[x * len(colors) // width] + (255,))
+	return pixels
+
+def histograms(pixels):
+	return [spectrum_hsv_lut(pixels, True)]
+
+RED = (200, 20, 20)
+ORANGE = (200, 90, 20)
+BLUE = (20, 20, 200)
+DARK = (10, 10, 10)
+
+def test_first_frame_is_no_cut():
+	detector = SceneCutDetector(50)
+	ok_(not detector.cut(histograms(frame([RED]))))
+	eq_(detector.scene, 0)
+
+def test_hard_cut():
+	detector = SceneCutDetector(50)
+	detector.cut(histograms(frame([RED, DARK])))
+	ok_(detector.cut(histograms(frame([BLUE, BLUE]))))
+	eq_(detector.scene, 1)
+	ok_(not detector.cut(histograms(frame([BLUE, BLUE])))) # same scene goes on
+	eq_(detector.scene, 1)
+
+def test_drift_is_no_cut():
+	detector = SceneCutDetector(50)
+	detector.cut(histograms(frame([RED, DARK, DARK])))
+	ok_(not detector.cut(histograms(frame([RED, RED, DARK])))) # a third of the picture changed
+	ok_(not detector.cut(histograms(frame([ORANGE, RED, DARK])))) # hue moved a little
+
+def test_fade_to_black():
+	detector = SceneCutDetector(50)
+	detector.cut(histograms(frame([(240, 240, 240)])))
+	ok_(detector.cut(histograms(frame([DARK])))) # no color either way, but the brightness dropped
+
+def test_threshold():
+	detector = SceneCutDetector(0)
+	detector.cut(histograms(frame([RED])))
+	ok_(not detector.cut(histograms(frame([BLUE]))))
+	detector = SceneCutDetector(20)
+	detector.cut(histograms(frame([RED, DARK, DARK])))
+	ok_(detector.cut(histograms(frame([RED, RED, DARK]))))
+
+def test_zones_combined():
+	detector = SceneCutDetector(50)
+	left = ({0: 50.0}, {0: 1.0}, {0: 0.8}, 100.0, 0.5)
+	right = ({240: 50.0}, {240: 1.0}, {240: 0.8}, 100.0, 0.5)
+	detector.cut([left, right])
+	ok_(not detector.cut([right, left])) # the same colours, just elsewhere
+	ok_(detector.cut([({120: 100.0}, {120: 1.0}, {120: 0.8}, 100.0, 0.5)] * 2))
+
+def test_cut_skips_smoothing():
+	smoother = LightSmoother(SMOOTHING_EXPONENTIAL, tau=0.5, threshold=2)
+	smoother.update(0, 255, 200, 0.0)
+	smoothed = smoother.update(43690, 255, 200, 0.05)
+	ok_(smoothed[:3] != (43690, 255, 200) and not smoothed[4]) # on its way
+	h, s, v, distance, cut = smoother.update(43690, 255, 200, 0.1, scene=1)
+	eq_((h, s, v, cut), (43690, 255, 200, True))
+	eq_(smoother.update(43690, 255, 200, 0.15, scene=1), None)
+
+def test_scene_cut_drops_the_old_scene():
+	bridge = MockBridge(latency=0.2).start()
+	fake_kodi.SETTINGS.update(bridge_ip=bridge.ip, bridge_user=USERNAME, force_light_on="true", send_workers="1")
+	settings = addon.MySettings()
+	addon.logger = addon.Logger()
+	addon.logger.disable()
+	lights = [addon.Light(i, settings) for i in (1, 2)]
+	pipeline = addon.FramePipeline(lambda light, target: None, addon.logger) # not started, the frame stays in its mailbox
+	pipeline.publish(0, lights[0], "old scene")
+	addon.pipeline = pipeline
+	try:
+		lights[0].set_light2(0, 255, 200, 0, addon.PRIORITY_AMBILIGHT) # on its way
+		time.sleep(0.05)
+		lights[1].set_light2(0, 255, 200, 0, addon.PRIORITY_AMBILIGHT) # queued behind it
+		addon.scene_cut()
+		eq_(pipeline.slots, {})
+		time.sleep(0.5)
+		eq_([c.id for c in bridge.puts()], ["1"])
+	finally:
+		addon.pipeline = None
+		addon.stop_schedulers()
+		bridge.stop()
@@ -0,0 +1,80 @@
+from nose.tools import *
+import os
+os.sys.path.append("./resources/lib/")
+
+from smoothing import *
+
+class Settings():
+	def __init__(self, smoothing=SMOOTHING_EXPONENTIAL, smoothing_time=200, delta_e=2):
+		self.smoothing = smoothing
+		self.smoothing_time = smoothing_time
+		self.delta_e = delta_e
+
+def test_lab_round_trip():
+	for h, s, v in [(0, 255, 255), (21845, 200, 128), (43690, 100, 40), (12000, 0, 200)]:
+		back = lab_to_hsv(*hsv_to_lab(h, s, v))
+		ok_(delta_e(hsv_to_lab(*back), hsv_to_lab(h, s, v)) < 0.5, (h, s, v, back))
+
+def test_delta_e_is_perceptual():
+	# the same hue step is far more visible in saturated colours than in near greys
+	saturated = delta_e(hsv_to_lab(0, 255, 200), hsv_to_lab(2000, 255, 200))
+	grey = delta_e(hsv_to_lab(0, 10, 200), hsv_to_lab(2000, 10, 200))
+	ok_(saturated > 5 * grey)
+	eq_(delta_e(hsv_to_lab(100, 0, 200), hsv_to_lab(40000, 0, 200)), 0) # hue of a grey doesn't matter
+
+def test_noise_is_suppressed():
+	smoother = LightSmoother(SMOOTHING_OFF, threshold=2.0)
+	ok_(smoother.update(20000, 200, 150, 0.0) is not None) # the first one always goes out
+	for i in range(20):
+		eq_(smoother.update(20000 + (i % 3) * 40, 200 - i % 2, 150 + i % 2, i * 0.1), None)
+	ok_(smoother.update(30000, 200, 150, 2.1) is not None)
+
+def test_threshold_zero_sends_every_change():
+	smoother = LightSmoother(SMOOTHING_OFF, threshold=0)
+	smoother.update(20000, 200, 150, 0.0)
+	eq_(smoother.update(20000, 200, 150, 0.1), None)
+	eq_(smoother.update(20000, 200, 151, 0.2)[:3], (20000, 200, 151))
+
+def steps(mode):
+	# filtered L* after each 50ms frame of a step from black to white
+	smoother = LightSmoother(mode, tau=0.2, threshold=0)
+	smoother.update(0, 0, 0, 0.0)
+	values = []
+	for i in range(1, 40):
+		smoother.update(0, 0, 255, i * 0.05)
+		values.append(smoother.state[0])
+	return values
+
+def test_exponential_filter():
+	values = steps(SMOOTHING_EXPONENTIAL)
+	ok_(55 < values[3] < 70, values[3]) # 1 - 1/e of the way after tau
+	ok_(all(a <= b for a, b in zip(values, values[1:])))
+	ok_(values[-1] > 99.9)
+
+def test_damped_filter_no_overshoot():
+	values = steps(SMOOTHING_DAMPED)
+	ok_(values[0] < steps(SMOOTHING_EXPONENTIAL)[0]) # slower start
+	ok_(all(a <= b + 1e-9 for a, b in zip(values, values[1:])))
+	ok_(max(values) <= 100.0 + 1e-6)
+	ok_(values[-1] > 99.0)
+
+def test_gap_jumps_to_target():
+	smoother = LightSmoother(SMOOTHING_EXPONENTIAL, tau=0.2)
+	smoother.update(0, 0, 0, 0.0)
+	eq_(smoother.update(0, 0, 255, 5.0)[:3], (0, 0, 255))
+
+def test_smoothing_counts_and_settles():
+	smoothing = Smoothing(Settings(delta_e=2))
+	light = object()
+	smoothing.update(light, 0, 0, 0, 0.0)
+	now = 0.05
+	smoothing.update(light, 0, 0, 255, now)
+	while not smoothing.settled():
+		now += 0.05
+		smoothing.update(light, 0, 0, 255, now)
+	ok_(now < 2.0)
+	eq_(smoothing.update(light, 0, 0, 255, now + 0.05), None)
+	ok_(smoothing.sent > 2 and smoothing.suppressed >= 1)
+	ok_("suppressed: %d" % smoothing.suppressed in repr(smoothing))
+	smoothing.reset()
+	ok_(smoothing.update(light, 0, 0, 255, now + 0.1) is not None)
@@ -0,0 +1,239 @@
+from nose.tools import *
+from nose.plugins.skip import SkipTest
+import os
+import random
+import shutil
+import colorsys
+import tempfile
+os.sys.path.append("./resources/lib/")
+
+import spectrum
+from spectrum import *
+
+def reference_hsv(pixels, rgba=True):
+	# the colorsys loop the faster paths replace, with per-bin means
+	spectrum, saturation, value = {}, {}, {}
+	size = int(len(pixels) / 4)
+	v_sum = 0.0
+	for i in range(size):
+		if rgba:
+			r, g, b = pixels[i * 4], pixels[i * 4 + 1], pixels[i * 4 + 2]
+		else:
+			b, g, r = pixels[i * 4], pixels[i * 4 + 1], pixels[i * 4 + 2]
+		tmph, tmps, tmpv = colorsys.rgb_to_hsv(r / 255.0, g / 255.0, b / 255.0)
+		v_sum += tmpv
+		if tmpv > VALUE_THRESHOLD and tmps > SATURATION_THRESHOLD:
+			h = int(tmph * 360)
+			spectrum[h] = spectrum.get(h, 0) + 1
+			saturation[h] = saturation.get(h, 0.0) + tmps
+			value[h] = value.get(h, 0.0) + tmpv
+	for h, n in spectrum.items():
+		saturation[h] /= n
+		value[h] /= n
+	return spectrum, saturation, value, size, v_sum / size
+
+def frames(width=32, height=18):
+	rnd = random.Random(width * height)
+	noise = bytearray(rnd.randrange(256) for i in range(width * height * 4))
+	gradient = bytearray()
+	for y in range(height):
+		for x in range(width):
+			gradient += bytearray([x * 255 // width, y * 255 // height, 128, 255])
+	bands = bytearray()
+	for y in range(height):
+		for x in range(width):
+			bands += bytearray([(200, 20, 20), (20, 200, 20), (10, 10, 10)][x * 3 // width] + (255,))
+	return {'noise': noise, 'gradient': gradient, 'bands': bands}
+
+def close(a, b, places=9):
+	eq_(sorted(a), sorted(b))
+	for key in a:
+		ok_(abs(a[key] - b[key]) < 10 ** -places, "%s: %s != %s" % (key, a[key], b[key]))
+
+def test_numpy_matches_colorsys():
+	if numpy is None:
+		raise SkipTest("numpy not installed")
+	for name, pixels in sorted(frames().items()):
+		for rgba in (True, False):
+			spectrum, saturation, value, size, overall_value = spectrum_hsv_numpy(pixels, rgba)
+			ref = reference_hsv(pixels, rgba)
+			eq_(spectrum, ref[0], name)
+			ok_(all(type(n) is int for n in spectrum.values()), "counts are pixel counts")
+			close(saturation, ref[1])
+			close(value, ref[2])
+			eq_(size, ref[3])
+			ok_(abs(overall_value - ref[4]) < 1e-9)
+
+def test_numpy_weighted_histogram():
+	if numpy is None:
+		raise SkipTest("numpy not installed")
+	pixels = frames()['bands']
+	h, s, v = hsv_numpy(pixels)
+	weights = numpy.ones(len(v)) * 0.5
+	weights[:len(v) // 2] = 0 # the top half doesn't count
+	spectrum, saturation, value, size, overall_value = histogram_numpy(h, s, v, weights)
+	ref = reference_hsv(pixels[len(pixels) // 2:])
+	eq_(size, ref[3] * 0.5)
+	eq_(spectrum, dict((key, n * 0.5) for key, n in ref[0].items()))
+	close(saturation, ref[1])
+	close(value, ref[2])
+	ok_(abs(overall_value - ref[4]) < 1e-9)
+
+def hue_step(r, g, b):
+	# the most a hue can move when each channel moves by one lookup table
+	# step, in degrees, plus one for the cut to whole degrees
+	step = (1 << (8 - LUT_BITS)) / 255.0
+	delta = (max(r, g, b) - min(r, g, b)) / 255.0
+	return 60 * 2 * step / (delta - step) + 1
+
+def test_lut_hue_within_a_step():
+	bins, sats, vals = load_lut()
+	shift = 8 - LUT_BITS
+	for name, pixels in sorted(frames(64, 36).items()):
+		for p in range(0, len(pixels), 4):
+			r, g, b = pixels[p], pixels[p + 1], pixels[p + 2]
+			i = ((r >> shift) << (LUT_BITS * 2)) | ((g >> shift) << LUT_BITS) | (b >> shift)
+			tmph, tmps, tmpv = colorsys.rgb_to_hsv(r / 255.0, g / 255.0, b / 255.0)
+			if bins[i] < 0 or not (tmpv > VALUE_THRESHOLD and tmps > SATURATION_THRESHOLD):
+				continue # filtered out by one of them, that's near a threshold (below)
+			error = abs(bins[i] - int(tmph * 360))
+			ok_(min(error, 360 - error) <= hue_step(r, g, b), "%s: %s" % (name, (r, g, b)))
+
+def test_lut_filters_like_colorsys():
+	bins, sats, vals = load_lut()
+	shift = 8 - LUT_BITS
+	step = (1 << shift) / 255.0
+	for name, pixels in sorted(frames(64, 36).items()):
+		for p in range(0, len(pixels), 4):
+			r, g, b = pixels[p], pixels[p + 1], pixels[p + 2]
+			i = ((r >> shift) << (LUT_BITS * 2)) | ((g >> shift) << LUT_BITS) | (b >> shift)
+			tmph, tmps, tmpv = colorsys.rgb_to_hsv(r / 255.0, g / 255.0, b / 255.0)
+			if (bins[i] >= 0) != (tmpv > VALUE_THRESHOLD and tmps > SATURATION_THRESHOLD):
+				near = abs(tmpv - VALUE_THRESHOLD) <= step or abs(tmps - SATURATION_THRESHOLD) <= 2 * step / (tmpv - step)
+				ok_(near, "%s: %s" % (name, (r, g, b)))
+
+def scene(width=64, height=36):
+	# mostly orange, with noise
+	rnd = random.Random(3)
+	pixels = bytearray()
+	for i in range(width * height):
+		pixels += bytearray([min(255, max(0, c + rnd.randrange(-30, 31))) for c in (200, 110, 30)] + [255])
+	return pixels
+
+def most_used(spectrum, saturation, width=20):
+	# the biggest color group of Screenshot.most_used_spectrum (default
+	# color bias) and its mean hue
+	groups = {}
+	for h, n in spectrum.items():
+		group = groups.setdefault(int(((h + width / 2) % 360) / width), [0, 0.0])
+		group[0] += n
+		group[1] += h * n
+	key = max(groups, key=lambda k: groups[k][0])
+	return key, groups[key][1] / groups[key][0]
+
+def test_lut_most_used_matches_colorsys():
+	for name, pixels in [('bands', frames()['bands']), ('scene', scene())]:
+		lut = spectrum_hsv_lut(pixels)
+		ref = reference_hsv(pixels)
+		group, hue = most_used(lut[0], lut[1])
+		ref_group, ref_hue = most_used(ref[0], ref[1])
+		eq_(group, ref_group, name)
+		ok_(abs(hue - ref_hue) <= hue_step(200, 110, 30), "%s: %s, colorsys %s" % (name, hue, ref_hue))
+		ok_(abs(lut[4] - ref[4]) < (1 << (8 - LUT_BITS)) / 255.0)
+
+def fresh_lut(cache_dir):
+	# load_lut as in a new process
+	spectrum._lut = None
+	try:
+		return load_lut(cache_dir)
+	finally:
+		spectrum._lut = None
+
+def test_lut_cache():
+	cache_dir = tempfile.mkdtemp()
+	path = os.path.join(cache_dir, LUT_FILE % LUT_BITS)
+	built = fresh_lut(cache_dir)
+	ok_(os.path.exists(path))
+	build_lut = spectrum.build_lut
+	spectrum.build_lut = None # read from the cache, not built again
+	try:
+		eq_(fresh_lut(cache_dir), built)
+	finally:
+		spectrum.build_lut = build_lut
+	shutil.rmtree(cache_dir)
+
+def test_lut_cache_rebuilt():
+	cache_dir = tempfile.mkdtemp()
+	path = os.path.join(cache_dir, LUT_FILE % LUT_BITS)
+	built = fresh_lut(cache_dir)
+	good = open(path, "rb").read()
+	middle = len(good) // 2
+	broken = {
+		'truncated': good[:middle],
+		'too long': good + good[:100],
+		'corrupt': good[:middle] + bytearray(b ^ 0xff for b in bytearray(good[middle:middle + 8])) + good[middle + 8:],
+		'empty': b"",
+	}
+	for name, data in sorted(broken.items()):
+		open(path, "wb").write(data)
+		eq_(fresh_lut(cache_dir), built, name)
+		eq_(open(path, "rb").read(), good, name)
+	shutil.rmtree(cache_dir)
+
+def flat(color, width=64, height=36):
+	return bytearray(color + (255,)) * (width * height)
+
+def with_block(pixels, x, y, size, color, width=64):
+	# a size x size block of color at x, y
+	pixels = bytearray(pixels)
+	row = bytearray(color + (255,)) * size
+	for line in range(y, y + size):
+		start = (line * width + x) * 4
+		pixels[start:start + len(row)] = row
+	return pixels
+
+def test_identical_frame_is_skipped():
+	detector = FrameChangeDetector(2)
+	ok_(detector.changed(flat((100, 50, 20))))
+	ok_(not detector.changed(flat((100, 50, 20))))
+	eq_((detector.analysed, detector.skipped), (1, 1))
+
+def test_change_tolerance():
+	detector = FrameChangeDetector(5)
+	detector.changed(flat((100, 100, 100)))
+	ok_(not detector.changed(flat((104, 100, 96)))) # mean difference 8/3 per channel
+	ok_(not detector.changed(flat((105, 105, 105)))) # at the tolerance
+	ok_(detector.changed(flat((106, 106, 106))))
+	ok_(not detector.changed(bytearray([106, 106, 106, 0]) * (64 * 36))) # alpha doesn't count
+
+def test_slow_fade_is_not_lost():
+	# compared to the last analysed frame, not the previous one
+	detector = FrameChangeDetector(5)
+	detector.changed(flat((100, 100, 100)))
+	ok_(not detector.changed(flat((103, 103, 103))))
+	ok_(detector.changed(flat((106, 106, 106))))
+
+def test_reset_lets_the_next_frame_through():
+	detector = FrameChangeDetector(5)
+	detector.changed(flat((100, 100, 100)))
+	detector.reset()
+	ok_(detector.changed(flat((100, 100, 100))))
+	ok_(not detector.changed(flat((100, 100, 100))))
+
+def test_capture_size_change_is_a_change():
+	detector = FrameChangeDetector(5)
+	detector.changed(flat((100, 100, 100), 16, 9)) # fewer pixels than samples
+	ok_(detector.changed(flat((100, 100, 100))))
+
+def test_samples_catch_a_small_object():
+	# an 8x8 block (1/36 of a 64x36 capture) is seen wherever it is, with the
+	# default tolerance
+	background = flat((20, 20, 20))
+	detector = FrameChangeDetector(2)
+	for y in range(36 - 8 + 1):
+		for x in range(64 - 8 + 1):
+			detector.reset()
+			detector.changed(background)
+			ok_(detector.changed(with_block(background, x, y, 8, (230, 230, 230))), (x, y))
+	eq_(FINGERPRINT_SAMPLES, 64)
+	eq_(len(detector.last), 64 * 3)
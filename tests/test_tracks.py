@@ -0,0 +1,78 @@
+from nose.tools import *
+import os
+import shutil
+import tempfile
+os.sys.path.append("./resources/lib/")
+
+from tracks import *
+
+class TestColorTrack:
+	def setup(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, track_key("/movies/film.mkv", 60))
+
+	def teardown(self):
+		shutil.rmtree(self.dir)
+
+	def test_round_trip(self):
+		track = ColorTrack(self.path, 2, 60)
+		track.write(12.34, [(0.5, 1.0, 0.25), (0.0, 0.2, 1.0)], scene=3)
+		scene, colors = track.read(12.3)
+		eq_(scene, 3)
+		for got, want in zip(colors, [(0.5, 1.0, 0.25), (0.0, 0.2, 1.0)]):
+			for a, b in zip(got, want):
+				ok_(abs(a - b) < 0.003, (got, want))
+		track.close()
+
+	def test_gaps_and_range(self):
+		track = ColorTrack(self.path, 1, 60)
+		track.write(10.0, [(0.1, 0.1, 0.1)])
+		eq_(track.read(9.9), None) # never played
+		eq_(track.read(20.0), None)
+		eq_(track.read(-1.0), None)
+		eq_(track.read(61.0), None)
+		track.write(70.0, [(0.1, 0.1, 0.1)]) # past the end, ignored
+		track.write(11.0, [(0.1, 0.1, 0.1), (0.2, 0.2, 0.2)]) # wrong number of lights
+		eq_(track.read(11.0), None)
+		track.close()
+
+	def test_hold_fills_short_gaps_only(self):
+		track = ColorTrack(self.path, 1, 60)
+		track.write(10.0, [(0.1, 0.1, 0.1)])
+		track.write(10.35, [(0.9, 0.9, 0.9)]) # a frame every 350ms
+		ok_(abs(track.read(10.25)[1][0][0] - 0.1) < 0.01) # what was showing in between
+		ok_(abs(track.read(10.35)[1][0][0] - 0.9) < 0.01)
+		track.write(20.0, [(0.5, 0.5, 0.5)]) # long gap, not filled
+		eq_(track.read(15.0), None)
+		track.seeked()
+		track.write(20.5, [(0.5, 0.5, 0.5)]) # after a seek, not filled either
+		eq_(track.read(20.2), None)
+		track.close()
+
+	def test_reopen_keeps_records(self):
+		track = ColorTrack(self.path, 1, 60)
+		track.write(30.0, [(0.3, 0.4, 0.5)], scene=1)
+		track.close()
+		track = ColorTrack(self.path, 1, 60)
+		eq_(track.read(30.0)[0], 1)
+		track.close()
+		track = ColorTrack(self.path, 2, 60) # other layout starts over
+		eq_(track.read(30.0), None)
+		track.close()
+
+def test_track_key():
+	eq_(track_key("/a.mkv", 100.2), track_key(u"/a.mkv", 99.8))
+	ok_(track_key("/a.mkv", 100) != track_key("/a.mkv", 100, "2|0"))
+	ok_(track_key("/a.mkv", 100) != track_key("/b.mkv", 100))
+
+def test_prune_tracks():
+	track_dir = tempfile.mkdtemp()
+	try:
+		for i in range(5):
+			path = os.path.join(track_dir, "%d.trk" % i)
+			open(path, "w").close()
+			os.utime(path, (1000 + i, 1000 + i))
+		prune_tracks(track_dir, kept=3)
+		eq_(sorted(os.listdir(track_dir)), ["2.trk", "3.trk", "4.trk"])
+	finally:
+		shutil.rmtree(track_dir)
@@ -0,0 +1,148 @@
+from nose.tools import *
+from nose.plugins.skip import SkipTest
+import os
+os.sys.path.append("./resources/lib/")
+
+import zones
+from zones import *
+
+class Settings():
+	def __init__(self, light=3, zones=(ZONE_LEFT, ZONE_SCREEN, ZONE_RIGHT), rect="0,0,100,100", zone_falloff=10):
+		self.light = light
+		self.light1_zone, self.light2_zone, self.light3_zone = zones
+		self.light1_zone_rect = self.light2_zone_rect = self.light3_zone_rect = rect
+		self.zone_falloff = zone_falloff
+
+RED = (200, 20, 20)
+GREEN = (20, 200, 20)
+BLUE = (20, 20, 200)
+
+def bands(colors, width=30, height=9):
+	# RGBA frame split into vertical bands of the given colors
+	pixels = bytearray()
+	for y in range(height):
+		for x in range(width):
+			pixels += bytearray(colors[x * len(colors) // width] + (255,))
+	return pixels
+
+def crop(pixels, width, left, right):
+	# the columns left..right-1 of every row
+	cropped = bytearray()
+	for row in range(0, len(pixels), width * 4):
+		cropped += pixels[row + left * 4:row + right * 4]
+	return cropped
+
+class pure_python():
+	# the zone map without numpy, also where numpy is installed
+	def __enter__(self):
+		self.numpy = zones.numpy
+		zones.numpy = None
+	def __exit__(self, *args):
+		zones.numpy = self.numpy
+
+def weights(rects, falloff, width, height):
+	# light -> compiled weight per pixel
+	with pure_python():
+		zone_map = ZoneMap(rects, falloff)
+		zone_map.compile(width, height)
+	compiled = [[0.0] * (width * height) for rect in rects]
+	for i, pixel in enumerate(zone_map.pixel_weights):
+		for light, weight in pixel:
+			compiled[light][i] = weight
+	return compiled
+
+def test_zone_rects():
+	eq_(zone_rect(ZONE_SCREEN), (0.0, 0.0, 1.0, 1.0))
+	eq_(zone_rect(ZONE_LEFT), (0.0, 0.0, 1 / 3.0, 1.0))
+	eq_(zone_rect(ZONE_BOTTOM), (0.0, 2 / 3.0, 1.0, 1.0))
+	eq_(zone_rect(ZONE_CUSTOM, "10,20,30,100"), (0.1, 0.2, 0.3, 1.0))
+	eq_(zone_rect(ZONE_CUSTOM, "-10,0,150,50"), (0.0, 0.0, 1.0, 0.5)) # clipped to the screen
+	eq_(zone_rect(ZONE_CUSTOM, "50,0,20,100"), zone_rect(ZONE_SCREEN)) # empty
+	eq_(zone_rect(ZONE_CUSTOM, "junk"), zone_rect(ZONE_SCREEN))
+	eq_(zone_rect(42), zone_rect(ZONE_SCREEN))
+
+def test_zone_map_from_settings():
+	eq_(zone_map(Settings(light=0)), None) # popularity mode
+	eq_(zone_map(Settings(zones=(ZONE_SCREEN,) * 3)), None)
+	zone_map_ = zone_map(Settings(light=2, zones=(ZONE_LEFT, ZONE_CUSTOM, ZONE_TOP), rect="50,0,100,50", zone_falloff=20))
+	eq_(zone_map_.rects, [zone_rect(ZONE_LEFT), (0.5, 0.0, 1.0, 0.5)])
+	eq_(zone_map_.falloff, 0.2)
+
+def test_hard_edges():
+	left, right = weights([zone_rect(ZONE_LEFT), zone_rect(ZONE_RIGHT)], 0, 30, 9)
+	for y in range(9):
+		eq_(left[y * 30:y * 30 + 30], [1.0] * 10 + [0.0] * 20)
+		eq_(right[y * 30:y * 30 + 30], [0.0] * 20 + [1.0] * 10)
+
+def test_falloff_weights():
+	# pixel centers of a 30 wide capture are at (x + 0.5) / 30, the left zone
+	# ends at 1/3 and fades out over a tenth of the screen
+	left, = weights([zone_rect(ZONE_LEFT)], 0.1, 30, 9)
+	row = left[:30]
+	eq_(row[:10], [1.0] * 10)
+	ok_(abs(row[10] - (1 - (10.5 / 30 - 1 / 3.0) / 0.1)) < 1e-9)
+	ok_(1.0 > row[10] > row[11] > row[12] > 0.0)
+	eq_(row[13:], [0.0] * 17)
+	eq_(left[30 * 8:30 * 9], row) # the same on every row
+
+def test_falloff_in_both_directions():
+	corner, = weights([(0.0, 0.0, 0.5, 0.5)], 0.2, 10, 10)
+	eq_(corner[0], 1.0)
+	ok_(abs(corner[5] - 0.75) < 1e-9) # x = 0.55
+	ok_(abs(corner[5 * 10] - 0.75) < 1e-9) # y = 0.55
+	ok_(abs(corner[5 * 10 + 5] - 0.75 * 0.75) < 1e-9) # both
+	ok_(abs(corner[6] - 0.25) < 1e-9)
+	eq_(corner[7], 0.0)
+	eq_(corner[9 * 10 + 9], 0.0)
+
+def test_compiled_once_per_size():
+	with pure_python():
+		zone_map_ = ZoneMap([zone_rect(ZONE_LEFT)], 0.1)
+		zone_map_.compile(30, 9)
+		compiled = zone_map_.pixel_weights
+		zone_map_.compile(30, 9)
+		ok_(zone_map_.pixel_weights is compiled)
+		zone_map_.compile(16, 9)
+		eq_(len(zone_map_.pixel_weights), 16 * 9)
+
+def test_lut_zones_are_their_part_of_the_screen():
+	pixels = bands([RED, GREEN, BLUE])
+	with pure_python():
+		left, right = ZoneMap([zone_rect(ZONE_LEFT), zone_rect(ZONE_RIGHT)], 0).spectra(pixels, 30, 9)
+	eq_(left, spectrum_hsv_lut(crop(pixels, 30, 0, 10)))
+	eq_(right, spectrum_hsv_lut(crop(pixels, 30, 20, 30)))
+
+def same_histogram(a, b):
+	# equal up to the order the sums were taken in
+	eq_(a[0], b[0])
+	for i in (1, 2):
+		eq_(sorted(a[i]), sorted(b[i]))
+		ok_(all(abs(a[i][h] - b[i][h]) < 1e-9 for h in a[i]))
+	eq_(a[3], b[3])
+	ok_(abs(a[4] - b[4]) < 1e-9)
+
+def test_numpy_zones_are_their_part_of_the_screen():
+	if numpy is None:
+		raise SkipTest("numpy not installed")
+	pixels = bands([RED, GREEN, BLUE])
+	left, right = ZoneMap([zone_rect(ZONE_LEFT), zone_rect(ZONE_RIGHT)], 0).spectra(pixels, 30, 9)
+	same_histogram(left, spectrum_hsv_numpy(crop(pixels, 30, 0, 10)))
+	same_histogram(right, spectrum_hsv_numpy(crop(pixels, 30, 20, 30)))
+
+def test_numpy_and_lut_agree():
+	if numpy is None:
+		raise SkipTest("numpy not installed")
+	pixels = bands([RED, (200, 110, 30), GREEN, (60, 60, 60), BLUE], 64, 36)
+	rects = [zone_rect(ZONE_LEFT), zone_rect(ZONE_SCREEN), zone_rect(ZONE_RIGHT)]
+	array = ZoneMap(rects, 0.1).spectra(pixels, 64, 36)
+	with pure_python():
+		lut = ZoneMap(rects, 0.1).spectra(pixels, 64, 36)
+	step = (1 << (8 - LUT_BITS)) / 255.0
+	for (spectrum, saturation, value, size, overall_value), (lut_spectrum, lut_saturation, lut_value, lut_size, lut_overall_value) in zip(array, lut):
+		ok_(abs(size - lut_size) < 1e-9)
+		ok_(abs(overall_value - lut_overall_value) < step)
+		ok_(abs(sum(spectrum.values()) - sum(lut_spectrum.values())) < 1e-9) # the same pixels have a color
+		for h, n in spectrum.items():
+			# the lookup table's hue of a band is within a few degrees
+			near = sum(m for k, m in lut_spectrum.items() if min(abs(k - h), 360 - abs(k - h)) <= 3)
+			ok_(near >= n - 1e-9, (h, n, lut_spectrum))